@@ -0,0 +1,50 @@
+#!/usr/bin/python2
+
+import sys, time
+sys.path.insert(0, '.')
+
+from biblio.parsers import read_metadata
+from biblio.text    import open_text_reader, TextException
+
+COMPRESSIONS = { 1: 'none', 2: 'palmdoc', 17480: 'huff/cdic' }
+
+totals = {}
+
+for f in sys.argv[1:]:
+    metadata = read_metadata(f)
+    try:
+        reader = open_text_reader(f, metadata)
+    except TextException, e:
+        print "%s: %s" % (f, e)
+        continue
+
+    with reader:
+        start = time.time()
+        reader.record(0)
+        first = time.time() - start
+
+        start = time.time()
+        size = 0
+        for record in reader.iter_records():
+            size += len(record)
+        elapsed = time.time() - start
+
+    compression = getattr(reader, 'compression', 'zlib')
+    compression = COMPRESSIONS.get(compression, str(compression))
+    print f
+    print "  compression  :", compression
+    print "  records      :", reader.record_count
+    print "  text bytes   :", size
+    print "  first record : %.2f ms" % (first * 1000)
+    print "  all records  : %.2f ms (%.2f MB/s)" % (elapsed * 1000, size / max(elapsed, 1e-9) / 1048576)
+
+    total = totals.setdefault(compression, [ 0, 0, 0.0 ])
+    total[0] += 1
+    total[1] += size
+    total[2] += elapsed
+
+if totals:
+    print
+    for compression, (books, size, elapsed) in sorted(totals.items()):
+        print "%-10s %4d books %10d bytes %8.2f ms %8.2f MB/s" % \
+              (compression, books, size, elapsed * 1000, size / max(elapsed, 1e-9) / 1048576)
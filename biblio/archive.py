@@ -0,0 +1,292 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# BOOKS INSIDE ARCHIVES
+#
+# Books bundled in ZIP and TAR archives are read in place, without being
+# extracted. Each member is opened as a seekable, read-only view of the
+# archive, and the views are handed to identify_stream() and to the
+# parsers exactly like files (open_header() accepts them):
+#
+#   stored ZIP members and TAR members are one contiguous range of the
+#   archive, read through a RangeFile: every read goes straight to the
+#   archive file, and nothing is copied
+#
+#   deflated ZIP members are read through an InflatingFile, which inflates
+#   only as far as the reads reach. Seeking forward inflates and discards;
+#   seeking back restarts from the nearest checkpoint, a copy of the
+#   inflater saved every INFLATE_CHECKPOINT_INTERVAL bytes of output
+#
+# An EPUB inside a ZIP is then opened by the EPUB parser as a ZIP file of
+# its own over the member view, and archives inside archives are walked
+# the same way. Members are named "archive.zip!/path/in/archive", with one
+# "!/" per level of nesting.
+#
+# Only uncompressed TAR archives can be read in place; encrypted ZIP
+# members and compression methods other than deflate are skipped.
+
+from __future__ import with_statement
+from collections import namedtuple
+import os, tarfile, zlib
+
+from biblio.identifiers           import identify_stream, extension_hints
+from biblio.identifiers.filetypes import TAR, is_archive, is_ebook
+from biblio.util.iopolicy         import open_header
+from biblio.util.rangefile        import RangeFile
+from biblio.util.rawzip           import ZipEditException, read_central_directory, \
+                                         LOCAL_HEADER, LOCAL_SIGNATURE, ZIP_STORED, ZIP_DEFLATED, \
+                                         CD_FLAGS, CD_COMPRESS, CD_COMPRESSED_SIZE, CD_SIZE, CD_OFFSET
+
+__all__ = [ 'InflatingFile', 'archive_member', 'iterate_archive_members', 'scan_archive',
+            'ARCHIVE_SEPARATOR', ]
+
+##############################################################################
+
+class ArchiveException (Exception):
+    pass
+
+ARCHIVE_SEPARATOR = '!/'
+
+INFLATE_CHUNK_SIZE          = 64 * 1024
+INFLATE_CHECKPOINT_INTERVAL = 2 * 1024 * 1024
+
+ZIP_ENCRYPTED = 0x01
+
+# A member of an archive: its full name (see above), its size and a
+# seekable view of its contents
+archive_member = namedtuple('archive_member', 'name size view')
+
+##############################################################################
+
+class InflatingFile (object):
+    """
+    A read-only, seekable view of the raw deflate data in compressed_size
+    bytes of stream starting at offset, inflating to size bytes.
+    """
+
+    def __init__ (self, stream, offset, compressed_size, size, owned=False):
+        self.stream = stream
+        self.offset = offset
+        self.compressed_size = compressed_size
+        self.length = size
+        self.owned = owned
+        self.pos = 0
+        self.closed = False
+
+        # (output position, input position, inflater), by output position
+        self.checkpoints = [ (0, 0, zlib.decompressobj(-zlib.MAX_WBITS)), ]
+        self._restart(0)
+
+    def _restart (self, pos):
+        for checkpoint in reversed(self.checkpoints):
+            if checkpoint[0] <= pos:
+                break
+        self.buffer_start, self.raw_pos, inflater = checkpoint
+        self.inflater = inflater.copy()
+        self.buffer = ''
+
+    def _inflate (self):
+        """
+        Inflates the next chunk of input, returning the new output ('' at
+        the end of the data).
+        """
+        size = min(INFLATE_CHUNK_SIZE, self.compressed_size - self.raw_pos)
+        if size <= 0:
+            return self.inflater.flush()
+        self.stream.seek(self.offset + self.raw_pos)
+        chunk = self.stream.read(size)
+        if not chunk:
+            return self.inflater.flush()
+        self.raw_pos += len(chunk)
+        try:
+            return self.inflater.decompress(chunk)
+        except zlib.error, e:
+            raise IOError('bad deflate data: %s' % e)
+
+    def read (self, size=-1):
+        remaining = self.length - self.pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return ''
+
+        if self.pos < self.buffer_start:
+            self._restart(self.pos)
+        end = self.pos + size
+
+        # The buffer always ends where the inflater stands
+        produced = self.buffer_start + len(self.buffer)
+        pieces = []
+        if self.pos < produced:
+            pieces.append(self.buffer[self.pos - self.buffer_start:])
+        while produced < end:
+            data = self._inflate()
+            if not data:
+                break
+            start = produced
+            produced += len(data)
+            if produced - self.checkpoints[-1][0] >= INFLATE_CHECKPOINT_INTERVAL:
+                self.checkpoints.append((produced, self.raw_pos, self.inflater.copy()))
+            if produced > self.pos:                     # else skipping forward
+                pieces.append(data[max(0, self.pos - start):])
+
+        buffered = ''.join(pieces)
+        data = buffered[:size]
+        self.buffer = buffered[size:]
+        self.buffer_start = produced - len(self.buffer)
+        self.pos += len(data)
+        return data
+
+    def seek (self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.pos
+        elif whence == os.SEEK_END:
+            pos += self.length
+        if pos < 0:
+            raise IOError('negative seek position %d' % pos)
+        self.pos = pos
+
+    def tell (self):
+        return self.pos
+
+    def close (self):
+        if not self.closed:
+            self.closed = True
+            self.checkpoints = []
+            if self.owned:
+                self.stream.close()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        self.close()
+
+##############################################################################
+
+def _zip_members (stream, prefix):
+    try:
+        entries, end = read_central_directory(stream)
+    except ZipEditException, e:
+        raise ArchiveException(str(e))
+
+    for entry in entries:
+        if entry.name.endswith('/') or entry.fields[CD_FLAGS] & ZIP_ENCRYPTED:
+            continue
+        method = entry.fields[CD_COMPRESS]
+        if method not in (ZIP_STORED, ZIP_DEFLATED):
+            continue
+
+        offset = entry.fields[CD_OFFSET]
+        stream.seek(offset)
+        header = stream.read(LOCAL_HEADER.size)
+        if len(header) != LOCAL_HEADER.size or header[:4] != LOCAL_SIGNATURE:
+            continue
+        fields = LOCAL_HEADER.unpack(header)
+        offset += LOCAL_HEADER.size + fields[9] + fields[10]
+
+        size = entry.fields[CD_SIZE]
+        if method == ZIP_STORED:
+            view = RangeFile(stream, offset, size)
+        else:
+            view = InflatingFile(stream, offset, entry.fields[CD_COMPRESSED_SIZE], size)
+        view.name = prefix + entry.name
+        yield archive_member(view.name, size, view)
+
+def _tar_members (stream, prefix):
+    try:
+        archive = tarfile.open(fileobj=stream, mode='r:')
+    except tarfile.TarError, e:
+        raise ArchiveException(str(e))
+
+    for info in archive:
+        if not info.isfile() or info.issparse():
+            continue
+        view = RangeFile(stream, info.offset_data, info.size)
+        view.name = prefix + info.name
+        yield archive_member(view.name, info.size, view)
+
+def iterate_archive_members (source, filetype=None, name=None):
+    """
+    Yields an archive_member for every regular member of the ZIP or TAR
+    archive source (a file name, or a seekable file object). The views
+    are only valid until the next member is yielded.
+    """
+    if name is None:
+        name = source if isinstance(source, basestring) else getattr(source, 'name', '')
+    prefix = name + ARCHIVE_SEPARATOR
+
+    with open_header(source) as stream:
+        if filetype is None:
+            filetype = identify_stream(stream)
+        if filetype is None or not is_archive(filetype):
+            raise ArchiveException('not a ZIP or TAR archive: %s' % name)
+
+        stream.seek(0)
+        members = _tar_members(stream, prefix) if filetype == TAR else _zip_members(stream, prefix)
+        for member in members:
+            try:
+                yield member
+            finally:
+                member.view.close()
+
+##############################################################################
+
+def _report (onerror, name, error):
+    if onerror is not None:
+        onerror(name, error)
+
+def scan_archive (source, hint=False, nested=True, filetype=None, onerror=None):
+    """
+    Yields (member name, ebook metadata) for every book in an archive,
+    recursing into archives inside it when nested is set. Members that
+    are neither books nor archives are skipped. A member that cannot be
+    read (a failing parser, corrupt compressed data) is yielded with None,
+    after onerror(member name, exception) is called if given; a nested
+    archive that cannot be read is only reported. Either way the scan
+    goes on with the next member.
+    """
+    from biblio.ebook   import EBOOK_DOCUMENT_TYPES
+    from biblio.parsers import read_processed_metadata
+
+    for member in iterate_archive_members(source, filetype):
+        hints = extension_hints(member.name) if hint else None
+        try:
+            member_type = identify_stream(member.view, hints)
+        except Exception, e:
+            _report(onerror, member.name, e)
+            yield member.name, None
+            continue
+        if member_type is None:
+            continue
+
+        if is_archive(member_type):
+            if nested:
+                try:
+                    for result in scan_archive(member.view, hint, nested, member_type, onerror):
+                        yield result
+                except Exception, e:
+                    _report(onerror, member.name, e)
+        elif is_ebook(member_type) or member_type in EBOOK_DOCUMENT_TYPES:
+            try:
+                metadata = read_processed_metadata(member.view, filetype=member_type)
+            except Exception, e:
+                _report(onerror, member.name, e)
+                metadata = None
+            yield member.name, metadata
+
+##############################################################################
+## THE END
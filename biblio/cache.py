@@ -0,0 +1,274 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# METADATA CACHE
+#
+# Processed ebook metadata is cached in two tiers that share one storage
+# backend (and therefore one eviction policy):
+#
+#   stat         keyed on (st_dev, st_ino, st_size, st_mtime). Free to
+#                compute, but lost whenever a file is copied, restored
+#                from a backup or moved to another share.
+#
+#   fingerprint  keyed on the file size plus a SHA-1 of the first and last
+#                FINGERPRINT_SIZE bytes. The head of the file covers the
+#                PDB record table and, for PalmDOC and MOBI books, record 0
+#                with its MOBI and EXTH headers; the tail covers the ZIP
+#                central directory of an EPUB. A copied or moved book is
+#                found here without being reparsed.
+#
+# A lookup tries the stat tier first and only fingerprints the file on a
+# miss; get_or_read() reuses that fingerprint to store what it reads, so a
+# file is fingerprinted at most once. A fingerprint hit is promoted into
+# the stat tier for the new location.
+#
+# Files that turn out not to be books are cached too, as NO_METADATA, so
+# that a rescan does not fingerprint and identify them again.
+
+from __future__ import with_statement
+import cPickle, hashlib, os, sqlite3, threading
+
+from biblio.metadata      import EbookMetadata, Storage
+from biblio.serialize     import encode_metadata, decode_metadata, is_metadata_record
+from biblio.util.iopolicy import open_header
+from biblio.util.lru      import LRUCache, cache_stats
+
+__all__ = [ 'MetadataCache', 'MemoryBackend', 'SQLiteBackend', 'CacheKeys',
+            'stat_key', 'fingerprint_key', 'FINGERPRINT_SIZE', 'NO_METADATA', ]
+
+##############################################################################
+
+FINGERPRINT_SIZE = 64 * 1024
+
+# Cached for files that have no metadata (not books, or unreadable ones)
+NO_METADATA = 'biblio.cache:no-metadata'
+
+def stat_key (filename, st=None):
+    if st is None:
+        st = os.stat(filename)
+    return ('stat', st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+def fingerprint_key (filename, size=FINGERPRINT_SIZE, st=None):
+    if st is None:
+        st = os.stat(filename)
+    digest = hashlib.sha1()
+    with open_header(filename) as stream:
+        if st.st_size <= 2 * size:
+            digest.update(stream.read())
+        else:
+            digest.update(stream.read(size))
+            stream.seek(-size, 2)
+            digest.update(stream.read(size))
+    return ('fingerprint', st.st_size, digest.hexdigest())
+
+class CacheKeys (object):
+    """
+    Both keys of one file, for a lookup and the store that follows it: the
+    file is stat'ed once, and only fingerprinted the first time the
+    fingerprint key is asked for.
+    """
+
+    def __init__ (self, filename, fingerprint_size=FINGERPRINT_SIZE):
+        self.filename = filename
+        self.fingerprint_size = fingerprint_size
+        self.st = os.stat(filename)
+        self.stat = stat_key(filename, self.st)
+        self._fingerprint = None
+
+    @property
+    def fingerprint (self):
+        if self._fingerprint is None:
+            self._fingerprint = fingerprint_key(self.filename, self.fingerprint_size, self.st)
+        return self._fingerprint
+
+##############################################################################
+
+# Storage backends
+#
+# A backend is a mapping of cache keys (tuples) to values with its own
+# eviction policy. It needs get(key, default), put(key, value) and
+# discard(key), plus maxsize and __len__ for the statistics.
+
+class MemoryBackend (object):
+
+    def __init__ (self, maxsize=65536):
+        self._lru = LRUCache(maxsize)
+
+    @property
+    def maxsize (self):
+        return self._lru.maxsize
+
+    def get (self, key, default=None):
+        return self._lru.get(key, default)
+
+    def put (self, key, value):
+        self._lru.put(key, value)
+
+    def discard (self, key):
+        self._lru.discard(key)
+
+    def __len__ (self):
+        return len(self._lru)
+
+class SQLiteBackend (object):
+    """
+    An on-disk backend. Entries are evicted in least recently used order
+    once there are more than maxsize of them. The entry count is kept in
+    memory, and the use times of hits are written in batches of
+    USED_BATCH_SIZE (and before evicting or closing), so a hit costs one
+    indexed SELECT and no write.
+    """
+
+    USED_BATCH_SIZE = 256
+
+    def __init__ (self, path, maxsize=1000000):
+        self.path = path
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS cache '
+                         '(key TEXT PRIMARY KEY, value BLOB, used INTEGER)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS cache_used ON cache (used)')
+        self._tick, self._count = \
+            self._db.execute('SELECT COALESCE(MAX(used), 0), COUNT(*) FROM cache').fetchone()
+        self._used = {}
+        self._db.commit()
+
+    def encode (self, value):
+        if isinstance(value, EbookMetadata):
+            return encode_metadata(value)
+        return cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+
+    def decode (self, raw):
+        if is_metadata_record(raw):
+            return decode_metadata(raw)
+        return cPickle.loads(str(raw))
+
+    def _flush_used (self):
+        if self._used:
+            self._db.executemany('UPDATE cache SET used = ? WHERE key = ?',
+                                 [ (tick, key) for key, tick in self._used.iteritems() ])
+            self._used.clear()
+            self._db.commit()
+
+    def get (self, key, default=None):
+        key = repr(key)
+        with self._lock:
+            row = self._db.execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return default
+            self._tick += 1
+            self._used[key] = self._tick
+            if len(self._used) >= self.USED_BATCH_SIZE:
+                self._flush_used()
+        return self.decode(row[0])
+
+    def put (self, key, value):
+        key = repr(key)
+        raw = sqlite3.Binary(self.encode(value))
+        with self._lock:
+            self._tick += 1
+            self._used.pop(key, None)
+            cursor = self._db.execute('UPDATE cache SET value = ?, used = ? WHERE key = ?',
+                                      (raw, self._tick, key))
+            if cursor.rowcount == 0:
+                self._db.execute('INSERT INTO cache (key, value, used) VALUES (?, ?, ?)',
+                                 (key, raw, self._tick))
+                self._count += 1
+            excess = self._count - self.maxsize
+            if excess > 0:
+                self._flush_used()
+                cursor = self._db.execute('DELETE FROM cache WHERE key IN '
+                                          '(SELECT key FROM cache ORDER BY used LIMIT ?)', (excess,))
+                self._count -= cursor.rowcount
+            self._db.commit()
+
+    def discard (self, key):
+        key = repr(key)
+        with self._lock:
+            self._used.pop(key, None)
+            cursor = self._db.execute('DELETE FROM cache WHERE key = ?', (key,))
+            self._count -= cursor.rowcount
+            self._db.commit()
+
+    def close (self):
+        with self._lock:
+            self._flush_used()
+            self._db.close()
+
+    def __len__ (self):
+        return self._count
+
+##############################################################################
+
+class MetadataCache (object):
+
+    def __init__ (self, backend=None, fingerprint_size=FINGERPRINT_SIZE, fingerprints=True):
+        if backend is None:
+            backend = MemoryBackend()
+        self.backend = backend
+        self.fingerprint_size = fingerprint_size
+        self.fingerprints = fingerprints
+        self._counts = { 'stat': [0, 0], 'fingerprint': [0, 0] }
+
+    def _get (self, tier, key):
+        value = self.backend.get(key)
+        self._counts[tier][value is None] += 1
+        return value
+
+    def lookup (self, filename, keys=None):
+        """
+        Returns the cached metadata for filename, None if there is none,
+        or NO_METADATA if the file is known to have none.
+        """
+        if keys is None:
+            keys = CacheKeys(filename, self.fingerprint_size)
+        value = self._get('stat', keys.stat)
+        if value is not None or not self.fingerprints:
+            return value
+
+        value = self._get('fingerprint', keys.fingerprint)
+        if value is not None:
+            self.backend.put(keys.stat, value)
+        return value
+
+    def store (self, filename, metadata, keys=None):
+        if keys is None:
+            keys = CacheKeys(filename, self.fingerprint_size)
+        self.backend.put(keys.stat, metadata)
+        if self.fingerprints:
+            self.backend.put(keys.fingerprint, metadata)
+
+    def get_or_read (self, filename, reader):
+        keys = CacheKeys(filename, self.fingerprint_size)
+        metadata = self.lookup(filename, keys)
+        if metadata is None:
+            metadata = reader(filename)
+            self.store(filename, NO_METADATA if metadata is None else metadata, keys)
+        elif metadata == NO_METADATA:
+            metadata = None
+        return metadata
+
+    def stats (self):
+        size = len(self.backend)
+        return Storage((tier, cache_stats(hits=hits, misses=misses, size=size,
+                                          maxsize=self.backend.maxsize))
+                       for tier, (hits, misses) in self._counts.iteritems())
+
+##############################################################################
+## THE END
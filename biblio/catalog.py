@@ -0,0 +1,229 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# CATALOG
+#
+# A queryable store for scan results, kept in a local SQLite database.
+#
+# Every book is one row of the books table, keyed by path, holding the
+# full EbookMetadata as a compact record (see biblio.serialize) plus the
+# columns needed to search it. Multi-valued fields (authors, identifiers
+# and languages) get their own tables. All searchable text is stored
+# normalized (case folded, accents and punctuation removed, whitespace
+# collapsed), and every search column is indexed, so lookups are index
+# probes regardless of catalog size.
+#
+# The title_sort and author_sort collation keys (see biblio.collation) are
+# stored as indexed BLOBs, so listing and paging the catalog in title or
+# author order is an index walk compared with memcmp().
+#
+# Loading is done in batches: each batch of books is written with a
+# handful of executemany() calls in a single transaction, with the
+# database in WAL mode.
+
+from __future__ import with_statement
+from collections import OrderedDict
+import sqlite3
+
+from biblio.collation import normalize_text, normalize_identifier, sort_key, \
+                             title_sort, authors_sort
+from biblio.serialize import encode_metadata, decode_metadata
+
+__all__ = [ 'Catalog', ]
+
+##############################################################################
+
+class CatalogException (Exception):
+    pass
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    id              INTEGER PRIMARY KEY,
+    path            TEXT NOT NULL UNIQUE,
+    filetype        TEXT,
+    title           TEXT,
+    series          TEXT,
+    series_index    REAL,
+    publisher       TEXT,
+    title_key       BLOB,
+    author_key      BLOB,
+    record          BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS books_title_key  ON books (title_key, path);
+CREATE INDEX IF NOT EXISTS books_author_key ON books (author_key, title_key, path);
+CREATE INDEX IF NOT EXISTS books_series    ON books (series, series_index);
+CREATE INDEX IF NOT EXISTS books_publisher ON books (publisher);
+CREATE INDEX IF NOT EXISTS books_title     ON books (title);
+
+CREATE TABLE IF NOT EXISTS authors (
+    book_id         INTEGER NOT NULL,
+    author          TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS authors_author ON authors (author);
+CREATE INDEX IF NOT EXISTS authors_book   ON authors (book_id);
+
+CREATE TABLE IF NOT EXISTS identifiers (
+    book_id         INTEGER NOT NULL,
+    scheme          TEXT NOT NULL,
+    value           TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS identifiers_value ON identifiers (scheme, value);
+CREATE INDEX IF NOT EXISTS identifiers_book  ON identifiers (book_id);
+
+CREATE TABLE IF NOT EXISTS languages (
+    book_id         INTEGER NOT NULL,
+    language        TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS languages_language ON languages (language);
+CREATE INDEX IF NOT EXISTS languages_book     ON languages (book_id);
+"""
+
+BOOK_ID = '(SELECT id FROM books WHERE path = ?)'
+
+##############################################################################
+
+class Catalog (object):
+
+    def __init__ (self, path, batch_size=1000):
+        self.path = path
+        self.batch_size = batch_size
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def close (self):
+        self.db.close()
+
+    # Loading ################################################################
+
+    def upsert (self, path, metadata):
+        self.upsert_many([ (path, metadata), ])
+
+    def upsert_many (self, items):
+        """
+        Writes the metadata of each (path, metadata) pair of items. A path
+        whose metadata is None (a file that is no longer a book, or no
+        longer reads) is removed from the catalog.
+        """
+        batch = []
+        for path, metadata in items:
+            batch.append((path, metadata))
+            if len(batch) >= self.batch_size:
+                self._write_batch(batch)
+                batch = []
+        if batch:
+            self._write_batch(batch)
+
+    load_scan = upsert_many
+
+    def _write_batch (self, batch):
+        books = []
+        authors = []
+        identifiers = []
+        languages = []
+        batch = OrderedDict(batch)
+        for path, metadata in batch.iteritems():
+            if metadata is None:
+                continue
+            filetype = metadata.filetype.type if metadata.filetype else None
+            title_key = sort_key(metadata.title_sort or title_sort(metadata.title, metadata.languages))
+            author_key = sort_key(metadata.author_sort or authors_sort(metadata.authors or ()))
+            books.append((path, filetype, normalize_text(metadata.title),
+                          normalize_text(metadata.series), metadata.series_index,
+                          normalize_text(metadata.publisher),
+                          sqlite3.Binary(title_key), sqlite3.Binary(author_key),
+                          sqlite3.Binary(encode_metadata(metadata))))
+            for author in metadata.authors or ():
+                authors.append((path, normalize_text(author)))
+            for scheme, value in (metadata.identifiers or {}).iteritems():
+                identifiers.append((path, scheme.lower(), normalize_identifier(value)))
+            for language in metadata.languages or ():
+                languages.append((path, language.lower()))
+
+        paths = [ (path,) for path in batch ]
+        with self.db:
+            self._delete_books(paths)
+            self.db.executemany('INSERT INTO books (path, filetype, title, series, series_index, '
+                                'publisher, title_key, author_key, record) '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', books)
+            self.db.executemany('INSERT INTO authors (book_id, author) VALUES (%s, ?)' % BOOK_ID,
+                                authors)
+            self.db.executemany('INSERT INTO identifiers (book_id, scheme, value) '
+                                'VALUES (%s, ?, ?)' % BOOK_ID, identifiers)
+            self.db.executemany('INSERT INTO languages (book_id, language) VALUES (%s, ?)' % BOOK_ID,
+                                languages)
+
+    def _delete_books (self, paths):
+        for table in ('authors', 'identifiers', 'languages'):
+            self.db.executemany('DELETE FROM %s WHERE book_id = %s' % (table, BOOK_ID), paths)
+        self.db.executemany('DELETE FROM books WHERE path = ?', paths)
+
+    def remove (self, path):
+        with self.db:
+            self._delete_books([ (path,), ])
+
+    # Queries ################################################################
+
+    def _books (self, sql, params=()):
+        return [ (path, decode_metadata(record))
+                 for path, record in self.db.execute(sql, params) ]
+
+    def get (self, path):
+        books = self._books('SELECT path, record FROM books WHERE path = ?', (path,))
+        if not books:
+            return None
+        return books[0][1]
+
+    def by_author (self, author):
+        return self._books('SELECT b.path, b.record FROM authors a JOIN books b ON b.id = a.book_id '
+                           'WHERE a.author = ? ORDER BY b.title', (normalize_text(author),))
+
+    def by_series (self, series):
+        return self._books('SELECT path, record FROM books WHERE series = ? '
+                           'ORDER BY series_index, title', (normalize_text(series),))
+
+    def by_identifier (self, scheme, value):
+        return self._books('SELECT b.path, b.record FROM identifiers i JOIN books b ON b.id = i.book_id '
+                           'WHERE i.scheme = ? AND i.value = ?',
+                           (scheme.lower(), normalize_identifier(value)))
+
+    def by_language (self, language):
+        return self._books('SELECT b.path, b.record FROM languages l JOIN books b ON b.id = l.book_id '
+                           'WHERE l.language = ? ORDER BY b.title', (language.lower(),))
+
+    def by_publisher (self, publisher):
+        return self._books('SELECT path, record FROM books WHERE publisher = ? ORDER BY title',
+                           (normalize_text(publisher),))
+
+    def by_title (self, title):
+        return self._books('SELECT path, record FROM books WHERE title = ?', (normalize_text(title),))
+
+    def list_by_title (self, offset=0, limit=100):
+        return self._books('SELECT path, record FROM books ORDER BY title_key, path '
+                           'LIMIT ? OFFSET ?', (limit, offset))
+
+    def list_by_author (self, offset=0, limit=100):
+        return self._books('SELECT path, record FROM books ORDER BY author_key, title_key, path '
+                           'LIMIT ? OFFSET ?', (limit, offset))
+
+    def __len__ (self):
+        return self.db.execute('SELECT COUNT(*) FROM books').fetchone()[0]
+
+##############################################################################
+## THE END
@@ -0,0 +1,142 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# COLLATION
+#
+# title_sort and author_sort are the human readable sort forms of a book's
+# title and authors ("Hobbit, The", "Tolkien, J. R. R."). They come from
+# the book itself when it has them (OPF file-as attributes, calibre meta
+# entries) and are derived here otherwise.
+#
+# sort_key() turns a sort form into a byte string that compares in the
+# intended order with a plain bytes comparison: accents and punctuation
+# are removed, case is folded and runs of digits are zero padded so that
+# "Book 2" sorts before "Book 10". Keys are memoized per distinct string,
+# since the same author names turn up over and over in a library.
+
+import re, unicodedata
+
+from biblio.util.lru import LRUCache
+
+__all__ = [ 'normalize_text', 'normalize_identifier', 'sort_key', 'title_sort',
+            'author_sort', 'authors_sort', 'fill_sort_fields', ]
+
+##############################################################################
+
+_PUNCTUATION = re.compile(r'[^\w\s]', re.UNICODE)
+_WHITESPACE  = re.compile(r'\s+', re.UNICODE)
+_DIGITS      = re.compile(r'\d+', re.UNICODE)
+_IDENTIFIER  = re.compile(r'[\s-]+')
+
+def normalize_text (text):
+    if text is None:
+        return None
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+    text = unicodedata.normalize('NFKD', text)
+    text = u''.join(c for c in text if not unicodedata.combining(c))
+    text = _PUNCTUATION.sub(u' ', text.lower())
+    return _WHITESPACE.sub(u' ', text).strip()
+
+def normalize_identifier (value):
+    # ISBNs and the like compare without their hyphens and spaces
+    return _IDENTIFIER.sub('', value).lower()
+
+SORT_KEY_CACHE_SIZE = 262144
+
+_sort_keys = LRUCache(SORT_KEY_CACHE_SIZE)
+
+def sort_key (text):
+    if text is None:
+        return ''
+    key = _sort_keys.get(text)
+    if key is None:
+        key = _DIGITS.sub(lambda m: m.group(0).zfill(12), normalize_text(text)).encode('utf-8')
+        _sort_keys.put(text, key)
+    return key
+
+##############################################################################
+
+ARTICLES = { 'en': (u'the', u'a', u'an'),
+             'de': (u'der', u'die', u'das', u'ein', u'eine'),
+             'es': (u'el', u'la', u'los', u'las', u'un', u'una'),
+             'fr': (u'le', u'la', u'les', u"l'", u'un', u'une'),
+             'it': (u'il', u'lo', u'la', u'i', u'gli', u'le', u"l'", u'un', u'una'),
+             'nl': (u'de', u'het', u'een'),
+           }
+
+def _article_pattern (articles):
+    alternatives = []
+    for article in articles:
+        if article.endswith(u"'"):
+            alternatives.append(re.escape(article[:-1]) + u"['\u2019]")
+        else:
+            alternatives.append(re.escape(article) + u'\\s+')
+    return re.compile(u'^(%s)(?=\\S)' % u'|'.join(alternatives), re.IGNORECASE | re.UNICODE)
+
+_ARTICLE_PATTERNS = dict((lang, _article_pattern(articles)) for lang, articles in ARTICLES.iteritems())
+
+def title_sort (title, languages=None):
+    if not title:
+        return title
+    title = title.strip()
+    langs = [ l.split('-')[0].lower() for l in (languages or ()) ] or [ 'en', ]
+    for lang in langs:
+        pattern = _ARTICLE_PATTERNS.get(lang)
+        if pattern is None:
+            continue
+        match = pattern.match(title)
+        if match:
+            article = match.group(1).strip()
+            return u'%s, %s' % (title[match.end():], article)
+    return title
+
+NAME_SUFFIXES = frozenset((u'jr', u'sr', u'ii', u'iii', u'iv', u'phd', u'md', u'esq'))
+
+def author_sort (author):
+    if not author:
+        return author
+    author = author.strip()
+    if u',' in author:
+        return author
+
+    parts = author.split()
+    if len(parts) < 2:
+        return author
+
+    suffixes = []
+    while len(parts) > 2 and parts[-1].rstrip(u'.').lower() in NAME_SUFFIXES:
+        suffixes.insert(0, parts.pop())
+
+    sorted_name = u'%s, %s' % (parts[-1], u' '.join(parts[:-1]))
+    if suffixes:
+        sorted_name += u', ' + u' '.join(suffixes)
+    return sorted_name
+
+def authors_sort (authors):
+    return u' & '.join(author_sort(a) for a in authors if a)
+
+##############################################################################
+
+def fill_sort_fields (ebook):
+    if ebook.title and not ebook.title_sort:
+        ebook.title_sort = title_sort(ebook.title, ebook.languages)
+    if ebook.authors and not ebook.author_sort:
+        ebook.author_sort = authors_sort(ebook.authors)
+    return ebook
+
+##############################################################################
+## THE END
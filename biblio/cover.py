@@ -0,0 +1,364 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# COVER IMAGES
+#
+# The cover of a book is found through the book's own structures, reading
+# nothing but the headers already parsed for its metadata:
+#
+#   MOBI   the image record given by EXTH 201 (cover offset), counted from
+#          first_image_record, or first_image_record itself when there is
+#          no EXTH 201. For thumbnails EXTH 202 (thumbnail offset) is
+#          preferred.
+#
+#   EPUB   the manifest item named by <meta name="cover" content="..."/>,
+#          else the item with the EPUB3 "cover-image" property, else the
+#          first image item whose id or href mentions "cover".
+#
+# locate_cover() returns where the image bytes are. A MOBI record, or a
+# ZIP member that is stored uncompressed, is one contiguous range of the
+# book file: open_cover() reads it through a bounded view of the file, and
+# callers that serve covers can hand the (offset, length) straight to
+# sendfile(). Deflated members are streamed out of the archive.
+#
+# CoverCache keeps the cover of every book looked at in a directory, one
+# file per book holding the raw image, so a UI can draw a grid of covers
+# without ever reparsing a book.
+
+from __future__ import with_statement
+from collections import namedtuple
+from zipfile     import ZipFile, BadZipfile, ZIP_STORED
+import hashlib, os, posixpath, struct, urllib
+
+from biblio.cache                 import CacheKeys
+from biblio.identifiers.filetypes import *
+from biblio.image                 import identify_image, probe_image_stream
+from biblio.parsers               import read_metadata
+from biblio.util.iopolicy         import open_header
+from biblio.util.rangefile        import RangeFile
+
+__all__ = [ 'cover_image', 'open_cover', 'locate_cover', 'probe_cover',
+            'CoverCache', 'cover', 'cover_location', ]
+
+##############################################################################
+
+cover = namedtuple('cover', 'filetype data')
+
+# Either offset and length (a contiguous range of the book file) or member
+# (a compressed ZIP member) are set
+cover_location = namedtuple('cover_location', 'offset length member')
+
+EXTH_COVER_OFFSET     = 201
+EXTH_THUMBNAIL_OFFSET = 202
+NO_IMAGE              = 0xffffffff
+
+ZIP_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
+##############################################################################
+
+def _exth_value (mobi, exth_type):
+    if 'exth' not in mobi:
+        return None
+    for record in mobi.exth.records:
+        if record.type == exth_type and len(record.data) == 4:
+            return struct.unpack('>L', record.data)[0]
+    return None
+
+def _locate_mobi_cover (metadata, thumbnail):
+    if 'mobi' not in metadata:
+        return None
+    mobi = metadata.mobi
+    first = mobi.get('first_image_record', NO_IMAGE)
+    if first == NO_IMAGE:
+        return None
+
+    offset = None
+    if thumbnail:
+        offset = _exth_value(mobi, EXTH_THUMBNAIL_OFFSET)
+    if offset is None or offset == NO_IMAGE:
+        offset = _exth_value(mobi, EXTH_COVER_OFFSET)
+    if offset == NO_IMAGE:
+        return None
+
+    n = first + (offset or 0)
+    if n >= len(metadata.pdb.records):
+        return None
+    record_offset, length = metadata.pdb.records[n]
+    return cover_location(record_offset, length, None)
+
+def _epub_cover_member (metadata):
+    opf = metadata.opf
+    images = []
+    by_id = {}
+    for tag, attribs, text in opf.get('manifest', ()):
+        if not tag.endswith('item') or 'href' not in attribs:
+            continue
+        if not attribs.get('media-type', '').startswith('image/'):
+            continue
+        images.append(attribs)
+        if 'id' in attribs:
+            by_id[attribs['id']] = attribs
+
+    item = None
+    for tag, attribs, text in opf.get('metadata', ()):
+        if tag.endswith('meta') and attribs.get('name') == 'cover':
+            item = by_id.get(attribs.get('content'))
+            if item is not None:
+                break
+    if item is None:
+        for attribs in images:
+            if 'cover-image' in attribs.get('properties', '').split():
+                item = attribs
+                break
+    if item is None:
+        for attribs in images:
+            if 'cover' in attribs.get('id', '').lower() or 'cover' in attribs['href'].lower():
+                item = attribs
+                break
+    if item is None:
+        return None
+
+    href = urllib.unquote(item['href'].split('#')[0])
+    return posixpath.normpath(posixpath.join(posixpath.dirname(metadata.get('opf_path', '')), href))
+
+def _locate_epub_cover (filename, metadata):
+    if 'opf' not in metadata:
+        return None
+    member = _epub_cover_member(metadata)
+    if member is None:
+        return None
+
+    with open_header(filename) as stream:
+        try:
+            info = ZipFile(stream).getinfo(member)
+        except (BadZipfile, KeyError):
+            return None
+        if info.compress_type != ZIP_STORED:
+            return cover_location(None, None, member)
+
+        stream.seek(info.header_offset)
+        header = stream.read(ZIP_LOCAL_HEADER.size)
+        if len(header) != ZIP_LOCAL_HEADER.size:
+            return None
+        fields = ZIP_LOCAL_HEADER.unpack(header)
+        if fields[0] != 'PK\x03\x04':
+            return None
+        offset = info.header_offset + ZIP_LOCAL_HEADER.size + fields[-2] + fields[-1]
+        return cover_location(offset, info.file_size, None)
+
+def locate_cover (filename, metadata=None, thumbnail=False):
+    if metadata is None:
+        metadata = read_metadata(filename)
+    if metadata is None:
+        return None
+    if metadata.filetype == MOBI:
+        return _locate_mobi_cover(metadata, thumbnail)
+    if metadata.filetype in (EPUB2, EPUB3):
+        return _locate_epub_cover(filename, metadata)
+    return None
+
+def open_cover (filename, metadata=None, thumbnail=False):
+    location = locate_cover(filename, metadata, thumbnail)
+    if location is None:
+        return None
+    if location.member is None:
+        return RangeFile(open(filename, 'rb'), location.offset, location.length, owned=True)
+
+    # Opened by name, the member stream gets its own file handle and
+    # closes it when it is closed
+    archive = ZipFile(filename)
+    try:
+        return archive.open(location.member)
+    finally:
+        archive.close()
+
+def probe_cover (filename, metadata=None, thumbnail=False):
+    stream = open_cover(filename, metadata, thumbnail)
+    if stream is None:
+        return None
+    try:
+        return probe_image_stream(stream)
+    finally:
+        stream.close()
+
+def _read_cover (filename, metadata, thumbnail):
+    stream = open_cover(filename, metadata, thumbnail)
+    if stream is None:
+        return None
+    try:
+        data = stream.read()
+    finally:
+        stream.close()
+    if not data:
+        return None
+    return cover(identify_image(data), data)
+
+def cover_image (filename, metadata=None, thumbnail=False, cache=None):
+    if cache is not None:
+        keys = CacheKeys(filename)
+        found, image = cache.lookup(filename, thumbnail, keys)
+        if found:
+            return image
+
+    image = _read_cover(filename, metadata, thumbnail)
+
+    if cache is not None:
+        cache.store(filename, image, thumbnail, keys)
+    return image
+
+##############################################################################
+
+# Cover cache
+#
+# Entries are keyed like the metadata cache (see biblio.cache): by the
+# book's stat key, with the fingerprint key as a fallback that finds books
+# that have been copied or moved. Each entry is a file named after its
+# tier and a hash of the key ("stat-<sha1>.jpg"), with an extension for
+# its image type; both keys of an entry are hardlinks to the same file.
+# Books without a cover get an empty ".none" entry so they are not looked
+# at again.
+#
+# Every time a book changes it gets a new stat key, and the entries of its
+# old keys are left behind. After a scan has looked up the covers of the
+# whole library, prune() removes the stat entries it did not touch, and
+# then the fingerprint entries no stat entry links to any more.
+
+CACHE_EXTENSIONS = { 'image/jpeg'    : '.jpg',
+                     'image/png'     : '.png',
+                     'image/gif'     : '.gif',
+                     'image/svg+xml' : '.svg',
+                   }
+UNKNOWN_EXTENSION = '.img'
+NO_COVER          = '.none'
+
+_ALL_EXTENSIONS = sorted(set(CACHE_EXTENSIONS.values())) + [ UNKNOWN_EXTENSION, NO_COVER ]
+
+class CoverCache (object):
+
+    def __init__ (self, directory, fingerprints=True):
+        self.directory = directory
+        self.fingerprints = fingerprints
+        self.hits = 0
+        self.misses = 0
+        self.touched = set()            # names of the stat entries used
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _base (self, key, thumbnail):
+        tier = key[0]
+        if thumbnail:
+            key = key + ('thumbnail',)
+        return os.path.join(self.directory, '%s-%s' % (tier, hashlib.sha1(repr(key)).hexdigest()))
+
+    def _find (self, base):
+        for ext in _ALL_EXTENSIONS:
+            if os.path.exists(base + ext):
+                return base + ext
+        return None
+
+    def path (self, filename, thumbnail=False, keys=None):
+        """
+        The cached cover file of a book: '' when the book is known to have
+        no cover, None when it is not in the cache.
+        """
+        if keys is None:
+            keys = CacheKeys(filename)
+        stat_base = self._base(keys.stat, thumbnail)
+        path = self._find(stat_base)
+        if path is None and self.fingerprints:
+            found = self._find(self._base(keys.fingerprint, thumbnail))
+            if found is not None:
+                path = stat_base + os.path.splitext(found)[1]
+                self._link(found, path)
+        if path is None:
+            return None
+        self.touched.add(os.path.basename(path))
+        if path.endswith(NO_COVER):
+            return ''
+        return path
+
+    def lookup (self, filename, thumbnail=False, keys=None):
+        path = self.path(filename, thumbnail, keys)
+        if path is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        if not path:
+            return True, None
+        with open(path, 'rb') as f:
+            data = f.read()
+        return True, cover(identify_image(data), data)
+
+    def store (self, filename, image, thumbnail=False, keys=None):
+        if keys is None:
+            keys = CacheKeys(filename)
+        if image is None:
+            ext, data = NO_COVER, ''
+        else:
+            mimetype = image.filetype.mimetype if image.filetype else None
+            ext, data = CACHE_EXTENSIONS.get(mimetype, UNKNOWN_EXTENSION), image.data
+
+        path = self._base(keys.stat, thumbnail) + ext
+        temp = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp, 'wb') as f:
+            f.write(data)
+        os.rename(temp, path)
+        self.touched.add(os.path.basename(path))
+
+        if self.fingerprints:
+            self._link(path, self._base(keys.fingerprint, thumbnail) + ext)
+        return path
+
+    def prune (self):
+        """
+        Removes the entries that have not been looked up or stored since
+        the cache was opened (or last pruned), and returns how many files
+        were removed. A fingerprint entry is kept as long as a remaining
+        stat entry is a link to it.
+        """
+        names = [ name for name in os.listdir(self.directory)
+                  if os.path.splitext(name)[1] in _ALL_EXTENSIONS ]
+        removed = 0
+        for tier in ('stat', 'fingerprint'):
+            for name in names:
+                if not name.startswith(tier + '-'):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    if tier == 'stat' and name in self.touched:
+                        continue
+                    if tier == 'fingerprint' and os.stat(path).st_nlink > 1:
+                        continue
+                    os.unlink(path)
+                    removed += 1
+                except OSError:
+                    continue
+        self.touched.clear()
+        return removed
+
+    def _link (self, source, target):
+        if os.path.exists(target):
+            return
+        try:
+            os.link(source, target)
+        except OSError:
+            with open(source, 'rb') as f:
+                data = f.read()
+            with open(target, 'wb') as f:
+                f.write(data)
+
+##############################################################################
+## THE END
@@ -0,0 +1,286 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# METADATA DAEMON
+#
+# Tools that call biblio once per file pay for interpreter startup, the
+# builtin pluggable initialization and the lxml/dateutil/chardet imports on
+# every call, which dwarfs the time spent actually parsing a book. The
+# daemon keeps a pool of worker processes with all of that already done,
+# and accepts batches of paths over a Unix domain socket.
+#
+# Wire protocol:
+#
+#   Every message is a frame: a 4 byte big-endian length followed by that
+#   many bytes of payload.
+#
+#   The client sends one frame holding the paths in the batch, as byte
+#   strings (utf-8 encoded if unicode) separated by NUL bytes. The daemon
+#   answers with one frame per path, in completion order. A zero-length
+#   frame ends the batch. A connection may send any number of batches.
+#
+#   Result frame:
+#
+#   Bytes Field                     Comments
+#   ----- ------------------------- ------------------------------------------
+#   4     Path length
+#   4     Error length              zero if the file was read successfully
+#   P     Path                      utf-8 encoded if the request path was unicode
+#   E     Error                     utf-8 encoded message describing why the
+#                                   file could not be read
+#   ?     Metadata                  compact EbookMetadata record (biblio.serialize),
+#                                   absent if the file is not an ebook
+#
+# Nothing received from the socket is ever unpickled or evaluated. The
+# socket is created with a umask that leaves it accessible to its owner
+# only, and an existing file at the socket path is only replaced if it is a
+# socket that nobody is listening on any more.
+
+from __future__ import with_statement
+import errno, multiprocessing, os, signal, socket, stat, struct, sys, SocketServer
+
+from biblio.serialize import encode_metadata, decode_metadata
+
+__all__ = [ 'MetadataDaemon', 'MetadataClient', 'serve', ]
+
+##############################################################################
+
+class DaemonException (Exception):
+    pass
+
+FRAME_HEADER = '>L'
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER)
+
+def send_frame (sock, payload):
+    sock.sendall(struct.pack(FRAME_HEADER, len(payload)) + payload)
+
+def recv_frame (sock):
+    header = _recv_exactly(sock, FRAME_HEADER_SIZE)
+    if header is None:
+        return None
+    length, = struct.unpack(FRAME_HEADER, header)
+    if length == 0:
+        return ''
+    payload = _recv_exactly(sock, length)
+    if payload is None:
+        raise DaemonException('connection closed in the middle of a frame')
+    return payload
+
+def _recv_exactly (sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1024 * 1024))
+        if not chunk:
+            if chunks:
+                raise DaemonException('connection closed in the middle of a frame')
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+PATH_SEPARATOR = '\0'
+
+def encode_paths (paths):
+    encoded = []
+    for path in paths:
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        if PATH_SEPARATOR in path:
+            raise DaemonException('path contains a NUL byte: %r' % path)
+        encoded.append(path)
+    return PATH_SEPARATOR.join(encoded)
+
+def decode_paths (payload):
+    if not payload:
+        return []
+    return payload.split(PATH_SEPARATOR)
+
+RESULT_HEADER = '>LL'
+RESULT_HEADER_SIZE = struct.calcsize(RESULT_HEADER)
+
+def encode_result (result):
+    path, metadata, error = result
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    if isinstance(error, unicode):
+        error = error.encode('utf-8', 'replace')
+    error = error or ''
+    payload = struct.pack(RESULT_HEADER, len(path), len(error)) + path + error
+    if metadata is not None:
+        payload += encode_metadata(metadata)
+    return payload
+
+def decode_result (payload):
+    path_length, error_length = struct.unpack_from(RESULT_HEADER, payload)
+    pos = RESULT_HEADER_SIZE
+    path = payload[pos:pos+path_length]
+    pos += path_length
+    error = payload[pos:pos+error_length].decode('utf-8', 'replace') or None
+    pos += error_length
+    metadata = None
+    if pos < len(payload):
+        metadata = decode_metadata(payload, pos)
+    return path, metadata, error
+
+##############################################################################
+
+# Worker processes
+
+def _initialize_worker ():
+    # Pay for all of the expensive imports up front, so the first book each
+    # worker sees costs no more than the last.
+    import biblio.plugs, biblio.ebook
+    import lxml.etree, dateutil.parser
+    try:
+        import chardet
+    except ImportError:
+        pass
+
+def _error_message (e):
+    # Exception messages may be unicode or byte strings, in any encoding
+    try:
+        message = unicode(e)
+    except UnicodeError:
+        message = str(e).decode('utf-8', 'replace')
+    return u'%s: %s' % (e.__class__.__name__, message)
+
+def _read_ebook_metadata (args):
+    path, hint = args
+    from biblio.ebook import ebook_metadata
+    try:
+        return encode_result((path, ebook_metadata(path, hint=hint), None))
+    except Exception, e:
+        return encode_result((path, None, _error_message(e)))
+
+##############################################################################
+
+class _MetadataRequestHandler (SocketServer.BaseRequestHandler):
+
+    def handle (self):
+        while True:
+            request = recv_frame(self.request)
+            if request is None:
+                return
+            self.server.process_batch(self.request, decode_paths(request))
+
+class MetadataDaemon (SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__ (self, socket_path, workers=None, hint=False):
+        _remove_stale_socket(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, _MetadataRequestHandler)
+        self.socket_path = socket_path
+        self.hint = hint
+        self.pool = multiprocessing.Pool(workers, initializer=_initialize_worker)
+
+    def server_bind (self):
+        umask = os.umask(0177)
+        try:
+            SocketServer.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+
+    def process_batch (self, sock, paths):
+        jobs = [ (path, self.hint) for path in paths ]
+        for payload in self.pool.imap_unordered(_read_ebook_metadata, jobs):
+            send_frame(sock, payload)
+        send_frame(sock, '')
+
+    def server_close (self):
+        SocketServer.UnixStreamServer.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+def _remove_stale_socket (socket_path):
+    try:
+        st = os.lstat(socket_path)
+    except OSError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise DaemonException('%s exists and is not a socket' % socket_path)
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except socket.error, e:
+        if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+            raise
+    else:
+        raise DaemonException('a daemon is already listening on %s' % socket_path)
+    finally:
+        probe.close()
+    os.unlink(socket_path)
+
+def serve (socket_path, workers=None, hint=False):
+    daemon = MetadataDaemon(socket_path, workers=workers, hint=hint)
+    try:
+        daemon.serve_forever()
+    finally:
+        daemon.server_close()
+
+##############################################################################
+
+class MetadataClient (object):
+
+    def __init__ (self, socket_path):
+        self.socket_path = socket_path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+
+    def ebook_metadata (self, paths):
+        paths = list(paths)
+        payload = encode_paths(paths)
+        originals = dict(zip(decode_paths(payload), paths))
+        send_frame(self.sock, payload)
+        while True:
+            payload = recv_frame(self.sock)
+            if payload is None:
+                raise DaemonException('daemon closed the connection')
+            if payload == '':
+                return
+            path, metadata, error = decode_result(payload)
+            yield originals.get(path, path), metadata, error
+
+    def close (self):
+        self.sock.close()
+
+##############################################################################
+
+def main (argv=None):
+    from optparse import OptionParser
+    op = OptionParser(usage='%prog [options] SOCKET')
+    op.add_option('-j', '--workers', type='int', default=None,
+                  help='number of worker processes (default: one per cpu)')
+    op.add_option('--hint', action='store_true', default=False,
+                  help='use file extensions as identification hints')
+    options, args = op.parse_args(argv)
+    if len(args) != 1:
+        op.error('a socket path is required')
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        serve(args[0], workers=options.workers, hint=options.hint)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
+
+##############################################################################
+## THE END
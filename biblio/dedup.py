@@ -0,0 +1,194 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# NEAR-DUPLICATE DETECTION
+#
+# The same book is commonly held in several formats (EPUB, MOBI and a few
+# PDB variants), usually with slightly different titles. Comparing every
+# pair of books is quadratic, so instead:
+#
+#   1. Each book is reduced to a set of shingles: character trigrams of its
+#      normalized title plus the normalized words of its authors' names.
+#
+#   2. The shingle set is summarized by a MinHash signature of SIGNATURE_SIZE
+#      values. The fraction of positions at which two signatures agree is
+#      an estimate of the Jaccard similarity of the two shingle sets. The
+#      SIGNATURE_SIZE independent 32-bit hash values of a shingle are cut
+#      out of salted SHA-512 digests, and the per-position minimums are
+#      taken with map(min, zip(...)), keeping the inner loops out of Python.
+#      Title trigrams and author names repeat constantly across a library,
+#      so the hash values of each shingle are memoized by the index.
+#
+#   3. The signature is cut into BANDS bands, and each band is hashed into a
+#      bucket (locality sensitive hashing). Books sharing any bucket are
+#      candidates, and a candidate becomes a duplicate when its estimated
+#      similarity reaches the threshold.
+#
+# Books that share an exact identifier (an ISBN from EXTH 104, an OPF
+# dc:identifier, ...) are duplicates without further checking, and no
+# signature is computed for them.
+#
+# Duplicates are merged with a union-find structure, so books can be added
+# one at a time as they are scanned and the groups are always current.
+
+import hashlib, struct
+
+from biblio.collation import normalize_identifier, normalize_text
+
+__all__ = [ 'DuplicateIndex', 'book_shingles', 'minhash_signature', ]
+
+##############################################################################
+
+SIGNATURE_SIZE = 64
+BANDS          = 16
+THRESHOLD      = 0.5
+
+HASHES_PER_DIGEST = 16      # 32-bit values per SHA-512 digest
+
+##############################################################################
+
+def book_shingles (metadata, size=3):
+    shingles = set()
+    title = normalize_text(metadata.title) or u''
+    title = u' %s ' % title
+    for n in xrange(len(title) - size + 1):
+        shingles.add(u't:' + title[n:n+size])
+    for author in metadata.authors or ():
+        for word in (normalize_text(author) or u'').split():
+            shingles.add(u'a:' + word)
+    return shingles
+
+SHINGLE_CACHE_SIZE = 262144
+
+def minhash_signature (shingles, size=SIGNATURE_SIZE, cache=None):
+    if not shingles:
+        return None
+    if cache is None:
+        cache = {}
+    sha512 = hashlib.sha512
+    salts = [ chr(n) for n in xrange(size / HASHES_PER_DIGEST) ]
+    layout = '>%dL' % size
+    rows = []
+    for shingle in shingles:
+        row = cache.get(shingle)
+        if row is None:
+            raw = shingle.encode('utf-8')
+            row = struct.unpack(layout, ''.join(sha512(salt + raw).digest() for salt in salts))
+            if len(cache) >= SHINGLE_CACHE_SIZE:
+                cache.clear()
+            cache[shingle] = row
+        rows.append(row)
+    return tuple(map(min, zip(*rows)))
+
+def estimated_similarity (sig1, sig2):
+    return sum(1 for x, y in zip(sig1, sig2) if x == y) / float(len(sig1))
+
+##############################################################################
+
+class DuplicateIndex (object):
+
+    def __init__ (self, threshold=THRESHOLD, bands=BANDS, signature_size=SIGNATURE_SIZE):
+        if signature_size % bands or signature_size % HASHES_PER_DIGEST:
+            raise ValueError('signature size must be a multiple of the number of bands and of %d'
+                             % HASHES_PER_DIGEST)
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = signature_size / bands
+        self.signature_size = signature_size
+        self._shingle_hashes = {}
+        self.signatures = {}
+        self.buckets = {}
+        self.identifiers = {}
+        self._parent = {}
+
+    # union-find #############################################################
+
+    def _find (self, key):
+        parent = self._parent
+        root = key
+        while parent[root] != root:
+            root = parent[root]
+        while parent[key] != root:
+            parent[key], key = root, parent[key]
+        return root
+
+    def _union (self, key1, key2):
+        root1, root2 = self._find(key1), self._find(key2)
+        if root1 != root2:
+            self._parent[root2] = root1
+
+    ##########################################################################
+
+    def _band_keys (self, signature):
+        rows = self.rows
+        for band in xrange(self.bands):
+            yield band, struct.pack('>%dL' % rows, *signature[band*rows:(band+1)*rows])
+
+    def add (self, key, metadata):
+        if key in self._parent:
+            raise KeyError('%r is already in the index' % (key,))
+        self._parent[key] = key
+
+        matched = False
+        for scheme, value in (metadata.identifiers or {}).iteritems():
+            if not value:
+                continue
+            ident = (scheme.lower(), normalize_identifier(value))
+            other = self.identifiers.setdefault(ident, key)
+            if other != key:
+                self._union(other, key)
+                matched = True
+        if matched:
+            return
+
+        signature = minhash_signature(book_shingles(metadata), self.signature_size,
+                                      self._shingle_hashes)
+        if signature is None:
+            return
+        self.signatures[key] = signature
+
+        candidates = set()
+        for band_key in self._band_keys(signature):
+            bucket = self.buckets.setdefault(band_key, [])
+            candidates.update(bucket)
+            bucket.append(key)
+
+        for other in candidates:
+            if self._find(other) == self._find(key):
+                continue
+            if estimated_similarity(signature, self.signatures[other]) >= self.threshold:
+                self._union(other, key)
+
+    def add_many (self, items):
+        for key, metadata in items:
+            if metadata is not None:
+                self.add(key, metadata)
+
+    def group_of (self, key):
+        root = self._find(key)
+        return [ k for k in self._parent if self._find(k) == root ]
+
+    def groups (self):
+        groups = {}
+        for key in self._parent:
+            groups.setdefault(self._find(key), []).append(key)
+        return [ g for g in groups.itervalues() if len(g) > 1 ]
+
+    def __len__ (self):
+        return len(self._parent)
+
+##############################################################################
+## THE END
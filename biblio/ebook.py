@@ -14,22 +14,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from __future__ import with_statement
 from datetime import datetime
 from dateutil.tz import tzlocal, tzutc
 import re
 
 from biblio.identifiers import identify_file
-from biblio.identifiers.filetypes import is_ebook
+from biblio.identifiers.filetypes import is_ebook, PDF, HTML, XHTML
 from biblio.parsers  import read_processed_metadata
+from biblio.util.iopolicy import io_session
 
 ##############################################################################
 
-def ebook_metadata (filename):
-    filetype = identify_file(filename)
-    if not is_ebook(filetype):
-        return None
+# Document types that libraries hold books in, and that are read as ebooks
+EBOOK_DOCUMENT_TYPES = (PDF, HTML, XHTML)
 
-    return read_processed_metadata(filename, filetype=filetype)
+def ebook_metadata (filename, hint=False, cache=None):
+    if cache is not None:
+        return cache.get_or_read(filename, lambda f: ebook_metadata(f, hint=hint))
+
+    with io_session(filename):
+        filetype = identify_file(filename, hint=hint)
+        if filetype is None or not (is_ebook(filetype) or filetype in EBOOK_DOCUMENT_TYPES):
+            return None
+
+        return read_processed_metadata(filename, filetype=filetype)
 
 ##############################################################################
 
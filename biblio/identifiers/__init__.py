@@ -15,15 +15,20 @@
 # limitations under the License.
 
 from __future__ import with_statement
-from contextlib  import closing
 from collections import namedtuple
-import functools, re, struct
+from contextlib  import closing
+import functools, os, re, struct, threading, zipfile, zlib
 
 from biblio.identifiers           import text
 from biblio.identifiers.filetypes import *
 from biblio.plugs                 import iterate_pluggables, IDENTIFIERS
+from biblio.util.iopolicy         import get_io_policy, open_header
+from biblio.util.lru              import LRUCache
+from biblio.util.rawzip           import ZipEditException, read_central_directory, read_member
 
-__all__ = [ 'identifier', 'identify_stream', 'identify_file', 'IdentifierBuilder', ]
+__all__ = [ 'identifier', 'identify_stream', 'identify_file', 'IdentifierBuilder',
+            'extension_hints', 'EXTENSION_HINTS',
+            'identify_cache_stats', 'clear_identify_cache', 'set_identify_cache_size', ]
 
 ##############################################################################
 
@@ -66,8 +71,15 @@ def _calc_identifier_sizes (identifier):
 
 ##############################################################################
 
-def identify_stream (stream):
-    data = stream.read(8192)
+def identify_stream (stream, hints=None):
+    _checks.memo = {}
+    try:
+        return _identify_stream(stream, hints)
+    finally:
+        _checks.memo = None
+
+def _identify_stream (stream, hints):
+    data = stream.read(get_io_policy().identify_size)
     current_pos = 0
 
     def test_identifier_rules (ident):
@@ -122,17 +134,101 @@ def identify_stream (stream):
 
     textfile = text.is_text(data)
 
-    for filetype,identifier in iterate_pluggables(IDENTIFIERS):
-        if textfile == True and identifier.text == False: continue
-        if textfile == False and identifier.binary == False: continue
+    def candidates (only=None):
+        for filetype,identifier in iterate_pluggables(IDENTIFIERS):
+            if only is not None and filetype not in only: continue
+            if textfile == True and identifier.text == False: continue
+            if textfile == False and identifier.binary == False: continue
+            yield filetype,identifier
+
+    if hints:
+        for filetype,identifier in candidates(hints):
+            if test_identifier_rules(identifier):
+                return filetype
+
+    for filetype,identifier in candidates():
+        if hints and filetype in hints: continue
         if test_identifier_rules(identifier):
             return filetype
 
     return None
 
-def identify_file (filename):
-    with closing(open(filename, 'rb')) as stream:
-        return identify_stream(stream)
+def identify_file (filename, hint=False):
+    key = _identify_cache_key(filename)
+    if key is not None:
+        filetype = _identify_cache.get(key, _not_cached)
+        if filetype is not _not_cached:
+            return filetype
+
+    hints = None
+    if hint:
+        hints = extension_hints(filename if isinstance(filename, basestring) else getattr(filename, 'name', ''))
+    with open_header(filename) as stream:
+        filetype = identify_stream(stream, hints)
+
+    if key is not None:
+        _identify_cache.put(key, filetype)
+    return filetype
+
+##############################################################################
+
+# Identification cache
+#
+# The same physical file is commonly identified several times in a row:
+# ebook_metadata() and the parser entry points each call identify_file(),
+# write_metadata() identifies again before writing, and hardlinked copies
+# of a book are the same inode under different names. Results are kept in
+# a bounded LRU keyed on the file's device, inode, size and modification
+# time, so each inode is sniffed at most once for as long as it is
+# unchanged.
+
+IDENTIFY_CACHE_SIZE = 65536
+
+_identify_cache = LRUCache(IDENTIFY_CACHE_SIZE)
+_not_cached = object()
+
+def _identify_cache_key (filename):
+    if _identify_cache.maxsize <= 0 or not isinstance(filename, basestring):
+        return None
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+def identify_cache_stats ():
+    return _identify_cache.stats()
+
+def clear_identify_cache ():
+    _identify_cache.clear()
+
+def set_identify_cache_size (maxsize):
+    _identify_cache.resize(maxsize)
+
+##############################################################################
+
+# Extension hints
+#
+# A well-named library is almost entirely made of files whose extension
+# already tells us what they are. In hint mode the identifiers for the
+# filetypes expected for an extension are tried first, and the full search
+# is only run (skipping those already tried) when none of them match.
+#
+# The magic numbers of the hinted filetypes are mutually exclusive with
+# every builtin identifier that is registered before them, so a hinted
+# match is always the same answer the full search would have given.
+
+EXTENSION_HINTS = { '.epub' : frozenset((EPUB3, EPUB2)),
+                    '.mobi' : frozenset((MOBI,)),
+                    '.azw'  : frozenset((MOBI,)),
+                    '.azw3' : frozenset((MOBI,)),
+                    '.prc'  : frozenset((MOBI, PDB_PALMDOC)),
+                    '.pdb'  : frozenset((PDB_PALMDOC, PDB_EREADER, PDB_GUTENPALM, PDB_PLUCKER, MOBI)),
+                    '.opf'  : frozenset((OPF2,)),
+                  }
+
+def extension_hints (filename):
+    return EXTENSION_HINTS.get(os.path.splitext(filename)[1].lower())
 
 ##############################################################################
 
@@ -202,6 +298,105 @@ class IdentifierBuilder (object):
 
 ##############################################################################
 
+# EPUB versions
+#
+# EPUB2 and EPUB3 books have the same OCF container, and only differ in
+# the version attribute of the OPF <package> element. The EPUB3 identifier
+# follows META-INF/container.xml to the package document and reads just
+# the first EPUB_PACKAGE_HEAD bytes of it (and at most EPUB_CONTAINER_MAX
+# bytes of the container); books it rejects, or whose members cannot be
+# inflated, fall through to the EPUB2 identifier.
+
+EPUB_CONTAINER     = 'META-INF/container.xml'
+EPUB_CONTAINER_MAX = 64 * 1024
+EPUB_PACKAGE_HEAD  = 4096
+EPUB_PACKAGE_TYPE  = 'application/oebps-package+xml'
+
+ROOTFILE_PATTERN  = re.compile(r'<(?:\w+:)?rootfile\b[^>]*>')
+FULL_PATH_PATTERN = re.compile(r'\sfull-path\s*=\s*["\']([^"\']+)')
+PACKAGE_PATTERN   = re.compile(r'<(?:\w+:)?package\b[^>]*?\sversion\s*=\s*["\']\s*([\d.]+)')
+
+# Func rules of several identifiers can ask the same question of a stream
+# (is it a zipped EPUB, which package version does it hold). The answers
+# are kept for the rest of the identify_stream() call that asked.
+
+_checks = threading.local()
+
+def _memoized (check):
+    @functools.wraps(check)
+    def memoized (stream):
+        memo = getattr(_checks, 'memo', None)
+        if memo is None:
+            return check(stream)
+        key = (check.__name__, id(stream))
+        if key not in memo:
+            memo[key] = check(stream)
+        return memo[key]
+    return memoized
+
+@_memoized
+def _epub_package_version (stream):
+    try:
+        stream.seek(0)
+        archive = zipfile.ZipFile(stream)
+        with closing(archive.open(EPUB_CONTAINER)) as member:
+            rootfiles = ROOTFILE_PATTERN.findall(member.read(EPUB_CONTAINER_MAX))
+        rootfiles.sort(key=lambda r: EPUB_PACKAGE_TYPE not in r)
+        for rootfile in rootfiles:
+            m = FULL_PATH_PATTERN.search(rootfile)
+            if m is not None:
+                break
+        else:
+            return None
+        with closing(archive.open(m.group(1))) as member:
+            head = member.read(EPUB_PACKAGE_HEAD)
+    except (zipfile.BadZipfile, KeyError, EnvironmentError, RuntimeError, ValueError,
+            NotImplementedError, zlib.error):
+        return None
+    m = PACKAGE_PATTERN.search(head)
+    return m.group(1) if m is not None else None
+
+def _is_epub3 (stream, data):
+    version = _epub_package_version(stream)
+    return version is not None and version.startswith('3')
+
+# Misordered EPUBs
+#
+# The OCF magic above needs the "mimetype" member to be the very first
+# local header, stored, with no extra field. Archives re-zipped by general
+# purpose tools often break that and would only be identified as ZIP files.
+# The fallback identifiers read the central directory instead (only the
+# end record and the directory itself), and accept archives that hold
+# META-INF/container.xml and a "mimetype" member reading
+# "application/epub+zip", wherever it is and however it is compressed. No
+# other member is read (beyond the package document, for EPUB3).
+
+EPUB_MIMETYPE = 'application/epub+zip'
+
+def _is_conforming_epub (data):
+    return data[26:58] == '\x08\0\0\0mimetypeapplication/epub+zip'
+
+@_memoized
+def _is_zipped_epub (stream):
+    try:
+        stream.seek(0)
+        entries, end = read_central_directory(stream)
+        by_name = dict((entry.name, entry) for entry in entries)
+        if EPUB_CONTAINER not in by_name or 'mimetype' not in by_name:
+            return False
+        mimetype = read_member(stream, by_name['mimetype'], len(EPUB_MIMETYPE) + 64)
+    except (ZipEditException, EnvironmentError, struct.error):
+        return False
+    return mimetype.strip() == EPUB_MIMETYPE
+
+def _is_misordered_epub3 (stream, data):
+    return not _is_conforming_epub(data) and _is_zipped_epub(stream) and _is_epub3(stream, data)
+
+def _is_misordered_epub (stream, data):
+    return not _is_conforming_epub(data) and _is_zipped_epub(stream)
+
+##############################################################################
+
 def initialize_builtin_pluggables (plug_adder_method):
 
     # some aliases and shortcuts
@@ -212,7 +407,10 @@ def initialize_builtin_pluggables (plug_adder_method):
     # EBOOKS #################################################################
 
     ## EPUB
+    add(EPUB3, ib().string(0,'PK\003\004').string(26,'\x08\0\0\0mimetypeapplication/').string(50,'epub+zip').func(0,_is_epub3).build())
+    add(EPUB3, ib().string(0,'PK\003\004').func(0,_is_misordered_epub3).build())
     add(EPUB2, ib().string(0,'PK\003\004').string(26,'\x08\0\0\0mimetypeapplication/').string(50,'epub+zip').build())
+    add(EPUB2, ib().string(0,'PK\003\004').func(0,_is_misordered_epub).build())
 
     ## PALM
     add(MOBI         , ib().string(60,'BOOKMOBI').build())
@@ -268,6 +466,9 @@ def initialize_builtin_pluggables (plug_adder_method):
     ## PDF documents
     add(PDF, ib().string(0,'%PDF-').build())
 
+    ## Archives
+    add(TAR, ib().string(257,'ustar').build())
+
     ## Generic Zip files
     add(ZIP09, ib().string(0,'PK\003\004').struct(4,'>b',0x09).build())
     add(ZIP10, ib().string(0,'PK\003\004').struct(4,'>b',0x0a).build())
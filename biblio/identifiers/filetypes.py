@@ -107,6 +107,13 @@ ZIP11 = filetype('zip.11', 'application/zip', 'ZIP file, version 1.1')
 ZIP20 = filetype('zip.20', 'application/zip', 'ZIP file, version 2.0')
 ZIP30 = filetype('zip.30', 'application/zip', 'ZIP file, version 3.0')
 
+# Other archive types
+
+TAR   = filetype('archive.tar', 'application/x-tar', 'TAR archive')
+
+def is_archive (ftype):
+    return ftype.type.startswith('zip.') or ftype.type.startswith('archive.')
+
 # XML types
 
 OPF2  = filetype('xml.opf.2', 'application/oebps-package+xml', 'Open packaging format xml, version 2')
@@ -0,0 +1,180 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# IMAGE PROBING
+#
+# The type and dimensions of an image, read from its header alone:
+#
+#   PNG    the IHDR chunk, which must come first: width and height are the
+#          big-endian longs at offsets 16 and 20
+#   GIF    the logical screen descriptor: little-endian shorts at offsets
+#          6 and 8
+#   JPEG   the first SOFn (start of frame) segment. Segments are walked by
+#          their length fields, skipping over the payload of everything
+#          else (EXIF data, thumbnails, tables), and the walk gives up after
+#          JPEG_PROBE_LIMIT bytes or JPEG_PROBE_SEGMENTS segments
+#
+# The probes work on any stream, so they serve equally for image files, the
+# members of an EPUB and the image records of a MOBI book (see
+# biblio.cover.open_cover()).
+
+from __future__ import with_statement
+from collections import namedtuple
+from cStringIO   import StringIO
+import struct
+
+from biblio.identifiers           import identify_stream
+from biblio.identifiers.filetypes import *
+from biblio.util.iopolicy         import open_header
+
+__all__ = [ 'image_info', 'identify_image', 'probe_image', 'probe_image_stream',
+            'probe_image_data', ]
+
+##############################################################################
+
+image_info = namedtuple('image_info', 'filetype width height')
+
+IMAGE_TYPES = (JPEG_JFIF, JPEG_EXIF, PNG, GIF89A, GIF87A)
+
+HEADER_SIZE = 32
+
+JPEG_PROBE_LIMIT    = 1024 * 1024
+JPEG_PROBE_SEGMENTS = 256
+
+# SOF0-SOF15, less DHT (c4), JPG (c8) and DAC (cc)
+JPEG_SOF_MARKERS = frozenset(range(0xc0, 0xd0)) - frozenset((0xc4, 0xc8, 0xcc))
+
+# Markers without a length field
+JPEG_STANDALONE_MARKERS = frozenset(range(0xd0, 0xda) + [ 0x01, ])
+
+##############################################################################
+
+def identify_image (data):
+    filetype = identify_stream(StringIO(data), hints=IMAGE_TYPES)
+    if filetype is None or not is_image(filetype):
+        return None
+    return filetype
+
+##############################################################################
+
+class _PrefixedStream (object):
+    """
+    A forward-only stream that returns prefix before the rest of stream,
+    for streams that cannot seek back over bytes already read.
+    """
+
+    def __init__ (self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read (self, size):
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        if len(data) < size:
+            data += self.stream.read(size - len(data))
+        return data
+
+def _skip (stream, count):
+    try:
+        stream.seek(count, 1)
+        return True
+    except (AttributeError, IOError):
+        pass
+    while count > 0:
+        data = stream.read(min(count, 65536))
+        if not data:
+            return False
+        count -= len(data)
+    return True
+
+def _probe_jpeg (stream, pos):
+    for n in xrange(JPEG_PROBE_SEGMENTS):
+        if pos > JPEG_PROBE_LIMIT:
+            return None
+
+        byte = stream.read(1)
+        if byte != '\xff':
+            return None
+        marker = stream.read(1)
+        pos += 2
+        while marker == '\xff':             # fill bytes
+            marker = stream.read(1)
+            pos += 1
+        if not marker:
+            return None
+        marker = ord(marker)
+
+        if marker in JPEG_STANDALONE_MARKERS:
+            if marker == 0xd9:              # EOI
+                return None
+            continue
+
+        raw = stream.read(2)
+        if len(raw) != 2:
+            return None
+        length, = struct.unpack('>H', raw)
+        if length < 2:
+            return None
+        pos += length
+
+        if marker in JPEG_SOF_MARKERS:
+            raw = stream.read(5)
+            if len(raw) != 5:
+                return None
+            precision, height, width = struct.unpack('>BHH', raw)
+            return width, height
+
+        if marker == 0xda:                  # SOS: image data follows
+            return None
+        if not _skip(stream, length - 2):
+            return None
+    return None
+
+def probe_image_stream (stream):
+    head = stream.read(HEADER_SIZE)
+    filetype = identify_image(head)
+
+    if head.startswith('\x89PNG\r\n\x1a\n'):
+        if len(head) < 24 or head[12:16] != 'IHDR':
+            return None
+        width, height = struct.unpack('>LL', head[16:24])
+    elif head.startswith('GIF8'):
+        if len(head) < 10:
+            return None
+        width, height = struct.unpack('<HH', head[6:10])
+    elif head.startswith('\xff\xd8'):
+        # Walk the segments from the end of the SOI marker
+        try:
+            stream.seek(2 - len(head), 1)
+        except (AttributeError, IOError):
+            stream = _PrefixedStream(head[2:], stream)
+        size = _probe_jpeg(stream, 2)
+        if size is None:
+            return None
+        width, height = size
+    else:
+        return None
+
+    return image_info(filetype, width, height)
+
+def probe_image_data (data):
+    return probe_image_stream(StringIO(data))
+
+def probe_image (filename):
+    with open_header(filename) as stream:
+        return probe_image_stream(stream)
+
+##############################################################################
+## THE END
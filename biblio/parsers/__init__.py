@@ -14,10 +14,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from collections import namedtuple
+from __future__ import with_statement
+from collections      import namedtuple
+from multiprocessing.pool import ThreadPool
+import errno, inspect, json, os, shutil
 
-from biblio.identifiers import identify_file
-from biblio.plugs       import find_pluggable, PARSERS
+from biblio.collation     import fill_sort_fields
+from biblio.identifiers   import identify_file
+from biblio.metadata      import EbookMetadata
+from biblio.plugs         import find_pluggable, PARSERS
+from biblio.util.iopolicy import io_session, deferred_sync, sync_file, sync_path
 
 ##############################################################################
 
@@ -26,7 +32,15 @@ class ParserException (Exception):
 
 parser = namedtuple('parser', 'filetype reader writer processor')
 
-ALL_PARSERS = [ 'epub','mobi','pdb','opf' ]
+ALL_PARSERS = [ 'epub','mobi','pdb','opf','pdf','html' ]
+
+# How a writer put the new metadata into the file. Writers return one of
+# these, and write_metadata() passes it on. A writer called with a target
+# path writes the updated book there and leaves the original alone; that
+# is always reported as WRITE_REWRITE.
+WRITE_IN_PLACE = 'in-place'     # patched inside the existing file
+WRITE_REWRITE  = 'rewrite'      # copied to a temporary file, renamed over the original
+WRITE_APPEND   = 'append'       # new data appended, and the old data left unreferenced
 
 ##############################################################################
 
@@ -34,21 +48,27 @@ def find_parser (filetype):
     return find_pluggable(PARSERS, filetype)
 
 def read_metadata (filename):
-    filetype = identify_file(filename)
-    if filetype is None:
-        return None
+    with io_session(filename):
+        filetype = identify_file(filename)
+        if filetype is None:
+            return None
 
-    parser = find_parser(filetype)
-    return parser.reader(filename)
+        parser = find_parser(filetype)
+        return parser.reader(filename)
 
 def read_processed_metadata (filename, filetype=None):
-    if filetype is None:
-        filetype = identify_file(filename)
-    if filetype is None:
-        return None
+    with io_session(filename):
+        if filetype is None:
+            filetype = identify_file(filename)
+        if filetype is None:
+            return None
 
-    parser = find_parser(filetype)
-    return parser.processor(parser.reader(filename))
+        parser = find_parser(filetype)
+        ebook = parser.processor(parser.reader(filename))
+
+    if isinstance(ebook, EbookMetadata):
+        fill_sort_fields(ebook)
+    return ebook
 
 def write_metadata (filename, metadata):
     filetype = identify_file(filename)
@@ -66,6 +86,206 @@ def write_metadata (filename, metadata):
 
 ##############################################################################
 
+# Batched writes
+#
+# write_metadata_batch() writes the metadata of many books at once. The
+# filetype of each book is taken from its metadata instead of identifying
+# the file again, and the books are written in four passes:
+#
+#   stage    each writer writes the updated book to a staging file next to
+#            the original (its target), jobs books at a time, with its
+#            fsyncs deferred (see biblio.util.iopolicy.deferred_sync). Each
+#            book is read and written once; only writers that cannot take a
+#            target get a copy of the book to update in place
+#   sync     the staging files are fsynced, again jobs at a time, and then
+#            each directory involved is fsynced once
+#   commit   each original is hardlinked to a backup name and the staging
+#            file renamed over it; the directories are fsynced once more
+#   cleanup  the backups are removed
+#
+# The originals are not touched until every staging file is on disk, and
+# every book is replaced by a single rename. With a journal, each pass is
+# recorded in that file (one JSON object per line, fsynced at the end of
+# each pass), so that after a crash recover_batch() can either finish the
+# batch, if all the staging files made it to disk, or roll it back from the
+# backups. A batch will not start over the journal of an earlier one that
+# has not been recovered.
+
+batch_result = namedtuple('batch_result', 'filename result error')
+
+BATCH_STAGED = '.%s.batch-%d'
+BATCH_BACKUP = '.%s.orig-%d'
+
+def _batch_paths (filename):
+    directory, name = os.path.split(os.path.abspath(filename))
+    pid = os.getpid()
+    return (os.path.join(directory, BATCH_STAGED % (name, pid)),
+            os.path.join(directory, BATCH_BACKUP % (name, pid)))
+
+class BatchJournal (object):
+
+    def __init__ (self, path):
+        self.path = path
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                raise ParserException('batch journal %s already exists: '
+                                      'run recover_batch() on it first' % path)
+            raise
+        self.stream = os.fdopen(fd, 'wb')
+
+    def record (self, event, **fields):
+        fields['event'] = event
+        self.stream.write(json.dumps(fields) + '\n')
+
+    def sync (self):
+        sync_file(self.stream)
+
+    def close (self):
+        self.stream.close()
+
+    def remove (self):
+        self.close()
+        os.unlink(self.path)
+
+    @staticmethod
+    def read (path):
+        events = []
+        with open(path, 'rb') as stream:
+            for line in stream:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    break                   # torn last line
+        return events
+
+def _sync_directories (filenames):
+    for directory in sorted(set(os.path.dirname(os.path.abspath(f)) for f in filenames)):
+        sync_path(directory)
+
+def _takes_target (writer):
+    try:
+        return 'target' in inspect.getargspec(writer).args
+    except TypeError:
+        return False
+
+def _stage_one (job):
+    filename, metadata, staged = job
+    try:
+        parser = find_parser(metadata.filetype)
+        if parser is None or parser.writer is None:
+            raise ParserException('Cannot write metadata for this file type: %s' % filename)
+        with deferred_sync():
+            if _takes_target(parser.writer):
+                return parser.writer(filename, metadata, target=staged), None
+            shutil.copyfile(filename, staged)
+            shutil.copymode(filename, staged)
+            parser.writer(staged, metadata)
+            return WRITE_REWRITE, None
+    except Exception, e:
+        if os.path.exists(staged):
+            os.unlink(staged)
+        return None, e
+
+def _commit_one (filename, staged, backup):
+    if os.path.exists(backup):
+        os.unlink(backup)
+    try:
+        os.link(filename, backup)
+    except OSError:
+        shutil.copy2(filename, backup)
+    os.rename(staged, filename)
+
+def write_metadata_batch (items, jobs=1, journal=None):
+    """
+    Writes metadata for each (filename, metadata) pair of items. Returns a
+    batch_result for each item, in order: result is what the writer
+    returned, or error the exception that stopped it. Books that fail are
+    left untouched and do not stop the rest of the batch.
+    """
+    items = list(items)
+    paths = [ _batch_paths(filename) for filename, metadata in items ]
+
+    log = BatchJournal(journal) if journal is not None else None
+    if log is not None:
+        log.record('begin', pid=os.getpid())
+        for (filename, metadata), (staged, backup) in zip(items, paths):
+            log.record('stage', filename=filename, staged=staged, backup=backup)
+        log.sync()
+
+    pool = ThreadPool(jobs) if jobs > 1 else None
+    try:
+        run = pool.map if pool is not None else map
+
+        outcomes = run(_stage_one, [ (filename, metadata, staged)
+                                     for (filename, metadata), (staged, backup) in zip(items, paths) ])
+        good = [ n for n, (result, error) in enumerate(outcomes) if error is None ]
+        if log is not None:
+            for n, (result, error) in enumerate(outcomes):
+                if error is not None:
+                    log.record('failed', filename=items[n][0])
+
+        run(sync_path, [ paths[n][0] for n in good ])
+        _sync_directories(items[n][0] for n in good)
+        if log is not None:
+            log.record('synced')
+            log.sync()
+
+        for n in good:
+            _commit_one(items[n][0], *paths[n])
+        _sync_directories(items[n][0] for n in good)
+        if log is not None:
+            log.record('committed')
+            log.sync()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    for n in good:
+        os.unlink(paths[n][1])
+    if log is not None:
+        log.remove()
+
+    return [ batch_result(filename, result, error)
+             for (filename, metadata), (result, error) in zip(items, outcomes) ]
+
+def recover_batch (journal, rollback=False):
+    """
+    Finishes or rolls back the batch of an interrupted
+    write_metadata_batch(). A batch is finished if all of its staging files
+    reached the disk (unless rollback is set), and rolled back otherwise.
+    Returns the names of the books that hold the new metadata.
+    """
+    events = BatchJournal.read(journal)
+    seen = set(e['event'] for e in events)
+    failed = set(e['filename'] for e in events if e['event'] == 'failed')
+    entries = [ e for e in events if e['event'] == 'stage' ]
+
+    written = []
+    if 'synced' in seen and not rollback:
+        for e in entries:
+            if e['filename'] in failed:
+                continue
+            if os.path.exists(e['staged']):
+                _commit_one(e['filename'], e['staged'], e['backup'])
+            written.append(e['filename'])
+    else:
+        for e in entries:
+            if os.path.exists(e['backup']):
+                os.rename(e['backup'], e['filename'])
+    _sync_directories(e['filename'] for e in entries)
+
+    for e in entries:
+        for path in (e['staged'], e['backup']):
+            if os.path.exists(path):
+                os.unlink(path)
+    os.unlink(journal)
+    return written
+
+##############################################################################
+
 def initialize_builtin_pluggables (add):
     global ALL_PARSERS
 
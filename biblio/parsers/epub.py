@@ -15,16 +15,18 @@
 # limitations under the License.
 
 from __future__ import with_statement
-from contextlib import closing
 from zipfile    import ZipFile, BadZipfile
+import os
 
 from lxml import etree
 
 from biblio.metadata              import Metadata, EbookMetadata
-from biblio.identifiers.filetypes import EPUB2, OPF2
-from biblio.parsers               import ParserException, parser
+from biblio.identifiers.filetypes import EPUB2, EPUB3, OPF2
+from biblio.parsers               import ParserException, parser, WRITE_REWRITE, WRITE_APPEND
 from biblio.parsers.file          import read_file_metadata
-from biblio.parsers.opf           import parse_opf_xml, process_opf_metadata
+from biblio.parsers.opf           import parse_opf_xml, process_opf_metadata, update_opf_xml
+from biblio.util.iopolicy         import open_header
+from biblio.util.rawzip           import ZipEditException, replace_member, append_member
 
 ##############################################################################
 
@@ -33,6 +35,10 @@ class EPubException (ParserException):
 
 CONTAINER_PATH = 'META-INF/container.xml'
 
+# Books at least this big get their new package document appended instead
+# of having the whole archive copied (see write_epub_metadata)
+EPUB_APPEND_THRESHOLD = 32 * 1024 * 1024
+
 ##############################################################################
 
 def read_epub_metadata (filename, metadata=None):
@@ -40,19 +46,26 @@ def read_epub_metadata (filename, metadata=None):
         metadata = Metadata(EPUB2)
     read_file_metadata(filename, metadata)
 
-    reader = zip_reader(filename)
+    with open_header(filename) as stream:
+        reader = zip_reader(stream)
 
-    try:
-        container = _parse_container_xml(reader(CONTAINER_PATH))
-    except KeyError:
-        raise EPubException('missing OCF container.xml')
+        try:
+            container = _parse_container_xml(reader(CONTAINER_PATH))
+        except KeyError:
+            raise EPubException('missing OCF container.xml')
 
-    try:
-        metadata.opf = parse_opf_xml(reader(container[OPF2.mimetype]))
-    except KeyError:
-        raise EPubException('missing OPF package file')
+        try:
+            metadata.opf_path = container[OPF2.mimetype]
+            metadata.opf = parse_opf_xml(reader(metadata.opf_path))
+        except KeyError:
+            raise EPubException('missing OPF package file')
 
     return metadata
+
+def read_epub3_metadata (filename, metadata=None):
+    if metadata is None:
+        metadata = Metadata(EPUB3)
+    return read_epub_metadata(filename, metadata)
         
 def _parse_container_xml (rawxml):
     if not rawxml: return
@@ -96,11 +109,69 @@ def process_epub_metadata (metadata):
 
 ##############################################################################
 
+# Writing metadata
+#
+# Only the OPF package document changes, so only that member is rebuilt:
+# every other member is copied as raw bytes without being decompressed, and
+# the "mimetype" member is kept stored and first (see biblio.util.rawzip).
+#
+# With mode WRITE_REWRITE the archive is copied to a temporary file that
+# replaces the original. With mode WRITE_APPEND the new package document
+# and a new central directory are appended to the book instead, which
+# costs a few KB of writing however big the book is, but leaves the old
+# package document behind as dead bytes. By default books smaller than
+# EPUB_APPEND_THRESHOLD are rewritten and bigger ones appended to.
+#
+# Given a target, the updated book is written there and the original is
+# left alone. That is always a rewrite: appending would first need a copy.
+
+def write_epub_metadata (filename, ebook, mode=None, target=None):
+    with open_header(filename) as stream:
+        reader = zip_reader(stream)
+        try:
+            container = _parse_container_xml(reader(CONTAINER_PATH))
+        except KeyError:
+            raise EPubException('missing OCF container.xml')
+        try:
+            opf_path = container[OPF2.mimetype]
+            rawopf = reader(opf_path)
+        except KeyError:
+            raise EPubException('missing OPF package file')
+
+    rawopf = update_opf_xml(rawopf, ebook)
+
+    if target is not None:
+        mode = WRITE_REWRITE
+    elif mode is None:
+        if os.path.getsize(filename) >= EPUB_APPEND_THRESHOLD:
+            mode = WRITE_APPEND
+        else:
+            mode = WRITE_REWRITE
+
+    try:
+        if mode == WRITE_APPEND:
+            append_member(filename, opf_path, rawopf)
+        elif mode == WRITE_REWRITE:
+            replace_member(filename, opf_path, rawopf, mimetype_first=True,
+                           read_member=lambda name: ZipFile(filename).read(name), output=target)
+        else:
+            raise EPubException('unknown write mode: %s' % mode)
+    except ZipEditException, e:
+        raise EPubException(str(e))
+    return mode
+
+##############################################################################
+
 def initialize_parser ():
-    return parser(filetype=EPUB2, 
-                  reader=read_epub_metadata, 
-                  writer=None, 
-                  processor=process_epub_metadata)
+    return ( parser(filetype=EPUB2, 
+                    reader=read_epub_metadata, 
+                    writer=write_epub_metadata, 
+                    processor=process_epub_metadata),
+             parser(filetype=EPUB3, 
+                    reader=read_epub3_metadata, 
+                    writer=write_epub_metadata, 
+                    processor=process_epub_metadata),
+           )
 
 ##############################################################################
 ## THE END
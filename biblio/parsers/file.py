@@ -24,7 +24,8 @@ def read_file_metadata (filename, metadata=None):
     if metadata is None:
         metadata = Metadata(None)
 
-    metadata.file_status = os.stat(filename)
+    if isinstance(filename, basestring):
+        metadata.file_status = os.stat(filename)
     return metadata
 
 ##############################################################################
@@ -0,0 +1,214 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# HTML AND XHTML DOCUMENTS
+#
+# All the metadata of an HTML book is in its <head>:
+#
+#   <title>                         the title
+#   <meta name="author">            the author(s)
+#   <meta name="description">       a description
+#   <meta name="keywords">          comma separated tags
+#   <meta name="DC.xxx">            Dublin Core elements (DC.title,
+#                                   DC.creator, DC.subject, ...), also
+#                                   written as "DCTERMS.xxx"
+#   <html lang="...">               the language
+#
+# The file is fed to lxml's pull parser HTML_CHUNK_SIZE bytes at a time,
+# and feeding stops as soon as the end of the head or the start of the
+# body has been seen. A multi-MB single-file book costs about as much as a
+# small one: the body is neither read nor parsed, beyond the rest of the
+# chunk that holds its start tag.
+
+from __future__ import with_statement
+import re
+
+from lxml import etree
+
+from biblio.metadata              import Metadata, EbookMetadata, Storage
+from biblio.identifiers.filetypes import HTML, XHTML
+from biblio.parsers               import ParserException, parser
+from biblio.parsers.file          import read_file_metadata
+from biblio.util.iopolicy         import open_header
+
+##############################################################################
+
+class HTMLException (ParserException):
+    pass
+
+HTML_CHUNK_SIZE = 8192
+HTML_MAX_HEAD   = 1024 * 1024
+
+DC_PREFIXES = ('dc.', 'dcterms.')
+
+ISBN_PATTERN = re.compile(r'(?:urn:)?isbn:?\s*([0-9Xx-]{10,17})$', re.I)
+
+##############################################################################
+
+def _local_name (tag):
+    if not isinstance(tag, basestring):
+        return None                             # comments and PIs
+    return tag.rsplit('}', 1)[-1].lower()
+
+def read_html_metadata (filename, metadata=None):
+    if metadata is None:
+        metadata = Metadata(HTML)
+    read_file_metadata(filename, metadata)
+
+    with open_header(filename) as stream:
+        metadata.html = _parse_html_head(stream, xml=(metadata.filetype == XHTML))
+
+    return metadata
+
+def read_xhtml_metadata (filename, metadata=None):
+    if metadata is None:
+        metadata = Metadata(XHTML)
+    return read_html_metadata(filename, metadata)
+
+def _parse_html_head (stream, xml=False):
+    if xml:
+        pullparser = etree.XMLPullParser(events=('start', 'end'), recover=True,
+                                         resolve_entities=False, no_network=True)
+    else:
+        pullparser = etree.HTMLPullParser(events=('start', 'end'), no_network=True)
+
+    head = Storage(title=None, lang=None, meta={})
+    fed = 0
+    done = False
+    while not done and fed < HTML_MAX_HEAD:
+        data = stream.read(HTML_CHUNK_SIZE)
+        if not data:
+            break
+        fed += len(data)
+        try:
+            pullparser.feed(data)
+        except etree.XMLSyntaxError:
+            pass
+        done = _collect_head(pullparser, head)
+
+    if head.title is None and not head.meta and not done:
+        raise HTMLException('no document head found')
+    return head
+
+def _collect_head (pullparser, head):
+    """
+    Adds what has been parsed so far to head. Returns True once the end of
+    the head has been seen.
+    """
+    for event, element in pullparser.read_events():
+        name = _local_name(element.tag)
+
+        if event == 'start':
+            if name == 'html':
+                head.lang = element.get('lang') or element.get('xml:lang') or \
+                            element.get('{http://www.w3.org/XML/1998/namespace}lang')
+            elif name == 'meta':
+                key = (element.get('name') or '').strip().lower()
+                content = (element.get('content') or '').strip()
+                if key and content:
+                    head.meta.setdefault(key, []).append(content)
+            elif name == 'body':
+                return True
+
+        elif event == 'end':
+            if name == 'title' and head.title is None:
+                head.title = (element.text or u'').strip() or None
+            elif name == 'head':
+                return True
+    return False
+
+##############################################################################
+
+def _dublin_core (meta, element):
+    values = []
+    for key, contents in meta.iteritems():
+        for prefix in DC_PREFIXES:
+            if key.startswith(prefix) and key[len(prefix):].split('.')[0] == element:
+                values.extend(contents)
+    return values
+
+def process_html_metadata (metadata):
+    ebook = EbookMetadata(metadata.filetype)
+
+    if 'html' not in metadata:
+        return ebook
+    head = metadata.html
+    meta = head.meta
+
+    from biblio.ebook import parse_ebook_authors, parse_ebook_date
+
+    titles = _dublin_core(meta, 'title')
+    if titles:
+        ebook.title = titles[0]
+    elif head.title:
+        ebook.title = head.title
+
+    authors = _dublin_core(meta, 'creator')
+    if not authors:
+        for author in meta.get('author', ()):
+            authors.extend(parse_ebook_authors(author))
+    if authors:
+        ebook.authors = authors
+
+    descriptions = _dublin_core(meta, 'description') or meta.get('description')
+    if descriptions:
+        ebook.description = descriptions[0]
+
+    tags = _dublin_core(meta, 'subject')
+    if not tags:
+        for keywords in meta.get('keywords', ()):
+            tags.extend(t.strip() for t in keywords.split(','))
+    tags = [ t for t in tags if t ]
+    if tags:
+        ebook.tags = tags
+
+    publishers = _dublin_core(meta, 'publisher')
+    if publishers:
+        ebook.publisher = publishers[0]
+    rights = _dublin_core(meta, 'rights')
+    if rights:
+        ebook.rights = rights[0]
+
+    languages = _dublin_core(meta, 'language')
+    if not languages and head.lang:
+        languages = [ head.lang, ]
+    if languages:
+        ebook.languages = languages
+
+    for date in _dublin_core(meta, 'date'):
+        try:
+            ebook.date_published = parse_ebook_date(date)
+            break
+        except (ValueError, OverflowError):
+            pass
+
+    for identifier in _dublin_core(meta, 'identifier'):
+        m = ISBN_PATTERN.match(identifier)
+        if m is not None:
+            ebook.identifiers = { 'isbn': m.group(1).replace('-', '') }
+            break
+
+    return ebook
+
+##############################################################################
+
+def initialize_parser ():
+    return ( parser(filetype=HTML , reader=read_html_metadata , writer=None, processor=process_html_metadata),
+             parser(filetype=XHTML, reader=read_xhtml_metadata, writer=None, processor=process_html_metadata),
+           )
+
+##############################################################################
+## THE END
@@ -192,13 +192,13 @@
 # a four-byte boundary
 
 from __future__ import with_statement
-from contextlib import closing
-import re, struct
+import os, re, shutil, struct, tempfile
 
 from biblio.metadata              import EbookMetadata, Metadata, Storage
 from biblio.identifiers.filetypes import MOBI
-from biblio.parsers               import parser
+from biblio.parsers               import parser, WRITE_IN_PLACE, WRITE_REWRITE
 from biblio.parsers.pdb           import PDBException, read_pdb_metadata
+from biblio.util.iopolicy         import open_header, sync_file
 from biblio.util.xmlunicode       import replace_entities
 
 ##############################################################################
@@ -218,7 +218,7 @@ def read_mobi_metadata (filename, metadata=None):
         return metadata
 
     offset, length = metadata.pdb.records[0]
-    with closing(open(filename, 'rb')) as stream:
+    with open_header(filename) as stream:
         stream.seek(offset)
         raw = stream.read(length)
 
@@ -378,6 +378,156 @@ def process_mobi_metadata (metadata):
 
 ##############################################################################
 
+# Writing metadata
+#
+# Only record 0 is rebuilt: the PalmDOC and MOBI headers are kept as they
+# are, the EXTH header is regenerated and the full name is replaced. Any
+# bytes between the end of the EXTH header and the full name are kept.
+#
+# If the new record 0 is no longer than the old one (there is usually
+# plenty of null padding after the full name) it is written over the old
+# one in place, padded to the same length, and nothing else in the file
+# moves. Otherwise the file is copied to a temporary file next to it with
+# the new record 0, given RECORD0_PADDING bytes of room for later edits,
+# and the offsets of all the following records in the PDB record table
+# shifted accordingly. The temporary file is then renamed over the book.
+#
+# A field that is None in the metadata leaves the book's existing value
+# alone. An empty value removes it.
+
+RECORD0_PADDING = 1024
+
+EXTH_AUTHOR      = 100
+EXTH_PUBLISHER   = 101
+EXTH_DESCRIPTION = 103
+EXTH_ISBN        = 104
+EXTH_SUBJECT     = 105
+EXTH_PUBLISHED   = 106
+EXTH_RIGHTS      = 109
+EXTH_TITLE       = 503
+
+def _exth_updates (ebook, codec):
+    def encode (value):
+        return value.encode(codec, 'replace') if isinstance(value, unicode) else value
+
+    updates = {}
+    if ebook.title is not None:
+        updates[EXTH_TITLE] = [ encode(ebook.title), ] if ebook.title else []
+    if ebook.authors is not None:
+        updates[EXTH_AUTHOR] = [ encode(a) for a in ebook.authors if a ]
+    if ebook.publisher is not None:
+        updates[EXTH_PUBLISHER] = [ encode(ebook.publisher), ] if ebook.publisher else []
+    if ebook.description is not None:
+        updates[EXTH_DESCRIPTION] = [ encode(ebook.description), ] if ebook.description else []
+    if ebook.identifiers is not None:
+        isbn = ebook.identifiers.get('isbn')
+        updates[EXTH_ISBN] = [ encode(isbn), ] if isbn else []
+    if ebook.tags is not None:
+        updates[EXTH_SUBJECT] = [ encode(u'; '.join(ebook.tags)), ] if ebook.tags else []
+    if ebook.date_published is not None:
+        updates[EXTH_PUBLISHED] = [ ebook.date_published.isoformat(), ]
+    if ebook.rights is not None:
+        updates[EXTH_RIGHTS] = [ encode(ebook.rights), ] if ebook.rights else []
+    return updates
+
+def _build_exth (records):
+    body = ''.join(struct.pack('>LL', rtype, len(data) + 8) + data for rtype, data in records)
+    exth = 'EXTH' + struct.pack('>LL', len(body) + 12, len(records)) + body
+    return exth + '\x00' * (-len(exth) % 4)
+
+def _build_record0 (raw, mobiheader, ebook):
+    codec = {1252:'cp1252', 65001:'utf-8'}.get(mobiheader.text_encoding, 'cp1252')
+    header_end = 16 + mobiheader.header_length
+
+    old_records = []
+    exth_end = header_end
+    if 'exth' in mobiheader:
+        old_records = [ (r.type, r.data) for r in mobiheader.exth.records ]
+        exth_end += mobiheader.exth.header_length
+        exth_end += -exth_end % 4
+
+    updates = _exth_updates(ebook, codec)
+    records = [ (rtype, data) for rtype, data in old_records if rtype not in updates ]
+    for rtype in sorted(updates):
+        records.extend((rtype, data) for data in updates[rtype])
+    exth = _build_exth(records)
+
+    gap = raw[exth_end:mobiheader.fullname_offset] if mobiheader.fullname_offset > exth_end else ''
+    if ebook.title:
+        fullname = ebook.title.encode(codec, 'replace') if isinstance(ebook.title, unicode) else ebook.title
+    else:
+        fullname = mobiheader.fullname or ''
+
+    header = bytearray(raw[:header_end])
+    fullname_offset = header_end + len(exth) + len(gap)
+    struct.pack_into('>LL', header, 0x54, fullname_offset, len(fullname))
+    struct.pack_into('>L', header, 0x80, mobiheader.exth_flags | 0x40)
+
+    record0 = str(header) + exth + gap + fullname + '\x00\x00'
+    return record0 + '\x00' * (-len(record0) % 4)
+
+def write_mobi_metadata (filename, ebook, target=None):
+    metadata = read_mobi_metadata(filename)
+    if 'mobi' not in metadata or 'identifier' not in metadata.mobi:
+        raise MobiException('MOBI file has no MOBI header to write to')
+    mobiheader = metadata.mobi
+    if mobiheader.encryption:
+        raise MobiException('cannot write metadata to an encrypted MOBI book')
+
+    offset, length = metadata.pdb.records[0]
+    with open(filename, 'rb') as stream:
+        stream.seek(offset)
+        raw = stream.read(length)
+
+    record0 = _build_record0(raw, mobiheader, ebook)
+
+    if len(record0) <= length:
+        if target is not None:
+            shutil.copyfile(filename, target)
+            shutil.copymode(filename, target)
+        with open(target or filename, 'r+b') as stream:
+            stream.seek(offset)
+            stream.write(record0 + '\x00' * (length - len(record0)))
+            sync_file(stream)
+        return WRITE_IN_PLACE if target is None else WRITE_REWRITE
+
+    record0 += '\x00' * RECORD0_PADDING
+    _rewrite_record0(filename, metadata.pdb, record0, target)
+    return WRITE_REWRITE
+
+def _rewrite_record0 (filename, pdbheader, record0, target=None):
+    offset, length = pdbheader.records[0]
+    shift = len(record0) - length
+
+    if target is None:
+        directory, name = os.path.split(os.path.abspath(filename))
+        fd, temp = tempfile.mkstemp(prefix='.%s.' % name, suffix='.tmp', dir=directory)
+    else:
+        temp = target
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            with open(filename, 'rb') as stream:
+                header = bytearray(stream.read(offset))
+                for n in xrange(1, pdbheader.num_records):
+                    entry = 78 + 8 * n
+                    record_offset, = struct.unpack_from('>L', header, entry)
+                    struct.pack_into('>L', header, entry, record_offset + shift)
+                out.write(header)
+                out.write(record0)
+                stream.seek(offset + length)
+                shutil.copyfileobj(stream, out, 1024 * 1024)
+            sync_file(out)
+        shutil.copymode(filename, temp)
+        if target is None:
+            os.rename(temp, filename)
+    except:
+        if os.path.exists(temp):
+            os.unlink(temp)
+        raise
+
+##############################################################################
+
 IANA_MOBI = { None: {None: (0, 0)},
               'af': {None: (54, 0)},
               'ar': {None: (1, 0),
@@ -572,7 +722,7 @@ def mobi2iana_language (mobi_locale):
 def initialize_parser ():
     return parser(filetype=MOBI, 
                   reader=read_mobi_metadata, 
-                  writer=None, 
+                  writer=write_mobi_metadata, 
                   processor=process_mobi_metadata)
 
 ##############################################################################
@@ -15,14 +15,16 @@
 # limitations under the License.
 
 from __future__ import with_statement
-from contextlib import closing
+import os, re, shutil, tempfile
 
 from lxml import etree
 
+from biblio.collation             import author_sort, title_sort
 from biblio.metadata              import Metadata, Storage
 from biblio.identifiers.filetypes import OPF2
-from biblio.parsers               import parser
+from biblio.parsers               import parser, WRITE_REWRITE
 from biblio.parsers.file          import read_file_metadata
+from biblio.util.iopolicy         import open_header, sync_file
 from biblio.util.xmlunicode       import xml_to_unicode
 
 ##############################################################################
@@ -32,6 +34,9 @@ NAMESPACES = { 'dc'      : 'http://purl.org/dc/elements/1.1',
                'opf'     : 'http://www.idpf.org/2007/opf',
              }
 
+# Identifiers without a scheme attribute, as EPUB3 writes them
+URN_PATTERN = re.compile(r'urn:([a-z][a-z0-9-]*):(.+)$', re.I)
+
 ##############################################################################
 
 def read_opf_metadata (filename, metadata=None):
@@ -39,7 +44,7 @@ def read_opf_metadata (filename, metadata=None):
         metadata = Metadata(OPF2)
     read_file_metadata(filename, metadata)
 
-    with closing(open(filename, 'r')) as stream:
+    with open_header(filename, 'r') as stream:
         metadata.opf = parse_opf_xml(stream.read())
 
     return metadata
@@ -52,6 +57,7 @@ def parse_opf_xml (rawxml):
     tree = etree.fromstring(rawxml, etree.XMLParser(recover=True))
 
     opf = Storage()
+    opf.version = tree.get('version')
 
     for section in ('metadata', 'manifest', 'spine', 'guide'):
         subtree = tree.find('opf:%s' % section, namespaces=NAMESPACES)
@@ -63,10 +69,39 @@ def parse_opf_xml (rawxml):
 
 ##############################################################################
 
+# EPUB3 metadata
+#
+# EPUB3 drops the opf:role/opf:file-as attributes and calibre's series
+# metas in favour of refinements: <meta property="..." refines="#id">
+# elements that attach a property to another element by its id, e.g.
+#
+#   <dc:creator id="c1">Lewis Carroll</dc:creator>
+#   <meta refines="#c1" property="role" scheme="marc:relators">aut</meta>
+#   <meta refines="#c1" property="file-as">Carroll, Lewis</meta>
+#   <meta property="belongs-to-collection" id="s1">Wonderland</meta>
+#   <meta refines="#s1" property="collection-type">series</meta>
+#   <meta refines="#s1" property="group-position">1</meta>
+#
+# The metadata is walked once, recording every element by id and every
+# refinement by the id it refines; the creators, titles and collections
+# are then resolved against that map.
+
+def _refinements (refinements, attribs):
+    if 'id' not in attribs:
+        return {}
+    return refinements.get(attribs['id'], {})
+
 def process_opf_metadata (metadata, ebook):
+    authors_file_as = []
+    has_file_as = False
+    titles = []
+    creators = []
+    collections = []
+    refinements = {}
     for tag,attribs,text in metadata.metadata:
         if tag == '{http://purl.org/dc/elements/1.1/}title':
-            ebook.title = text.strip()
+            if text and text.strip():
+                titles.append((attribs, text.strip()))
         elif tag == '{http://purl.org/dc/elements/1.1/}publisher':
             ebook.publisher = text.strip()
         elif tag == '{http://purl.org/dc/elements/1.1/}date':
@@ -87,14 +122,20 @@ def process_opf_metadata (metadata, ebook):
                     if attr.endswith('scheme'):
                         typ = val.lower()
                         ebook.setdefault('identifiers', {})[typ] = text.strip()
+                m = URN_PATTERN.match(text.strip())
+                if m is not None and not any(attr.endswith('scheme') for attr in attribs):
+                    typ, value = m.group(1).lower(), m.group(2)
+                    if typ == 'isbn':
+                        value = value.replace('-', '')
+                    ebook.setdefault('identifiers', {})[typ] = value
         elif tag == '{http://purl.org/dc/elements/1.1/}creator':
-            if ('role' in attribs and attribs['role'] == 'aut') or \
-               ('{http://www.idpf.org/2007/opf}role' in attribs and 
-                attribs['{http://www.idpf.org/2007/opf}role'] == 'aut') or \
-               ('role' not in attribs and 
-                '{http://www.idpf.org/2007/opf}role' not in attribs):
-                from biblio.ebook import parse_ebook_authors
-                ebook.setdefault('authors', []).extend(parse_ebook_authors(text))
+            creators.append((attribs, text))
+        elif tag == '{http://www.idpf.org/2007/opf}meta' and 'property' in attribs:
+            if not (text and text.strip()): continue
+            if attribs.get('refines', '').startswith('#'):
+                refinements.setdefault(attribs['refines'][1:], {}).setdefault(attribs['property'], text.strip())
+            elif attribs['property'] == 'belongs-to-collection':
+                collections.append((attribs, text.strip()))
         elif tag == '{http://www.idpf.org/2007/opf}meta':
             if not ('name' in attribs and 'content' in attribs): continue
             name = attribs['name']
@@ -103,12 +144,365 @@ def process_opf_metadata (metadata, ebook):
                 ebook.series = content.strip()
             elif name == 'calibre:series_index':
                 ebook.series_index = float(content.strip())
+            elif name == 'calibre:title_sort':
+                ebook.title_sort = content.strip()
+            elif name == 'calibre:author_sort':
+                ebook.author_sort = content.strip()
+
+    # The main title if one is marked, else the last one
+    for attribs, text in titles:
+        refined = _refinements(refinements, attribs)
+        if refined.get('title-type', 'main') == 'main' or not ebook.title:
+            ebook.title = text
+            if refined.get('file-as') and not ebook.title_sort:
+                ebook.title_sort = refined['file-as']
+
+    for attribs, text in creators:
+        refined = _refinements(refinements, attribs)
+        role = attribs.get('{http://www.idpf.org/2007/opf}role') or attribs.get('role') or refined.get('role')
+        if role not in (None, 'aut'):
+            continue
+        from biblio.ebook import parse_ebook_authors
+        names = parse_ebook_authors(text)
+        ebook.setdefault('authors', []).extend(names)
+        file_as = attribs.get('{http://www.idpf.org/2007/opf}file-as') or attribs.get('file-as') or \
+                  refined.get('file-as')
+        if file_as and file_as.strip():
+            authors_file_as.append(file_as.strip())
+            has_file_as = True
+        else:
+            # Keep the sort aligned with the authors
+            authors_file_as.extend(author_sort(name) for name in names)
+
+    if not ebook.series:
+        for attribs, text in collections:
+            refined = _refinements(refinements, attribs)
+            if refined.get('collection-type', 'series') != 'series':
+                continue
+            ebook.series = text
+            try:
+                ebook.series_index = float(refined.get('group-position', ''))
+            except ValueError:
+                pass
+            break
+
+    if has_file_as and not ebook.author_sort:
+        ebook.author_sort = u' & '.join(authors_file_as)
 
     return ebook
 
 ##############################################################################
+
+# Updating an OPF package document
+#
+# Only the elements for the fields being written are touched; everything
+# else in the package document (manifest, spine, guide, unknown metadata)
+# is kept as it is. Existing elements are reused in place where possible,
+# so the document keeps its order and layout. A field that is None in the
+# metadata leaves the existing elements alone, an empty value removes them.
+
+DC  = '{http://purl.org/dc/elements/1.1/}'
+OPF = '{http://www.idpf.org/2007/opf}'
+
+def _set_elements (parent, tag, items, match=None):
+    existing = [ el for el in parent if el.tag == tag and (match is None or match(el)) ]
+    elements = []
+    anchor = existing[-1] if existing else None
+    for n, (text, attrib) in enumerate(items):
+        if n < len(existing):
+            el = existing[n]
+        else:
+            # Unprefixed where the OPF namespace is the default one, as
+            # EPUB3 packages have it
+            nsmap = { None: OPF[1:-1] } if tag.startswith(OPF) and parent.nsmap.get(None) == OPF[1:-1] else None
+            el = etree.SubElement(parent, tag, nsmap=nsmap)
+            if anchor is not None:
+                anchor.addnext(el)
+                el.tail = anchor.tail
+            else:
+                previous = el.getprevious()
+                if previous is not None:
+                    el.tail = previous.tail
+                    previous.tail = parent.text
+            anchor = el
+        el.text = text
+        for key, value in attrib.iteritems():
+            el.set(key, value)
+        elements.append(el)
+    for el in existing[len(items):]:
+        parent.remove(el)
+    return elements
+
+def _set_single (parent, tag, value):
+    if value is not None:
+        _set_elements(parent, tag, [ (value, {}), ] if value else [])
+
+def _set_meta (parent, name, value):
+    if value is not None:
+        _set_elements(parent, OPF + 'meta', [ (None, {'name':name, 'content':value}), ] if value else [],
+                      lambda el: el.get('name') == name)
+
+def _role (el):
+    return el.get(OPF + 'role', el.get('role'))
+
+def _scheme (el):
+    return (el.get(OPF + 'scheme') or el.get('scheme') or '').lower()
+
+def _identifier_scheme (el):
+    """
+    Returns the scheme of an identifier, and whether it is written as a
+    URN ("urn:isbn:...") rather than with an opf:scheme attribute.
+    """
+    scheme = _scheme(el)
+    if scheme:
+        return scheme, False
+    m = URN_PATTERN.match((el.text or '').strip())
+    if m is not None:
+        return m.group(1).lower(), True
+    return None, False
+
+def _update_identifiers (root, metadata, identifiers, epub3=False):
+    # EPUB3 has no opf:scheme, so new identifiers are written as URNs there
+    unique_id = root.get('unique-identifier')
+    wanted = dict((scheme.lower(), value) for scheme, value in identifiers.iteritems() if value)
+    for el in list(metadata.iter(DC + 'identifier')):
+        scheme, urn = _identifier_scheme(el)
+        if scheme in wanted:
+            value = wanted.pop(scheme)
+            el.text = 'urn:%s:%s' % (scheme, value) if urn else value
+        elif scheme and el.get('id') != unique_id:
+            el.getparent().remove(el)
+    for scheme, value in sorted(wanted.iteritems()):
+        if epub3:
+            item = ('urn:%s:%s' % (scheme, value), {})
+        else:
+            item = (value, {OPF + 'scheme': scheme.upper()})
+        _set_elements(metadata, DC + 'identifier', [ item, ], lambda el: False)
+
+# Sort fields
+#
+# The metadata handed to a writer has come from read_processed_metadata(),
+# so title_sort and author_sort are always set: read from the file, or
+# derived by fill_sort_fields(). When the title or the authors change and
+# the sort field is still the one that went with the old value, it is
+# stale and is derived again from the new value. A derived sort is only
+# written where the file already keeps one; an explicit one always is.
+
+def _meta_content (metadata, name):
+    for el in metadata.iter(OPF + 'meta'):
+        if el.get('name') == name:
+            return (el.get('content') or u'').strip()
+    return None
+
+def _title_sort_value (ebook, old_title, old_sort):
+    """
+    Returns the title sort to write, or None to leave the file as it is.
+    """
+    title = ebook.title if ebook.title is not None else old_title
+    if not title:
+        return None
+    derived = title_sort(title, ebook.languages)
+    sort = ebook.title_sort
+    if title != old_title and old_title and \
+       sort in (old_sort, title_sort(old_title, ebook.languages)):
+        sort = None                                     # stale
+    if not sort:
+        sort = derived
+    if old_sort is None and sort == derived:
+        return None
+    return sort
+
+def _author_file_as (metadata, refined):
+    """
+    Returns (author, file-as) for each author in the file, in order.
+    """
+    creators = []
+    for el in metadata:
+        if el.tag == DC + 'creator' and (_role(el) or _refined_text(refined, el, 'role')) in (None, 'aut'):
+            sort = el.get(OPF + 'file-as') or el.get('file-as') or _refined_text(refined, el, 'file-as')
+            creators.append(((el.text or u'').strip(), sort))
+    return creators
+
+def _author_sort_values (ebook, authors, old_creators, old_sort):
+    """
+    Returns the file-as of each author, or None for an author that had
+    none and would only get the derived one. Authors that were already in
+    the file keep theirs unless a new author_sort is given.
+    """
+    old_file_as = dict((a, sort) for a, sort in old_creators if sort)
+    old_authors = [ a for a, sort in old_creators ]
+    derived = [ old_file_as.get(a) or author_sort(a) for a in authors ]
+    sorts = (ebook.author_sort or u'').split(u' & ')
+    stale = (old_sort, u' & '.join(sort for a, sort in old_creators if sort),
+             u' & '.join(author_sort(a) for a in old_authors))
+    if not ebook.author_sort or len(sorts) != len(authors) or \
+       (set(authors) != set(old_authors) and ebook.author_sort in stale):
+        sorts = derived
+    return [ sort if a in old_file_as or sort != author_sort(a) else None
+             for a, sort in zip(authors, sorts) ]
+
+# EPUB3 packages get role, file-as and series as refinements (see above)
+# instead of attributes. Refinements of elements that are removed go too.
+
+def _refinement_map (metadata):
+    refined = {}
+    for el in metadata.iter(OPF + 'meta'):
+        if el.get('refines', '').startswith('#') and el.get('property'):
+            refined.setdefault(el.get('refines')[1:], {}).setdefault(el.get('property'), []).append(el)
+    return refined
+
+def _refined_text (refined, el, prop):
+    for meta in refined.get(el.get('id'), {}).get(prop, ()):
+        return (meta.text or '').strip()
+    return None
+
+def _element_id (root, el, prefix):
+    if el.get('id') is None:
+        ids = set(root.xpath('//@id'))
+        n = 1
+        while '%s%d' % (prefix, n) in ids:
+            n += 1
+        el.set('id', '%s%d' % (prefix, n))
+    return el.get('id')
+
+def _set_refinement (metadata, ident, prop, value, attrib={}):
+    attrib = dict(attrib, refines='#' + ident, property=prop)
+    _set_elements(metadata, OPF + 'meta', [ (value, attrib), ] if value else [],
+                  lambda el: el.get('refines') == '#' + ident and el.get('property') == prop)
+
+def _drop_refinements (metadata, refined, before, after):
+    kept = set(el.get('id') for el in after)
+    for ident in before:
+        if ident not in kept:
+            for elements in refined.get(ident, {}).values():
+                for el in elements:
+                    if el.getparent() is not None:
+                        el.getparent().remove(el)
+
+def _update_epub3_creators (root, metadata, authors, sorts):
+    refined = _refinement_map(metadata)
+    is_author = lambda el: (_role(el) or _refined_text(refined, el, 'role')) in (None, 'aut')
+    before = [ el.get('id') for el in metadata if el.tag == DC + 'creator' and is_author(el) ]
+    creators = _set_elements(metadata, DC + 'creator', [ (a, {}) for a in authors ], is_author)
+    for el, sort in zip(creators, sorts):
+        ident = _element_id(root, el, 'creator')
+        _set_refinement(metadata, ident, 'role', 'aut', { 'scheme': 'marc:relators' })
+        _set_refinement(metadata, ident, 'file-as', sort)
+    _drop_refinements(metadata, refined, before, creators)
+
+def _update_epub3_series (root, metadata, series, series_index):
+    refined = _refinement_map(metadata)
+    is_series = lambda el: el.get('property') == 'belongs-to-collection' and \
+                           _refined_text(refined, el, 'collection-type') in (None, 'series')
+    before = [ el.get('id') for el in metadata if el.tag == OPF + 'meta' and is_series(el) ]
+    collections = _set_elements(metadata, OPF + 'meta',
+                                [ (series, {'property':'belongs-to-collection'}), ] if series else [],
+                                is_series)
+    for el in collections:
+        ident = _element_id(root, el, 'series')
+        _set_refinement(metadata, ident, 'collection-type', 'series')
+        if series_index is not None:
+            _set_refinement(metadata, ident, 'group-position', '%g' % series_index)
+    _drop_refinements(metadata, refined, before, collections)
+
+def update_opf_xml (rawxml, ebook):
+    root = etree.fromstring(rawxml, etree.XMLParser(recover=True))
+    metadata = root.find(OPF + 'metadata')
+    if metadata is None:
+        metadata = etree.SubElement(root, OPF + 'metadata')
+        root.insert(0, metadata)
+    epub3 = (root.get('version') or '').startswith('3')
+
+    refined = _refinement_map(metadata)
+    is_main_title = lambda el: _refined_text(refined, el, 'title-type') in (None, 'main')
+    titles = [ el for el in metadata if el.tag == DC + 'title' and is_main_title(el) ]
+    old_title = (titles[0].text or u'').strip() if titles else None
+    old_title_sort = _meta_content(metadata, 'calibre:title_sort')
+    if old_title_sort is None and epub3 and titles:
+        old_title_sort = _refined_text(refined, titles[0], 'file-as')
+
+    if ebook.title is not None:
+        titles = _set_elements(metadata, DC + 'title', [ (ebook.title, {}), ] if ebook.title else [],
+                               is_main_title)
+    sort = _title_sort_value(ebook, old_title, old_title_sort)
+    if sort is not None:
+        has_meta = _meta_content(metadata, 'calibre:title_sort') is not None
+        has_refinement = epub3 and titles and _refined_text(refined, titles[0], 'file-as') is not None
+        if has_meta or not epub3:
+            _set_meta(metadata, 'calibre:title_sort', sort)
+        if epub3 and titles and (has_refinement or not has_meta):
+            _set_refinement(metadata, _element_id(root, titles[0], 'title'), 'file-as', sort)
+
+    if ebook.authors is not None:
+        authors = [ a for a in ebook.authors if a ]
+        sorts = _author_sort_values(ebook, authors, _author_file_as(metadata, refined),
+                                    _meta_content(metadata, 'calibre:author_sort'))
+        if epub3:
+            _update_epub3_creators(root, metadata, authors, sorts)
+        else:
+            creators = _set_elements(metadata, DC + 'creator', [ (a, {}) for a in authors ],
+                                     lambda el: _role(el) in (None, 'aut'))
+            for el, sort in zip(creators, sorts):
+                if _role(el) is None:
+                    el.set(OPF + 'role', 'aut')
+                el.attrib.pop('file-as', None)
+                if sort:
+                    el.set(OPF + 'file-as', sort)
+                else:
+                    el.attrib.pop(OPF + 'file-as', None)
+        if _meta_content(metadata, 'calibre:author_sort') is not None:
+            _set_meta(metadata, 'calibre:author_sort',
+                      u' & '.join(sort or author_sort(a) for a, sort in zip(authors, sorts)))
+
+    _set_meta(metadata, 'calibre:series', ebook.series)
+    if ebook.series_index is not None:
+        _set_meta(metadata, 'calibre:series_index', '%g' % ebook.series_index)
+    if epub3 and ebook.series is not None:
+        _update_epub3_series(root, metadata, ebook.series, ebook.series_index)
+    _set_single(metadata, DC + 'publisher', ebook.publisher)
+    _set_single(metadata, DC + 'description', ebook.description)
+    _set_single(metadata, DC + 'rights', ebook.rights)
+
+    if ebook.languages is not None:
+        _set_elements(metadata, DC + 'language', [ (l, {}) for l in ebook.languages if l ])
+    if ebook.tags is not None:
+        _set_elements(metadata, DC + 'subject', [ (t, {}) for t in ebook.tags if t ])
+    if ebook.date_published is not None:
+        _set_elements(metadata, DC + 'date', [ (ebook.date_published.isoformat(), {}), ],
+                      lambda el: el.get(OPF + 'event', el.get('event', 'publication')) == 'publication')
+    if ebook.identifiers is not None:
+        _update_identifiers(root, metadata, ebook.identifiers, epub3)
+
+    return etree.tostring(root, encoding='utf-8', xml_declaration=True)
+
+def write_opf_metadata (filename, ebook, target=None):
+    with open(filename, 'rb') as stream:
+        rawxml = stream.read()
+    rawxml = update_opf_xml(rawxml, ebook)
+
+    if target is None:
+        directory, name = os.path.split(os.path.abspath(filename))
+        fd, temp = tempfile.mkstemp(prefix='.%s.' % name, suffix='.tmp', dir=directory)
+    else:
+        temp = target
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(rawxml)
+            sync_file(out)
+        shutil.copymode(filename, temp)
+        if target is None:
+            os.rename(temp, filename)
+    except:
+        if os.path.exists(temp):
+            os.unlink(temp)
+        raise
+    return WRITE_REWRITE
+
+##############################################################################
+
 def initialize_parser ():
-    return parser(filetype=OPF2, reader=read_opf_metadata, writer=None, processor=None)
+    return parser(filetype=OPF2, reader=read_opf_metadata, writer=write_opf_metadata, processor=None)
 
 ##############################################################################
 ## THE END
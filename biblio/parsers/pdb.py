@@ -93,13 +93,13 @@
 from __future__ import with_statement
 
 import datetime, re, struct
-from contextlib import closing
 
 from biblio.metadata              import Metadata, Storage
 from biblio.identifiers.filetypes import PDB_EREADER, PDB_GUTENPALM, \
                                          PDB_PALMDOC, PDB_PLUCKER
 from biblio.parsers               import ParserException, parser
 from biblio.parsers.file          import read_file_metadata
+from biblio.util.iopolicy         import open_header
 
 ##############################################################################
 
@@ -124,7 +124,7 @@ def read_pdb_metadata (filename, metadata=None):
         metadata = Metadata(None)
     read_file_metadata(filename, metadata)
 
-    with closing(open(filename, 'rb')) as stream:
+    with open_header(filename) as stream:
         metadata.pdb = _parse_pdb_header(stream)
 
     return metadata
@@ -178,7 +178,7 @@ def read_ereader_metadata (filename, metadata=None):
     read_pdb_metadata(filename, metadata)
 
     offset, length = metadata.pdb.records[0]
-    with closing(open(filename, 'rb')) as stream:
+    with open_header(filename) as stream:
         stream.seek(offset)
         raw = stream.read(length)
 
@@ -256,7 +256,7 @@ def read_palmdoc_metadata (filename, metadata=None):
     read_pdb_metadata(filename, metadata)
 
     offset, length = metadata.pdb.records[0]
-    with closing(open(filename, 'rb')) as stream:
+    with open_header(filename) as stream:
         stream.seek(offset)
         raw = stream.read(length)
 
@@ -289,7 +289,7 @@ def read_plucker_metadata (filename, metadata=None):
     read_pdb_metadata(filename, metadata)
 
     offset, length = metadata.pdb.records[0]
-    with closing(open(filename, 'rb')) as stream:
+    with open_header(filename) as stream:
         stream.seek(offset)
         raw = stream.read(length)
 
@@ -346,7 +346,7 @@ def read_ztxt_metadata (filename, metadata=None):
     read_pdb_metadata(filename, metadata)
 
     offset, length = metadata.pdb.records[0]
-    with closing(open(filename, 'rb')) as stream:
+    with open_header(filename) as stream:
         stream.seek(offset)
         raw = stream.read(length)
 
@@ -0,0 +1,686 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# PORTABLE DOCUMENT FORMAT
+#
+# The metadata of a PDF lives in two places, both reached from the trailer
+# at the end of the file:
+#
+#   /Info       the document information dictionary: Title, Author,
+#               Subject, Keywords, Creator, Producer, CreationDate, ...
+#   /Metadata   an XMP packet, in a stream referenced by the document
+#               catalog (the trailer's /Root)
+#
+# Nothing else in the file is read. The last PDF_TAIL_SIZE bytes give the
+# offset of the newest cross-reference section (the "startxref" line), and
+# the cross-reference section gives the offset of each object needed:
+#
+#   xref table    "xref", then subsections of fixed 20 byte entries, then
+#                 "trailer" and the trailer dictionary. The entry of an
+#                 object is found by arithmetic, so only the subsection
+#                 headers and the entries actually used are read.
+#   xref stream   (PDF 1.5) a stream object whose dictionary is the trailer,
+#                 holding binary entries; objects may be stored compressed
+#                 inside object streams.
+#
+# Incrementally updated files have a chain of sections linked by /Prev;
+# older sections are only loaded when an object is not found in the newer
+# ones. A PDF of hundreds of MB costs a handful of small reads.
+#
+# Only FlateDecode streams (with or without a PNG predictor) are decoded.
+# Encrypted documents (a trailer with /Encrypt) have their strings
+# encrypted too, so only the PDF version is reported for them.
+
+from __future__ import with_statement
+from collections import namedtuple
+import datetime, re, zlib
+
+from lxml import etree
+
+from biblio.metadata              import Metadata, EbookMetadata, Storage
+from biblio.identifiers.filetypes import PDF
+from biblio.parsers               import ParserException, parser
+from biblio.parsers.file          import read_file_metadata
+from biblio.util.iopolicy         import open_header
+
+##############################################################################
+
+class PDFException (ParserException):
+    pass
+
+PDF_TAIL_SIZE     = 1024
+PDF_CHUNK_SIZE    = 1024
+PDF_MAX_OBJECT    = 1024 * 1024
+PDF_MAX_SECTIONS  = 64
+
+WHITESPACE = '\x00\t\n\x0c\r '
+DELIMITERS = '()<>[]{}/%'
+
+TOKEN_PATTERN     = re.compile(r'[^\x00\t\n\x0c\r ()<>\[\]{}/%]+')
+REF_PATTERN       = re.compile(r'\s+(\d+)\s+R(?![^\x00\t\n\x0c\r ()<>\[\]{}/%])')
+OBJ_PATTERN       = re.compile(r'\s*(\d+)\s+(\d+)\s+obj')
+STRING_SPECIALS   = re.compile(r'[\\()]')
+NUMBER_PATTERN    = re.compile(r'[+-]?(\d+\.?\d*|\.\d+)$')
+SUBSECTION_PATTERN = re.compile(r'\s*(\d+)\s+(\d+)[ \t]*(\r\n|\n|\r)')
+ENTRY_PATTERN     = re.compile(r'(\d{10}) (\d{5}) ([nf])')
+DATE_PATTERN      = re.compile(r'(?:D:)?(\d{4})(\d{2})?(\d{2})?')
+
+STRING_ESCAPES = { 'n':'\n', 'r':'\r', 't':'\t', 'b':'\b', 'f':'\f', '(':'(', ')':')', '\\':'\\' }
+
+class pdf_name (str):
+    pass
+
+class pdf_keyword (str):
+    pass
+
+pdf_ref = namedtuple('pdf_ref', 'num gen')
+
+class _Truncated (Exception):
+    pass
+
+##############################################################################
+
+# Objects
+#
+# Parses one object out of a buffer holding part of the file. If the buffer
+# ends inside the object (and is not the end of the file) _Truncated is
+# raised, and the caller retries with a bigger buffer.
+
+class _ObjectParser (object):
+
+    def __init__ (self, data, eof=False):
+        self.data = data
+        self.eof = eof
+
+    def _more (self):
+        raise _Truncated()
+
+    def skip_space (self, pos):
+        data, n = self.data, len(self.data)
+        while pos < n:
+            c = data[pos]
+            if c in WHITESPACE:
+                pos += 1
+            elif c == '%':
+                while pos < n and data[pos] not in '\r\n':
+                    pos += 1
+            else:
+                break
+        return pos
+
+    def parse (self, pos):
+        data = self.data
+        pos = self.skip_space(pos)
+        if pos >= len(data):
+            self._more()
+        c = data[pos]
+
+        if c == '/':
+            m = TOKEN_PATTERN.match(data, pos + 1)
+            end = m.end() if m else pos + 1
+            if end == len(data) and not self.eof:
+                self._more()
+            name = data[pos+1:end]
+            if '#' in name:
+                name = re.sub(r'#([0-9A-Fa-f]{2})', lambda m: chr(int(m.group(1), 16)), name)
+            return pdf_name(name), end
+
+        if c == '<':
+            if data[pos+1:pos+2] == '<':
+                return self._parse_dict(pos + 2)
+            end = data.find('>', pos)
+            if end < 0:
+                self._more()
+            digits = re.sub(r'[^0-9A-Fa-f]', '', data[pos+1:end])
+            if len(digits) % 2:
+                digits += '0'
+            return digits.decode('hex'), end + 1
+
+        if c == '[':
+            items = []
+            pos += 1
+            while True:
+                pos = self.skip_space(pos)
+                if pos >= len(data):
+                    self._more()
+                if data[pos] == ']':
+                    return items, pos + 1
+                value, pos = self.parse(pos)
+                items.append(value)
+
+        if c == '(':
+            return self._parse_string(pos + 1)
+
+        m = TOKEN_PATTERN.match(data, pos)
+        if m is None:
+            raise PDFException('unexpected %r in object' % c)
+        token, end = m.group(), m.end()
+        if end == len(data) and not self.eof:
+            self._more()
+
+        if token.isdigit():
+            if len(data) - end < 16 and not self.eof:
+                self._more()
+            m = REF_PATTERN.match(data, end)
+            if m is not None:
+                return pdf_ref(int(token), int(m.group(1))), m.end()
+            return int(token), end
+        if NUMBER_PATTERN.match(token):
+            return (float(token) if '.' in token else int(token)), end
+        if token == 'true':
+            return True, end
+        if token == 'false':
+            return False, end
+        if token == 'null':
+            return None, end
+        return pdf_keyword(token), end
+
+    def _parse_dict (self, pos):
+        data = self.data
+        result = {}
+        while True:
+            pos = self.skip_space(pos)
+            if pos + 1 >= len(data):
+                self._more()
+            if data[pos:pos+2] == '>>':
+                return result, pos + 2
+            key, pos = self.parse(pos)
+            value, pos = self.parse(pos)
+            if isinstance(key, pdf_name):
+                result[str(key)] = value
+
+    def _parse_string (self, pos):
+        data = self.data
+        out = []
+        depth = 1
+        while True:
+            m = STRING_SPECIALS.search(data, pos)
+            if m is None:
+                self._more()
+            out.append(data[pos:m.start()])
+            pos = m.start()
+            c = data[pos]
+            if c == '(':
+                depth += 1
+                out.append(c)
+                pos += 1
+            elif c == ')':
+                depth -= 1
+                if depth == 0:
+                    return ''.join(out), pos + 1
+                out.append(c)
+                pos += 1
+            else:
+                if pos + 1 >= len(data):
+                    self._more()
+                e = data[pos+1]
+                if e in STRING_ESCAPES:
+                    out.append(STRING_ESCAPES[e])
+                    pos += 2
+                elif e in '01234567':
+                    octal = re.match(r'[0-7]{1,3}', data[pos+1:pos+4]).group()
+                    out.append(chr(int(octal, 8) & 0xff))
+                    pos += 1 + len(octal)
+                elif e == '\r':
+                    pos += 3 if data[pos+2:pos+3] == '\n' else 2
+                elif e == '\n':
+                    pos += 2
+                else:
+                    out.append(e)
+                    pos += 2
+
+##############################################################################
+
+def _png_unpredict (data, columns):
+    rowsize = columns + 1
+    previous = bytearray(columns)
+    out = []
+    for start in xrange(0, len(data) - rowsize + 1, rowsize):
+        kind = ord(data[start])
+        row = bytearray(data[start+1:start+rowsize])
+        if kind == 1:
+            for i in xrange(1, columns):
+                row[i] = (row[i] + row[i-1]) & 0xff
+        elif kind == 2:
+            for i in xrange(columns):
+                row[i] = (row[i] + previous[i]) & 0xff
+        elif kind == 3:
+            for i in xrange(columns):
+                left = row[i-1] if i else 0
+                row[i] = (row[i] + ((left + previous[i]) >> 1)) & 0xff
+        elif kind == 4:
+            for i in xrange(columns):
+                a = row[i-1] if i else 0
+                b = previous[i]
+                c = previous[i-1] if i else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                row[i] = (row[i] + (a if pa <= pb and pa <= pc else b if pb <= pc else c)) & 0xff
+        out.append(str(row))
+        previous = row
+    return ''.join(out)
+
+def _decode_stream (info, data):
+    filters = info.get('Filter')
+    params = info.get('DecodeParms')
+    if filters is None:
+        return data
+    if not isinstance(filters, list):
+        filters, params = [ filters, ], [ params, ]
+    elif not isinstance(params, list):
+        params = [ params, ] * len(filters)
+
+    for name, param in zip(filters, params):
+        if name not in ('FlateDecode', 'Fl'):
+            raise PDFException('unsupported stream filter: %s' % name)
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(data)
+        if isinstance(param, dict) and param.get('Predictor', 1) >= 10:
+            data = _png_unpredict(data, param.get('Columns', 1))
+    return data
+
+##############################################################################
+
+class _XRefTable (object):
+
+    def __init__ (self, document, offset):
+        self.document = document
+        self.subsections = []
+
+        pos = offset + 4
+        while True:
+            head = document.read_at(pos, 64)
+            start = len(head) - len(head.lstrip(WHITESPACE))
+            if head[start:start+7] == 'trailer':
+                self.trailer, end = document.parse_at(pos + start + 7)
+                break
+            m = SUBSECTION_PATTERN.match(head)
+            if m is None:
+                raise PDFException('bad xref table at %d' % pos)
+            first, count = int(m.group(1)), int(m.group(2))
+            self.subsections.append((first, count, pos + m.end()))
+            pos += m.end() + 20 * count
+
+    def lookup (self, num):
+        for first, count, base in self.subsections:
+            if first <= num < first + count:
+                m = ENTRY_PATTERN.match(self.document.read_at(base + 20 * (num - first), 20))
+                if m is None or m.group(3) == 'f':
+                    return None
+                return (1, int(m.group(1)), int(m.group(2)))
+        raise KeyError(num)
+
+class _XRefStream (object):
+
+    def __init__ (self, document, offset):
+        info, data = document.stream_at(offset)
+        if info.get('Type') != 'XRef':
+            raise PDFException('bad xref stream at %d' % offset)
+        self.trailer = info
+
+        widths = info['W']
+        index = info.get('Index', [ 0, info['Size'] ])
+        rowsize = sum(widths)
+        self.entries = {}
+        pos = 0
+        for first, count in zip(index[0::2], index[1::2]):
+            for num in xrange(first, first + count):
+                row = data[pos:pos+rowsize]
+                pos += rowsize
+                if len(row) < rowsize:
+                    break
+                fields = []
+                start = 0
+                for width in widths:
+                    value = 0
+                    for byte in row[start:start+width]:
+                        value = (value << 8) | ord(byte)
+                    fields.append(value)
+                    start += width
+                if widths[0] == 0:
+                    fields[0] = 1
+                self.entries[num] = tuple(fields)
+
+    def lookup (self, num):
+        entry = self.entries[num]
+        if entry[0] not in (1, 2):
+            return None
+        return entry
+
+class _PDFDocument (object):
+
+    def __init__ (self, stream):
+        self.stream = stream
+        stream.seek(0, 2)
+        self.size = stream.tell()
+        self.sections = []
+        self.objects = {}
+        self.object_streams = {}
+
+        tail = self.read_at(max(0, self.size - PDF_TAIL_SIZE), PDF_TAIL_SIZE)
+        m = re.search(r'startxref\s+(\d+)', tail[tail.rfind('startxref'):] if 'startxref' in tail else '')
+        if m is None:
+            raise PDFException('missing startxref')
+        self.next_section = int(m.group(1))
+
+        self.trailer = {}
+        self._load_section()
+        while self.next_section is not None and \
+              any(key not in self.trailer for key in ('Info', 'Root')):
+            self._load_section()
+
+    def read_at (self, offset, size):
+        self.stream.seek(offset)
+        return self.stream.read(size)
+
+    def parse_at (self, offset):
+        size = PDF_CHUNK_SIZE
+        while True:
+            data = self.read_at(offset, size)
+            try:
+                return _ObjectParser(data, eof=offset + len(data) >= self.size).parse(0)
+            except _Truncated:
+                if size >= PDF_MAX_OBJECT:
+                    raise PDFException('object at %d is too large' % offset)
+                size *= 4
+
+    def object_at (self, offset):
+        head = self.read_at(offset, 32)
+        m = OBJ_PATTERN.match(head)
+        if m is None:
+            raise PDFException('no object at %d' % offset)
+        value, end = self.parse_at(offset + m.end())
+        return value, offset + m.end() + end
+
+    def stream_at (self, offset):
+        info, end = self.object_at(offset)
+        if not isinstance(info, dict):
+            raise PDFException('no stream at %d' % offset)
+        head = self.read_at(end, 32)
+        start = len(head) - len(head.lstrip(WHITESPACE))
+        if head[start:start+6] != 'stream':
+            raise PDFException('no stream at %d' % offset)
+        start += 6
+        if head[start:start+2] == '\r\n':
+            start += 2
+        elif head[start:start+1] in '\r\n':
+            start += 1
+        length = self.resolve(info.get('Length'))
+        if not isinstance(length, (int, long)):
+            raise PDFException('bad stream length at %d' % offset)
+        return info, _decode_stream(info, self.read_at(end + start, length))
+
+    def _load_section (self):
+        offset, self.next_section = self.next_section, None
+        if len(self.sections) >= PDF_MAX_SECTIONS:
+            return
+        if self.read_at(offset, 4) == 'xref':
+            section = _XRefTable(self, offset)
+        else:
+            section = _XRefStream(self, offset)
+        self.sections.append(section)
+
+        # Hybrid files: the table is followed by a stream holding the
+        # objects that are stored compressed
+        if isinstance(section.trailer.get('XRefStm'), (int, long)):
+            self.sections.append(_XRefStream(self, section.trailer['XRefStm']))
+
+        for key, value in section.trailer.iteritems():
+            self.trailer.setdefault(key, value)
+        if isinstance(section.trailer.get('Prev'), (int, long)):
+            self.next_section = section.trailer['Prev']
+
+    def _lookup (self, num):
+        n = 0
+        while True:
+            while n < len(self.sections):
+                try:
+                    return self.sections[n].lookup(num)
+                except KeyError:
+                    n += 1
+            if self.next_section is None:
+                return None
+            self._load_section()
+
+    def get_object (self, num):
+        if num in self.objects:
+            return self.objects[num]
+        entry = self._lookup(num)
+        if entry is None:
+            value = None
+        elif entry[0] == 1:
+            value, end = self.object_at(entry[1])
+        else:
+            value = self._compressed_object(entry[1], entry[2])
+        self.objects[num] = value
+        return value
+
+    def get_stream (self, ref):
+        entry = self._lookup(ref.num) if isinstance(ref, pdf_ref) else None
+        if entry is None or entry[0] != 1:
+            return None
+        return self.stream_at(entry[1])[1]
+
+    def _compressed_object (self, objstm, index):
+        if objstm not in self.object_streams:
+            entry = self._lookup(objstm)
+            if entry is None or entry[0] != 1:
+                raise PDFException('missing object stream %d' % objstm)
+            info, data = self.stream_at(entry[1])
+            header = data[:info['First']].split()
+            offsets = [ int(header[i]) + info['First'] for i in xrange(1, len(header), 2) ]
+            self.object_streams[objstm] = (offsets, data)
+        offsets, data = self.object_streams[objstm]
+        if index >= len(offsets):
+            return None
+        return _ObjectParser(data, eof=True).parse(offsets[index])[0]
+
+    def resolve (self, value, depth=0):
+        while isinstance(value, pdf_ref) and depth < 32:
+            value = self.get_object(value.num)
+            depth += 1
+        return value
+
+##############################################################################
+
+def read_pdf_metadata (filename, metadata=None):
+    if metadata is None:
+        metadata = Metadata(PDF)
+    read_file_metadata(filename, metadata)
+
+    with open_header(filename) as stream:
+        metadata.pdf = _parse_pdf(stream)
+
+    return metadata
+
+def _parse_pdf (stream):
+    pdf = Storage()
+    head = stream.read(16)
+    m = re.match(r'%PDF-(\d+\.\d+)', head)
+    pdf.version = m.group(1) if m else None
+
+    try:
+        _parse_document(_PDFDocument(stream), pdf)
+    except (KeyError, IndexError, TypeError, ValueError, AttributeError, zlib.error), e:
+        raise PDFException('bad PDF structure: %s' % e)
+    return pdf
+
+def _parse_document (document, pdf):
+    if 'Encrypt' in document.trailer:
+        pdf.encrypted = True
+        return
+    pdf.encrypted = False
+
+    info = document.resolve(document.trailer.get('Info'))
+    if isinstance(info, dict):
+        pdf.info = {}
+        for key, value in info.iteritems():
+            value = document.resolve(value)
+            if isinstance(value, str) and not isinstance(value, (pdf_name, pdf_keyword)):
+                pdf.info[key] = decode_pdf_string(value)
+
+    catalog = document.resolve(document.trailer.get('Root'))
+    if isinstance(catalog, dict) and 'Metadata' in catalog:
+        try:
+            xmp = document.get_stream(catalog['Metadata'])
+        except (PDFException, KeyError, TypeError, ValueError, zlib.error):
+            xmp = None
+        if xmp:
+            pdf.xmp = parse_xmp(xmp)
+
+##############################################################################
+
+# Text strings are either UTF-16BE with a byte order mark, or in
+# PDFDocEncoding, which matches Latin-1 apart from a few punctuation
+# characters in the 0x18-0x1f and 0x80-0xa0 ranges.
+
+PDFDOC_SPECIALS = { 0x18:0x02d8, 0x19:0x02c7, 0x1a:0x02c6, 0x1b:0x02d9,
+                    0x1c:0x02dd, 0x1d:0x02db, 0x1e:0x02da, 0x1f:0x02dc,
+                    0x80:0x2022, 0x81:0x2020, 0x82:0x2021, 0x83:0x2026,
+                    0x84:0x2014, 0x85:0x2013, 0x86:0x0192, 0x87:0x2044,
+                    0x88:0x2039, 0x89:0x203a, 0x8a:0x2212, 0x8b:0x2030,
+                    0x8c:0x201e, 0x8d:0x201c, 0x8e:0x201d, 0x8f:0x2018,
+                    0x90:0x2019, 0x91:0x201a, 0x92:0x2122, 0x93:0xfb01,
+                    0x94:0xfb02, 0x95:0x0141, 0x96:0x0152, 0x97:0x0160,
+                    0x98:0x0178, 0x99:0x017d, 0x9a:0x0131, 0x9b:0x0142,
+                    0x9c:0x0153, 0x9d:0x0161, 0x9e:0x017e, 0xa0:0x20ac,
+                  }
+
+def decode_pdf_string (value):
+    if value.startswith('\xfe\xff'):
+        return value[2:].decode('utf-16-be', 'replace')
+    if value.startswith('\xef\xbb\xbf'):
+        return value[3:].decode('utf-8', 'replace')
+    return value.decode('latin-1').translate(PDFDOC_SPECIALS)
+
+def parse_pdf_date (value):
+    m = DATE_PATTERN.match(value.strip())
+    if m is None:
+        return None
+    try:
+        return datetime.date(int(m.group(1)), int(m.group(2) or 1), int(m.group(3) or 1))
+    except ValueError:
+        return None
+
+##############################################################################
+
+# XMP
+#
+# Only the Dublin Core properties and a couple of PDF/XMP ones are kept,
+# as lists of strings keyed by property name. Properties can be elements
+# (with rdf:Alt/Bag/Seq lists of rdf:li values) or, in the abbreviated
+# syntax, attributes of rdf:Description.
+
+RDF = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+XMP_PROPERTIES = { '{http://purl.org/dc/elements/1.1/}title'       : 'title',
+                   '{http://purl.org/dc/elements/1.1/}creator'     : 'creator',
+                   '{http://purl.org/dc/elements/1.1/}description' : 'description',
+                   '{http://purl.org/dc/elements/1.1/}subject'     : 'subject',
+                   '{http://purl.org/dc/elements/1.1/}publisher'   : 'publisher',
+                   '{http://purl.org/dc/elements/1.1/}rights'      : 'rights',
+                   '{http://purl.org/dc/elements/1.1/}language'    : 'language',
+                   '{http://purl.org/dc/elements/1.1/}date'        : 'date',
+                   '{http://purl.org/dc/elements/1.1/}identifier'  : 'identifier',
+                   '{http://ns.adobe.com/xap/1.0/}CreateDate'      : 'create_date',
+                   '{http://ns.adobe.com/pdf/1.3/}Keywords'        : 'keywords',
+                 }
+
+def parse_xmp (rawxml):
+    try:
+        root = etree.fromstring(rawxml.strip(), etree.XMLParser(recover=True, resolve_entities=False))
+    except etree.XMLSyntaxError:
+        return {}
+    if root is None:
+        return {}
+
+    xmp = {}
+    for description in root.iter(RDF + 'Description'):
+        for key, value in description.attrib.iteritems():
+            if key in XMP_PROPERTIES and value.strip():
+                xmp.setdefault(XMP_PROPERTIES[key], []).append(value.strip())
+        for child in description:
+            if child.tag not in XMP_PROPERTIES:
+                continue
+            items = [ li.text for li in child.iter(RDF + 'li') ] or [ child.text ]
+            values = [ v.strip() for v in items if v and v.strip() ]
+            if values:
+                xmp.setdefault(XMP_PROPERTIES[child.tag], []).extend(values)
+    return xmp
+
+##############################################################################
+
+ISBN_PATTERN = re.compile(r'(?:urn:)?isbn:?\s*([0-9Xx-]{10,17})$', re.I)
+
+def process_pdf_metadata (metadata):
+    ebook = EbookMetadata(metadata.filetype)
+
+    if 'pdf' not in metadata:
+        return ebook
+    info = metadata.pdf.get('info', {})
+    xmp = metadata.pdf.get('xmp', {})
+
+    from biblio.ebook import parse_ebook_authors
+
+    title = xmp.get('title', [ info.get('Title') ])[0]
+    if title and title.strip():
+        ebook.title = title.strip()
+
+    if 'creator' in xmp:
+        ebook.authors = xmp['creator']
+    elif info.get('Author'):
+        ebook.authors = parse_ebook_authors(info['Author'])
+
+    description = xmp.get('description', [ info.get('Subject') ])[0]
+    if description and description.strip():
+        ebook.description = description.strip()
+
+    tags = xmp.get('subject')
+    if not tags:
+        keywords = xmp.get('keywords', [ info.get('Keywords') ])[0]
+        if keywords:
+            tags = [ t.strip() for t in re.split(r'[;,]', keywords) ]
+    if tags:
+        ebook.tags = [ t for t in tags if t ]
+
+    if 'publisher' in xmp:
+        ebook.publisher = xmp['publisher'][0]
+    if 'rights' in xmp:
+        ebook.rights = xmp['rights'][0]
+    if 'language' in xmp:
+        ebook.languages = xmp['language']
+
+    for identifier in xmp.get('identifier', ()):
+        m = ISBN_PATTERN.match(identifier)
+        if m is not None:
+            ebook.identifiers = { 'isbn': m.group(1).replace('-', '') }
+            break
+
+    for date in xmp.get('date', []) + xmp.get('create_date', []) + [ info.get('CreationDate') ]:
+        if date:
+            date = parse_pdf_date(date.replace('-', ''))
+            if date is not None:
+                ebook.date_published = date
+                break
+
+    return ebook
+
+##############################################################################
+
+def initialize_parser ():
+    return parser(filetype=PDF, reader=read_pdf_metadata, writer=None, processor=process_pdf_metadata)
+
+##############################################################################
+## THE END
@@ -0,0 +1,214 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# BULK SCANNING
+#
+# When scanning a large library the order in which files are visited
+# matters far more than the cost of parsing any one of them. On spinning
+# disks and network filesystems, visiting files in directory-listing order
+# makes the disk head jump all over the platter. Visiting them in inode
+# order (or, better, in order of their first physical extent) keeps the
+# reads mostly sequential.
+#
+# The scanner first collects a scan_entry for every candidate file, hands
+# the list to an ordering function and then identifies and parses the
+# files in the order returned. Orderings are plain callables taking and
+# returning a list of scan_entry tuples, so callers can supply their own.
+#
+# With archives set, ZIP and TAR archives are scanned too, and the books
+# inside them are reported under their "archive.zip!/member" names (see
+# biblio.archive). They are read in place, and never extracted to disk.
+
+from __future__ import with_statement
+from collections import namedtuple
+import os, stat, struct
+
+from biblio.archive               import scan_archive
+from biblio.ebook                 import ebook_metadata
+from biblio.identifiers           import identify_file
+from biblio.identifiers.filetypes import is_archive
+
+__all__ = [ 'scan_entry', 'scan_ebooks', 'collect_scan_entries',
+            'order_scan_entries', 'add_scan_order', 'SMALL_FILE_SIZE', ]
+
+##############################################################################
+
+class ScanException (Exception):
+    pass
+
+scan_entry = namedtuple('scan_entry', 'path dev inode size')
+
+SMALL_FILE_SIZE = 256 * 1024
+
+##############################################################################
+
+def collect_scan_entries (paths, recursive=True):
+    if isinstance(paths, basestring):
+        paths = [ paths, ]
+
+    entries = []
+    for path in paths:
+        if os.path.isdir(path):
+            if recursive:
+                for dirpath, dirnames, filenames in os.walk(path):
+                    for name in filenames:
+                        _append_scan_entry(entries, os.path.join(dirpath, name))
+            else:
+                for name in os.listdir(path):
+                    _append_scan_entry(entries, os.path.join(path, name))
+        else:
+            _append_scan_entry(entries, path)
+    return entries
+
+def _append_scan_entry (entries, path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    if not stat.S_ISREG(st.st_mode):
+        return
+    entries.append(scan_entry(path=path, dev=st.st_dev, inode=st.st_ino, size=st.st_size))
+
+##############################################################################
+
+# Orderings
+
+def order_none (entries):
+    return list(entries)
+
+def order_by_inode (entries):
+    return sorted(entries, key=lambda e: (e.dev, e.inode))
+
+def order_by_directory (entries):
+    # Group files by directory, visit the directories in the order of their
+    # lowest inode, and visit the files within a directory by inode.
+    groups = {}
+    for entry in entries:
+        groups.setdefault(os.path.dirname(entry.path), []).append(entry)
+    for group in groups.itervalues():
+        group.sort(key=lambda e: (e.dev, e.inode))
+    ordered = []
+    for group in sorted(groups.itervalues(), key=lambda g: (g[0].dev, g[0].inode)):
+        ordered.extend(group)
+    return ordered
+
+def order_by_extent (entries):
+    # Order by the physical location of the first extent of each file, as
+    # reported by the Linux FIEMAP ioctl. Files for which no extent can be
+    # found (other platforms, filesystems without FIEMAP, empty or inline
+    # files) are placed after the mapped ones in inode order.
+    mapped = []
+    unmapped = []
+    for entry in entries:
+        physical = _first_physical_extent(entry.path)
+        if physical is None:
+            unmapped.append(entry)
+        else:
+            mapped.append((entry.dev, physical, entry))
+    mapped.sort(key=lambda m: m[:2])
+    return [ m[2] for m in mapped ] + order_by_inode(unmapped)
+
+FS_IOC_FIEMAP   = 0xC020660B
+FIEMAP_HEADER   = '=QQLLLL'
+FIEMAP_EXTENT   = '=QQQQQLLLL'
+
+def _first_physical_extent (path):
+    try:
+        import fcntl
+    except ImportError:
+        return None
+
+    request = struct.pack(FIEMAP_HEADER, 0, 0xffffffffffffffff, 0, 0, 1, 0) + \
+              '\0' * struct.calcsize(FIEMAP_EXTENT)
+    try:
+        with open(path, 'rb') as stream:
+            response = fcntl.ioctl(stream.fileno(), FS_IOC_FIEMAP, request)
+    except (IOError, OSError):
+        return None
+
+    mapped_extents = struct.unpack_from(FIEMAP_HEADER, response)[3]
+    if mapped_extents < 1:
+        return None
+    return struct.unpack_from(FIEMAP_EXTENT, response, struct.calcsize(FIEMAP_HEADER))[1]
+
+SCAN_ORDERS = { None        : order_none,
+                'none'      : order_none,
+                'inode'     : order_by_inode,
+                'directory' : order_by_directory,
+                'extent'    : order_by_extent,
+              }
+
+def add_scan_order (name, ordering):
+    if not callable(ordering):
+        raise ScanException('scan ordering must be callable: %r' % ordering)
+    SCAN_ORDERS[name] = ordering
+
+def order_scan_entries (entries, order=None, small_first=False):
+    if callable(order):
+        ordering = order
+    else:
+        try:
+            ordering = SCAN_ORDERS[order]
+        except KeyError:
+            raise ScanException('Unknown scan ordering: %s' % order)
+
+    ordered = ordering(entries)
+
+    if small_first:
+        if small_first is True:
+            small_first = SMALL_FILE_SIZE
+        ordered = [ e for e in ordered if e.size <= small_first ] + \
+                  [ e for e in ordered if e.size >  small_first ]
+    return ordered
+
+##############################################################################
+
+def _ebook_metadata (path, onerror, **options):
+    try:
+        return ebook_metadata(path, **options)
+    except Exception, e:
+        if onerror is not None:
+            onerror(path, e)
+        return None
+
+def scan_ebooks (paths, order='inode', small_first=False, recursive=True, hint=False,
+                 cache=None, archives=False, onerror=None):
+    """
+    Yields (path, ebook metadata) for every file found under paths, with
+    None for files that are not books. A file whose parser fails is also
+    yielded with None, after onerror(path, exception) is called if given,
+    and the scan carries on with the next file. Books inside archives are
+    handled the same way (see biblio.archive.scan_archive).
+    """
+    entries = collect_scan_entries(paths, recursive=recursive)
+    for entry in order_scan_entries(entries, order=order, small_first=small_first):
+        if archives:
+            try:
+                filetype = identify_file(entry.path, hint=hint)
+            except Exception:
+                filetype = None             # reported by _ebook_metadata() below
+            if filetype is not None and is_archive(filetype):
+                try:
+                    for result in scan_archive(entry.path, hint=hint, filetype=filetype, onerror=onerror):
+                        yield result
+                except Exception, e:
+                    if onerror is not None:
+                        onerror(entry.path, e)
+                continue
+        yield entry.path, _ebook_metadata(entry.path, onerror, hint=hint, cache=cache)
+
+##############################################################################
+## THE END
@@ -0,0 +1,373 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# COMPACT METADATA RECORDS
+#
+# A compact, versioned binary encoding of EbookMetadata, used to move
+# metadata between processes and into on-disk caches without the size and
+# cost of pickling dict subclasses, dates and filetype namedtuples.
+#
+# Multi-byte numeric fields are stored big-endian.
+#
+# Offset Bytes Field                Comments
+# ------ ----- -------------------- -------------------------------------------
+# 00     2     Magic                the characters 'B' 'M'
+# 02     1     Version              record format version, currently 1
+# 03     1     Filetype id          index in FILETYPE_TABLE. 0 = not in table
+# 04     4     Record length        length of the whole record, this header included
+# 08     2     String count         number of entries in the string table
+# 10     1     Field count          number of fields following the string table
+# --------------------------------
+# string table                      repeat string count times
+# --------------------------------
+# 4      Length                     byte length. bit 31 set for unicode strings
+# L      Data                       the bytes (utf-8 encoded for unicode strings)
+# --------------------------------
+# fields                            repeat field count times
+# --------------------------------
+# 1      Field id                   index in EbookMetadata._fields.
+#                                   0xff = filetype, for filetypes not in the table
+# 1      Value type                 see below
+# ?      Value
+#
+# Value types:
+#  'n'  None                        no data
+#  's'  string                      2 byte string table index
+#  'l'  list of strings             2 byte count, then 2 byte index per item
+#  'm'  string to string map        2 byte count, then 2+2 byte index per pair
+#  'd'  date                        4 byte proleptic gregorian ordinal
+#  't'  datetime                    1 byte flag (1 = UTC aware), 8 byte
+#                                   microseconds since 1970-01-01
+#  'f'  float                       8 byte IEEE double
+#  'i'  integer                     8 byte signed integer
+#  'F'  filetype                    2 byte indexes of type, mimetype and description
+#
+# Every string (title, authors, identifier values, ...) is stored once in the
+# string table and referenced by index, so repeated names cost two bytes.
+#
+# MetadataRecord reads fields straight out of the buffer it is given (a str,
+# bytearray or mmap) without slicing it, so a file of concatenated records
+# can be walked with iter_metadata_records() and only the fields actually
+# asked for are decoded.
+
+from datetime import date, datetime, timedelta
+import struct
+
+from dateutil.tz import tzutc
+
+from biblio.identifiers.filetypes import *
+from biblio.metadata              import EbookMetadata
+
+__all__ = [ 'encode_metadata', 'decode_metadata', 'MetadataRecord',
+            'iter_metadata_records', 'is_metadata_record', 'SerializationError', ]
+
+##############################################################################
+
+class SerializationError (Exception):
+    pass
+
+RECORD_MAGIC   = 'BM'
+RECORD_VERSION = 1
+
+RECORD_HEADER      = '>2sBBLHB'
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER)
+
+FILETYPE_FIELD = 0xff
+UNICODE_FLAG   = 0x80000000
+
+# Interned filetypes. The position in this table is stored in every record,
+# so new filetypes must only ever be appended.
+FILETYPE_TABLE = ( None,
+                   EPUB2, EPUB3, LIT, MOBI,
+                   PDB_EREADER, PDB_GUTENPALM, PDB_PALMDOC, PDB_PLUCKER,
+                   OPF2, PDF, HTML, XHTML, XML,
+                 )
+FILETYPE_IDS = dict((ft, n) for n, ft in enumerate(FILETYPE_TABLE) if ft is not None)
+
+FIELD_IDS = dict((name, n) for n, name in enumerate(EbookMetadata._fields))
+
+EPOCH = datetime(1970, 1, 1)
+
+##############################################################################
+
+def encode_metadata (metadata):
+    strings = []
+    string_ids = {}
+
+    def intern (s):
+        if not isinstance(s, basestring):
+            raise SerializationError('expected a string, got %r' % (s,))
+        key = (type(s) is unicode, s)
+        try:
+            return string_ids[key]
+        except KeyError:
+            if len(strings) > 0xffff:
+                raise SerializationError('too many strings for one record')
+            string_ids[key] = len(strings)
+            strings.append(s)
+            return string_ids[key]
+
+    fields = []
+    ftype = metadata.filetype
+    filetype_id = FILETYPE_IDS.get(ftype, 0)
+    if filetype_id == 0 and ftype is not None:
+        fields.append(struct.pack('>BcHHH', FILETYPE_FIELD, 'F', intern(ftype.type),
+                                  intern(ftype.mimetype), intern(ftype.description)))
+
+    for name, value in metadata.iteritems():
+        if name == 'filetype':
+            continue
+        try:
+            field_id = FIELD_IDS[name]
+        except KeyError:
+            raise SerializationError("'%s' is not an ebook metadata field" % name)
+
+        if value is None:
+            fields.append(struct.pack('>Bc', field_id, 'n'))
+        elif isinstance(value, basestring):
+            fields.append(struct.pack('>BcH', field_id, 's', intern(value)))
+        elif isinstance(value, (list, tuple)):
+            ids = [ intern(v) for v in value ]
+            fields.append(struct.pack('>BcH%dH' % len(ids), field_id, 'l', len(ids), *ids))
+        elif isinstance(value, dict):
+            ids = []
+            for k, v in value.iteritems():
+                ids.append(intern(k))
+                ids.append(intern(v))
+            fields.append(struct.pack('>BcH%dH' % len(ids), field_id, 'm', len(value), *ids))
+        elif isinstance(value, datetime):
+            aware = value.tzinfo is not None
+            if aware:
+                value = value.astimezone(tzutc()).replace(tzinfo=None)
+            delta = value - EPOCH
+            micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+            fields.append(struct.pack('>BcBq', field_id, 't', aware, micros))
+        elif isinstance(value, date):
+            fields.append(struct.pack('>BcL', field_id, 'd', value.toordinal()))
+        elif isinstance(value, float):
+            fields.append(struct.pack('>Bcd', field_id, 'f', value))
+        elif isinstance(value, (int, long)):
+            fields.append(struct.pack('>Bcq', field_id, 'i', value))
+        else:
+            raise SerializationError('cannot encode %s value %r' % (name, value))
+
+    table = []
+    for s in strings:
+        if type(s) is unicode:
+            raw = s.encode('utf-8')
+            table.append(struct.pack('>L', len(raw) | UNICODE_FLAG))
+        else:
+            raw = s
+            table.append(struct.pack('>L', len(raw)))
+        table.append(raw)
+
+    body = ''.join(table) + ''.join(fields)
+    header = struct.pack(RECORD_HEADER, RECORD_MAGIC, RECORD_VERSION, filetype_id,
+                         RECORD_HEADER_SIZE + len(body), len(strings), len(fields))
+    return header + body
+
+def decode_metadata (buf, offset=0):
+    # A single straight pass over the record. MetadataRecord is the lazy
+    # alternative when only some of the fields are needed.
+    unpack_from = struct.unpack_from
+    magic, version, filetype_id, length, string_count, field_count = \
+        unpack_from(RECORD_HEADER, buf, offset)
+    if magic != RECORD_MAGIC:
+        raise SerializationError('not a metadata record')
+    if version != RECORD_VERSION:
+        raise SerializationError('unsupported metadata record version %d' % version)
+
+    pos = offset + RECORD_HEADER_SIZE
+    strings = []
+    for n in xrange(string_count):
+        size, = unpack_from('>L', buf, pos)
+        pos += 4
+        if size & UNICODE_FLAG:
+            size &= ~UNICODE_FLAG
+            strings.append(str(buf[pos:pos+size]).decode('utf-8'))
+        else:
+            strings.append(str(buf[pos:pos+size]))
+        pos += size
+
+    metadata = EbookMetadata(FILETYPE_TABLE[filetype_id])
+    fields = EbookMetadata._fields
+    for n in xrange(field_count):
+        field_id, typ = unpack_from('>Bc', buf, pos)
+        pos += 2
+        if typ == 's':
+            value = strings[unpack_from('>H', buf, pos)[0]]
+            pos += 2
+        elif typ == 'l':
+            count, = unpack_from('>H', buf, pos)
+            value = [ strings[i] for i in unpack_from('>%dH' % count, buf, pos + 2) ]
+            pos += 2 + 2 * count
+        elif typ == 'm':
+            count, = unpack_from('>H', buf, pos)
+            ids = unpack_from('>%dH' % (2 * count), buf, pos + 2)
+            value = dict((strings[ids[i]], strings[ids[i+1]]) for i in xrange(0, len(ids), 2))
+            pos += 2 + 4 * count
+        elif typ == 'd':
+            value = date.fromordinal(unpack_from('>L', buf, pos)[0])
+            pos += 4
+        elif typ == 'n':
+            value = None
+        elif typ == 'F':
+            value = filetype(*[ strings[i] for i in unpack_from('>HHH', buf, pos) ])
+            pos += 6
+        else:
+            value, size = _decode_scalar(typ, buf, pos)
+            pos += size
+
+        if field_id == FILETYPE_FIELD:
+            dict.__setitem__(metadata, 'filetype', value)
+        else:
+            dict.__setitem__(metadata, fields[field_id], value)
+    return metadata
+
+def _decode_scalar (typ, buf, pos):
+    if typ == 't':
+        aware, micros = struct.unpack_from('>Bq', buf, pos)
+        value = EPOCH + timedelta(microseconds=micros)
+        if aware:
+            value = value.replace(tzinfo=tzutc())
+        return value, 9
+    elif typ == 'f':
+        return struct.unpack_from('>d', buf, pos)[0], 8
+    elif typ == 'i':
+        return struct.unpack_from('>q', buf, pos)[0], 8
+    raise SerializationError('unknown value type %r' % typ)
+
+def is_metadata_record (buf, offset=0):
+    return buf[offset:offset+2] == RECORD_MAGIC
+
+##############################################################################
+
+class MetadataRecord (object):
+
+    def __init__ (self, buf, offset=0):
+        magic, version, filetype_id, length, string_count, field_count = \
+            struct.unpack_from(RECORD_HEADER, buf, offset)
+        if magic != RECORD_MAGIC:
+            raise SerializationError('not a metadata record')
+        if version != RECORD_VERSION:
+            raise SerializationError('unsupported metadata record version %d' % version)
+
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+        pos = offset + RECORD_HEADER_SIZE
+        strings = []
+        for n in xrange(string_count):
+            size, = struct.unpack_from('>L', buf, pos)
+            strings.append((pos + 4, size & ~UNICODE_FLAG, bool(size & UNICODE_FLAG)))
+            pos += 4 + (size & ~UNICODE_FLAG)
+        self._strings = strings
+        self._decoded = {}
+
+        fields = {}
+        for n in xrange(field_count):
+            field_id, typ = struct.unpack_from('>Bc', buf, pos)
+            pos += 2
+            fields[field_id] = (typ, pos)
+            if typ in ('s',):
+                pos += 2
+            elif typ == 'l':
+                pos += 2 + 2 * struct.unpack_from('>H', buf, pos)[0]
+            elif typ == 'm':
+                pos += 2 + 4 * struct.unpack_from('>H', buf, pos)[0]
+            elif typ == 'd':
+                pos += 4
+            elif typ == 't':
+                pos += 9
+            elif typ in ('f', 'i'):
+                pos += 8
+            elif typ == 'F':
+                pos += 6
+            elif typ != 'n':
+                raise SerializationError('unknown value type %r' % typ)
+        self._fields = fields
+
+        if filetype_id:
+            self.filetype = FILETYPE_TABLE[filetype_id]
+        elif FILETYPE_FIELD in fields:
+            self.filetype = filetype(*[ self._string(i) for i in
+                                        struct.unpack_from('>HHH', buf, fields[FILETYPE_FIELD][1]) ])
+        else:
+            self.filetype = None
+
+    def _string (self, index):
+        try:
+            return self._decoded[index]
+        except KeyError:
+            pos, size, is_unicode = self._strings[index]
+            s = str(self.buf[pos:pos+size])
+            if is_unicode:
+                s = s.decode('utf-8')
+            self._decoded[index] = s
+            return s
+
+    def get (self, name, default=None):
+        try:
+            typ, pos = self._fields[FIELD_IDS[name]]
+        except KeyError:
+            return default
+
+        buf = self.buf
+        if typ == 'n':
+            return None
+        elif typ == 's':
+            return self._string(struct.unpack_from('>H', buf, pos)[0])
+        elif typ == 'l':
+            count, = struct.unpack_from('>H', buf, pos)
+            return [ self._string(i) for i in struct.unpack_from('>%dH' % count, buf, pos + 2) ]
+        elif typ == 'm':
+            count, = struct.unpack_from('>H', buf, pos)
+            ids = struct.unpack_from('>%dH' % (2 * count), buf, pos + 2)
+            return dict((self._string(ids[i]), self._string(ids[i+1])) for i in xrange(0, len(ids), 2))
+        elif typ == 'd':
+            return date.fromordinal(struct.unpack_from('>L', buf, pos)[0])
+        else:
+            return _decode_scalar(typ, buf, pos)[0]
+
+    def __getitem__ (self, name):
+        if name == 'filetype':
+            return self.filetype
+        if name not in self:
+            raise KeyError(name)
+        return self.get(name)
+
+    def __contains__ (self, name):
+        return FIELD_IDS.get(name) in self._fields
+
+    def fields (self):
+        return [ name for name in EbookMetadata._fields if name in self ]
+
+    def to_metadata (self):
+        metadata = EbookMetadata(self.filetype)
+        for name in self.fields():
+            metadata[name] = self.get(name)
+        return metadata
+
+def iter_metadata_records (buf, offset=0):
+    end = len(buf)
+    while offset < end:
+        record = MetadataRecord(buf, offset)
+        yield record
+        offset += record.length
+
+##############################################################################
+## THE END
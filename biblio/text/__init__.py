@@ -0,0 +1,432 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# TEXT ACCESS
+#
+# Streaming access to the text of a book, one decompressed record at a
+# time, so that only a single record is ever held in memory. A text reader
+# is opened with open_text_reader() and exposes:
+#
+#   record_count     number of text records
+#   codec            the codec the text is encoded with
+#   record(n)        the decompressed bytes of text record n (0 based)
+#   iter_records()   every text record in turn
+#   close()
+#
+#   locate(offset)   the (record, offset in record) holding a text offset
+#   read(offset, length)
+#                    a range of the text, decompressing only the records
+#                    that cover it
+#
+# zTXT records all inflate to record_size bytes, so locating an offset is a
+# division. PalmDOC and MOBI records decompress to varying sizes (and MOBI
+# records carry trailing entries), so their readers keep a TextIndex of the
+# text offset at which each record starts. The index is extended only as
+# far as the offsets asked for, measuring records without decompressing
+# them where the compression allows it, and can be saved to a file and
+# reused for as long as the book is unchanged.
+#
+# iter_text_records() and iter_text() wrap a reader for the common case
+# of reading the whole text once, the latter yielding unicode chunks with
+# multibyte characters that straddle records decoded correctly.
+
+from __future__ import with_statement
+import bisect, codecs, os, struct, zlib
+
+from biblio.identifiers.filetypes import MOBI, PDB_PALMDOC, PDB_GUTENPALM
+from biblio.parsers               import read_metadata
+from biblio.text.huffcdic         import HuffCdicDecoder
+from biblio.text.palmdoc          import palmdoc_decompress, palmdoc_decompressed_size, \
+                                         trailing_entries_size
+from biblio.util.lru              import LRUCache
+
+__all__ = [ 'open_text_reader', 'iter_text_records', 'iter_text', 'TextException', 'TextIndex', ]
+
+##############################################################################
+
+class TextException (Exception):
+    pass
+
+COMPRESSION_NONE     = 1
+COMPRESSION_PALMDOC  = 2
+COMPRESSION_HUFFCDIC = 17480
+
+MOBI_CODECS = { 1252: 'cp1252', 65001: 'utf-8' }
+
+##############################################################################
+
+# Text index file layout: magic, version, complete flag, then the size,
+# inode and mtime of the book it was built for, the number of offsets and
+# the offsets themselves.
+
+TEXT_INDEX_MAGIC   = 'BX'
+TEXT_INDEX_VERSION = 1
+TEXT_INDEX_HEADER  = struct.Struct('>2sBBQQdL')
+
+class TextIndex (object):
+    """
+    The text offset at which each decompressed text record starts, as far
+    as it has been measured. starts[n] is the offset of record n, and the
+    last entry is the end of the last measured record. The index is
+    complete once every record has been measured.
+    """
+
+    def __init__ (self, starts=None, complete=False):
+        self.starts = starts or [ 0, ]
+        self.complete = complete
+
+    def locate (self, offset):
+        starts = self.starts
+        if not 0 <= offset < starts[-1]:
+            return None
+        n = bisect.bisect_right(starts, offset) - 1
+        return n, offset - starts[n]
+
+    def encode (self, st):
+        return TEXT_INDEX_HEADER.pack(TEXT_INDEX_MAGIC, TEXT_INDEX_VERSION, int(self.complete),
+                                      st.st_size, st.st_ino, st.st_mtime, len(self.starts)) + \
+               struct.pack('>%dL' % len(self.starts), *self.starts)
+
+    @classmethod
+    def decode (cls, data, st):
+        if len(data) < TEXT_INDEX_HEADER.size:
+            return None
+        magic, version, complete, size, inode, mtime, count = TEXT_INDEX_HEADER.unpack_from(data)
+        if magic != TEXT_INDEX_MAGIC or version != TEXT_INDEX_VERSION:
+            return None
+        if (size, inode, mtime) != (st.st_size, st.st_ino, st.st_mtime):
+            return None
+        if count == 0 or len(data) != TEXT_INDEX_HEADER.size + 4 * count:
+            return None
+        starts = list(struct.unpack_from('>%dL' % count, data, TEXT_INDEX_HEADER.size))
+        return cls(starts, bool(complete))
+
+    def save (self, path, filename):
+        data = self.encode(os.stat(filename))
+        temp = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp, 'wb') as f:
+            f.write(data)
+        os.rename(temp, path)
+
+    @classmethod
+    def load (cls, path, filename):
+        """
+        Returns the index saved at path, or None if there is none or it was
+        built for a different version of the book.
+        """
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        return cls.decode(data, os.stat(filename))
+
+##############################################################################
+
+class PDBTextReader (object):
+    """
+    Base for the readers of PDB based books, whose text records follow
+    record 0 in the PDB record table.
+    """
+
+    def raw_record (self, n):
+        offset, length = self.metadata.pdb.records[n]
+        self.stream.seek(offset)
+        return bytearray(self.stream.read(length))
+
+    def iter_records (self):
+        for n in xrange(self.record_count):
+            yield self.record(n)
+
+    def read (self, offset, length):
+        if offset < 0 or length < 0:
+            raise ValueError('negative offset or length')
+        end = min(offset + length, self.text_length)
+        chunks = []
+        while offset < end:
+            location = self.locate(offset)
+            if location is None:
+                break
+            n, start = location
+            chunk = self._record_data(n)[start:start + end - offset]
+            if not chunk:
+                break
+            chunks.append(str(chunk))
+            offset += len(chunk)
+        return ''.join(chunks)
+
+    def close (self):
+        self.stream.close()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        self.close()
+
+class PalmTextReader (PDBTextReader):
+    """
+    Text reader for PalmDOC and MOBI books. Text records follow record 0
+    in the PDB record table.
+    """
+
+    def __init__ (self, filename, metadata=None, index_path=None):
+        if metadata is None:
+            metadata = read_metadata(filename)
+        self.filename = filename
+        self.metadata = metadata
+
+        if metadata.filetype == MOBI:
+            if 'mobi' not in metadata:
+                raise TextException('MOBI file has no text header record')
+            header = metadata.mobi
+            if header.encryption:
+                raise TextException('cannot read the text of an encrypted MOBI book')
+            self.extra_flags = header.get('extra_flags', 0)
+            self.codec = MOBI_CODECS.get(header.get('text_encoding'), 'cp1252')
+        elif metadata.filetype == PDB_PALMDOC:
+            header = metadata.palmdoc
+            self.extra_flags = 0
+            self.codec = 'cp1252'
+        else:
+            raise TextException('not a PalmDOC or MOBI book')
+
+        self.compression = header.compression
+        self.text_length = header.text_length
+        self.record_size = header.record_size
+        self.record_count = min(header.record_count, len(metadata.pdb.records) - 1)
+
+        if self.compression == COMPRESSION_NONE:
+            self.decompress = bytearray
+        elif self.compression == COMPRESSION_PALMDOC:
+            self.decompress = palmdoc_decompress
+        elif self.compression == COMPRESSION_HUFFCDIC and metadata.filetype == MOBI:
+            self.decompress = self._huffcdic_decompress
+        else:
+            raise TextException('unsupported text compression: %d' % self.compression)
+
+        self.huffcdic = None
+        self.index_path = index_path
+        self._index = None
+        self._index_saved = None
+        self._last = None
+        self.stream = open(filename, 'rb')
+
+    def _huffcdic_decompress (self, raw):
+        # The HUFF/CDIC tables are loaded when the first record is read and
+        # kept for the life of the reader.
+        if self.huffcdic is None:
+            header = self.metadata.mobi
+            first = header.huffman_record
+            count = header.huffman_record_count
+            if count < 2 or first + count > len(self.metadata.pdb.records):
+                raise TextException('invalid HUFF/CDIC record range')
+            self.huffcdic = HuffCdicDecoder(self.raw_record(first),
+                                            [ self.raw_record(n) for n in xrange(first + 1, first + count) ])
+        return bytearray(self.huffcdic.decompress(raw))
+
+    def _text_record (self, n):
+        if not 0 <= n < self.record_count:
+            raise IndexError('text record %d out of range' % n)
+        raw = self.raw_record(n + 1)
+        if self.extra_flags:
+            trailing = trailing_entries_size(raw, self.extra_flags)
+            if trailing:
+                del raw[-trailing:]
+        return raw
+
+    def _record_data (self, n):
+        # Consecutive reads mostly land in the same record
+        if self._last is None or self._last[0] != n:
+            self._last = (n, self.decompress(self._text_record(n)))
+        return self._last[1]
+
+    def record (self, n):
+        return bytearray(self._record_data(n))
+
+    def _decompressed_size (self, n):
+        if self.compression == COMPRESSION_NONE:
+            if not self.extra_flags:
+                return self.metadata.pdb.records[n + 1][1]
+            return len(self._text_record(n))
+        if self.compression == COMPRESSION_PALMDOC:
+            return palmdoc_decompressed_size(self._text_record(n))
+        return len(self._record_data(n))
+
+    # Text index #############################################################
+
+    @property
+    def index (self):
+        if self._index is None:
+            if self.index_path is not None:
+                self._index = TextIndex.load(self.index_path, self.filename)
+            if self._index is None:
+                self._index = TextIndex()
+            self._index_saved = (len(self._index.starts), self._index.complete)
+        return self._index
+
+    def _extend_index (self, offset=None):
+        index = self.index
+        starts = index.starts
+        while not index.complete and (offset is None or offset >= starts[-1]):
+            n = len(starts) - 1
+            if n < self.record_count:
+                starts.append(starts[-1] + self._decompressed_size(n))
+            if len(starts) > self.record_count:
+                index.complete = True
+        return index
+
+    def build_index (self):
+        return self._extend_index()
+
+    def save_index (self, path=None):
+        path = path or self.index_path
+        if path is None or self._index is None:
+            return
+        self._index.save(path, self.filename)
+        self._index_saved = (len(self._index.starts), self._index.complete)
+
+    def locate (self, offset):
+        return self._extend_index(offset).locate(offset)
+
+    def close (self):
+        if self.index_path is not None and self._index is not None and \
+           self._index_saved != (len(self._index.starts), self._index.complete):
+            self.save_index()
+        PDBTextReader.close(self)
+
+ZTXT_RANDOM_ACCESS = 0x01
+
+ZTXT_RECORD_CACHE_SIZE   = 16
+ZTXT_CHECKPOINT_INTERVAL = 16
+
+class ZtxtTextReader (PDBTextReader):
+    """
+    Text reader for zTXT (GutenPalm) books. The text is a single zlib stream
+    cut into records of record_size decompressed bytes. When the random
+    access flag is set the stream was fully flushed at every record
+    boundary, so any record can be inflated on its own. Otherwise records
+    are inflated in order, resuming from a copy of the inflater state saved
+    every ZTXT_CHECKPOINT_INTERVAL records. Recently inflated records are
+    kept in an LRU cache.
+    """
+
+    def __init__ (self, filename, metadata=None, cache_size=ZTXT_RECORD_CACHE_SIZE):
+        if metadata is None:
+            metadata = read_metadata(filename)
+        if metadata.filetype != PDB_GUTENPALM:
+            raise TextException('not a zTXT book')
+        self.metadata = metadata
+
+        header = metadata.ztxt
+        self.codec = 'cp1252'
+        self.text_length = header.data_size
+        self.record_size = header.record_size
+        self.record_count = min(header.record_count, len(metadata.pdb.records) - 1)
+        self.random_access = bool(header.flags & ZTXT_RANDOM_ACCESS)
+        if self.record_size == 0:
+            raise TextException('invalid zTXT record size')
+
+        self.records = LRUCache(cache_size)
+        self._checkpoints = {}
+        self._inflater = None
+        self._next_record = 0
+        self.stream = open(filename, 'rb')
+
+    def _inflate_record (self, n):
+        # Only the first record carries the zlib header
+        if n == 0:
+            inflater = zlib.decompressobj()
+        else:
+            inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        return inflater.decompress(str(self.raw_record(n + 1)))
+
+    def _inflate_sequential (self, n):
+        if self._inflater is None or n < self._next_record:
+            start = max(k for k in self._checkpoints if k <= n) if self._checkpoints else 0
+            if start in self._checkpoints:
+                self._inflater = self._checkpoints[start].copy()
+            else:
+                self._inflater = zlib.decompressobj()
+            self._next_record = start
+
+        while True:
+            m = self._next_record
+            if m % ZTXT_CHECKPOINT_INTERVAL == 0 and m not in self._checkpoints:
+                self._checkpoints[m] = self._inflater.copy()
+            data = self._inflater.decompress(str(self.raw_record(m + 1)))
+            self._next_record += 1
+            if m == n:
+                return data
+            self.records.put(m, data)
+
+    def _record_data (self, n):
+        if not 0 <= n < self.record_count:
+            raise IndexError('text record %d out of range' % n)
+        data = self.records.get(n)
+        if data is None:
+            try:
+                if self.random_access:
+                    data = self._inflate_record(n)
+                else:
+                    data = self._inflate_sequential(n)
+            except zlib.error, e:
+                self._inflater = None
+                raise TextException('corrupt zTXT text record %d: %s' % (n, e))
+            self.records.put(n, data)
+        return data
+
+    def record (self, n):
+        return bytearray(self._record_data(n))
+
+    def locate (self, offset):
+        n, start = divmod(offset, self.record_size)
+        if offset < 0 or n >= self.record_count:
+            return None
+        return n, start
+
+TEXT_READERS = { MOBI          : PalmTextReader,
+                 PDB_PALMDOC   : PalmTextReader,
+                 PDB_GUTENPALM : ZtxtTextReader,
+               }
+
+##############################################################################
+
+def open_text_reader (filename, metadata=None, **options):
+    if metadata is None:
+        metadata = read_metadata(filename)
+    if metadata is None or metadata.filetype not in TEXT_READERS:
+        raise TextException('no text reader for this file type: %s' % filename)
+    return TEXT_READERS[metadata.filetype](filename, metadata, **options)
+
+def iter_text_records (filename, metadata=None):
+    with open_text_reader(filename, metadata) as reader:
+        for record in reader.iter_records():
+            yield record
+
+def iter_text (filename, metadata=None, errors='replace'):
+    with open_text_reader(filename, metadata) as reader:
+        decoder = codecs.getincrementaldecoder(reader.codec)(errors)
+        for record in reader.iter_records():
+            text = decoder.decode(str(record))
+            if text:
+                yield text
+        text = decoder.decode('', True)
+        if text:
+            yield text
+
+##############################################################################
+## THE END
@@ -0,0 +1,156 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# HUFF/CDIC COMPRESSION
+#
+# The MOBI "huffdic" compression (compression type 17480) encodes the text
+# as a stream of canonical huffman codes, each of which selects a phrase
+# from a dictionary. A phrase is either literal text or is itself huffdic
+# compressed. The tables are kept in the records named by the MOBI header
+# huffman_record and huffman_record_count fields: one HUFF record followed
+# by one or more CDIC records.
+#
+# HUFF record
+#
+# Offset Bytes Field                Comments
+# ------ ----- -------------------- -------------------------------------------
+# 00     4     Identifier           the characters 'H' 'U' 'F' 'F'
+# 04     4     Header length        always 24
+# 08     4     Cache table offset   offset of the 256 entry code table
+# 12     4     Base table offset    offset of the 32 entry (min,max) code table
+#
+#  Each cache table entry describes the codes starting with one byte value:
+#  bits 0-4 are the code length, bit 7 is set when that length is final, and
+#  bits 8-31 are the maximum code. The base table gives, for every code
+#  length 1-32, the smallest and largest codes of that length.
+#
+# CDIC record
+#
+# Offset Bytes Field                Comments
+# ------ ----- -------------------- -------------------------------------------
+# 00     4     Identifier           the characters 'C' 'D' 'I' 'C'
+# 04     4     Header length        always 16
+# 08     4     Phrase count         number of phrases in all CDIC records
+# 12     4     Code bits            each CDIC record holds up to 2^bits phrases
+# 16     2*n   Phrase offsets       offset of each phrase, from offset 16
+#
+#  Each phrase is a 2 byte length, with bit 15 set for literal phrases,
+#  followed by the phrase data.
+#
+# All the tables are precomputed once per book when the decoder is built.
+# A compressed phrase is expanded the first time it is used and replaced by
+# its expansion, so each phrase is decoded at most once per book.
+
+import struct
+
+__all__ = [ 'HuffCdicDecoder', 'HuffCdicException', ]
+
+##############################################################################
+
+class HuffCdicException (Exception):
+    pass
+
+class HuffCdicDecoder (object):
+
+    def __init__ (self, huff, cdics):
+        self.phrases = []
+        self.literal = []
+        self._load_huff(str(huff))
+        for cdic in cdics:
+            self._load_cdic(str(cdic))
+
+    def _load_huff (self, huff):
+        if huff[0:8] != 'HUFF\x00\x00\x00\x18':
+            raise HuffCdicException('invalid HUFF header')
+        cache_offset, base_offset = struct.unpack('>LL', huff[8:16])
+
+        cache = []
+        for value in struct.unpack('>256L', huff[cache_offset:cache_offset+1024]):
+            codelen = value & 0x1f
+            if codelen == 0:
+                raise HuffCdicException('invalid HUFF code length')
+            term = value & 0x80
+            maxcode = (((value >> 8) + 1) << (32 - codelen)) - 1
+            cache.append((codelen, term, maxcode))
+        self.cache = cache
+
+        base = struct.unpack('>64L', huff[base_offset:base_offset+256])
+        mincodes = [ 0 ]
+        maxcodes = [ 0 ]
+        for codelen in xrange(1, 33):
+            mincodes.append(base[2*codelen - 2] << (32 - codelen))
+            maxcodes.append(((base[2*codelen - 1] + 1) << (32 - codelen)) - 1)
+        self.mincodes = mincodes
+        self.maxcodes = maxcodes
+
+    def _load_cdic (self, cdic):
+        if cdic[0:8] != 'CDIC\x00\x00\x00\x10':
+            raise HuffCdicException('invalid CDIC header')
+        phrase_count, bits = struct.unpack('>LL', cdic[8:16])
+        count = min(1 << bits, phrase_count - len(self.phrases))
+        for offset in struct.unpack('>%dH' % count, cdic[16:16 + 2*count]):
+            length, = struct.unpack('>H', cdic[16+offset:18+offset])
+            self.phrases.append(cdic[18+offset:18+offset+(length & 0x7fff)])
+            self.literal.append(bool(length & 0x8000))
+
+    def decompress (self, data):
+        data = str(data)
+        bitsleft = len(data) * 8
+        data += '\x00' * 8
+        cache = self.cache
+        mincodes = self.mincodes
+        maxcodes = self.maxcodes
+        phrases = self.phrases
+        literal = self.literal
+        unpack_from = struct.unpack_from
+
+        out = []
+        pos = 0
+        x, = unpack_from('>Q', data, 0)
+        n = 32
+        while True:
+            if n <= 0:
+                pos += 4
+                x, = unpack_from('>Q', data, pos)
+                n += 32
+            code = (x >> n) & 0xffffffff
+
+            codelen, term, maxcode = cache[code >> 24]
+            if not term:
+                while code < mincodes[codelen]:
+                    codelen += 1
+                maxcode = maxcodes[codelen]
+
+            n -= codelen
+            bitsleft -= codelen
+            if bitsleft < 0:
+                break
+
+            r = (maxcode - code) >> (32 - codelen)
+            phrase = phrases[r]
+            if not literal[r]:
+                # Guard against phrases that (directly or not) contain
+                # themselves while they are being expanded.
+                literal[r] = True
+                phrases[r] = ''
+                phrase = self.decompress(phrase)
+                phrases[r] = phrase
+            out.append(phrase)
+
+        return ''.join(out)
+
+##############################################################################
+## THE END
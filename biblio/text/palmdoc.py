@@ -0,0 +1,142 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# PALMDOC COMPRESSION
+#
+# PalmDOC text records are compressed with a simple LZ77 variant. The
+# compressed stream is a sequence of tokens, distinguished by their first
+# byte:
+#
+# Byte       Meaning
+# ---------- -----------------------------------------------------------------
+# 0x00       a literal 0x00 byte
+# 0x01-0x08  copy the next 1-8 bytes literally
+# 0x09-0x7f  a literal byte
+# 0x80-0xbf  with the following byte, a 16 bit back-reference. bits 3-13 are
+#            the distance back into the output (1-2047), bits 0-2 are the
+#            length minus 3 (3-10 bytes)
+# 0xc0-0xff  a space followed by the byte XOR 0x80
+#
+# MOBI TRAILING ENTRIES
+#
+# MOBI text records may end with trailing entries that are not part of the
+# text. Bit 0 of the MOBI header extra data flags marks multibyte character
+# overlap data: the low two bits of the last byte, plus one, give its size.
+# Each other set bit marks a trailing entry whose size is stored as a
+# backward-encoded variable width integer at the very end of the record.
+# The multibyte data, if present, sits before all other trailing entries.
+
+__all__ = [ 'palmdoc_decompress', 'palmdoc_decompressed_size', 'trailing_entries_size', ]
+
+##############################################################################
+
+def palmdoc_decompress (data):
+    if not isinstance(data, bytearray):
+        data = bytearray(data)
+    out = bytearray()
+    append = out.append
+    extend = out.extend
+    end = len(data)
+    i = 0
+    while i < end:
+        c = data[i]
+        i += 1
+        if c >= 0xc0:
+            append(0x20)
+            append(c ^ 0x80)
+        elif c >= 0x80:
+            if i >= end:
+                break
+            c = (c << 8) | data[i]
+            i += 1
+            distance = (c >> 3) & 0x7ff
+            length = (c & 0x7) + 3
+            if distance == 0 or distance > len(out):
+                continue
+            start = len(out) - distance
+            if distance >= length:
+                extend(out[start:start+length])
+            else:
+                # The reference overlaps the bytes it produces
+                for n in xrange(length):
+                    append(out[start + n])
+        elif 1 <= c <= 8:
+            extend(data[i:i+c])
+            i += c
+        else:
+            append(c)
+    return out
+
+def palmdoc_decompressed_size (data):
+    # Walks the tokens exactly as palmdoc_decompress() does, but only
+    # counts the output instead of producing it.
+    if not isinstance(data, bytearray):
+        data = bytearray(data)
+    size = 0
+    end = len(data)
+    i = 0
+    while i < end:
+        c = data[i]
+        i += 1
+        if c >= 0xc0:
+            size += 2
+        elif c >= 0x80:
+            if i >= end:
+                break
+            c = (c << 8) | data[i]
+            i += 1
+            distance = (c >> 3) & 0x7ff
+            if distance == 0 or distance > size:
+                continue
+            size += (c & 0x7) + 3
+        elif 1 <= c <= 8:
+            size += min(c, end - i)
+            i += c
+        else:
+            size += 1
+    return size
+
+##############################################################################
+
+def _backward_varint (data, end):
+    result = 0
+    shift = 0
+    pos = end
+    while pos > 0:
+        pos -= 1
+        byte = data[pos]
+        result |= (byte & 0x7f) << shift
+        shift += 7
+        if byte & 0x80 or shift >= 28:
+            break
+    return result
+
+def trailing_entries_size (data, extra_flags):
+    if not isinstance(data, bytearray):
+        data = bytearray(data)
+    size = len(data)
+    num = 0
+    flags = extra_flags >> 1
+    while flags:
+        if flags & 1:
+            num += _backward_varint(data, size - num)
+        flags >>= 1
+    if extra_flags & 1 and size - num > 0:
+        num += (data[size - num - 1] & 0x3) + 1
+    return min(num, size)
+
+##############################################################################
+## THE END
@@ -0,0 +1,318 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# BYTE SOURCES
+#
+# A byte source is a book that is read by ranges rather than opened as a
+# local file: it only has to answer read_at(offset, length) and size().
+# Since biblio only reads headers (see biblio.util.iopolicy), a book on a
+# web server or in an object store never has to be downloaded: a MOBI
+# book, for instance, is identified and parsed from its first block, and
+# an EPUB from its first block, its last block (the central directory) and
+# whatever blocks its container and package documents sit in.
+#
+# Two backends are provided:
+#
+#   FileByteSource    a local file
+#   HTTPByteSource    an http:// or https:// URL, read with Range requests
+#                     over one keep-alive connection; the size comes from
+#                     the Content-Range of the first response
+#
+# Remote sources are wrapped in a CachedByteSource, which reads whole
+# blocks of BYTE_SOURCE_BLOCK_SIZE bytes and keeps the most recently used
+# ones in an LRUCache. The missing blocks of one read_at() are fetched with
+# one backend read per run of adjacent blocks, so a read that spans several
+# blocks is still a single request.
+#
+# A byte source can be passed anywhere a file name is accepted:
+# open_header() reads it through a ByteSourceFile, a seekable file object
+# over the source, so identify_file(), the parsers and the EPUB ZIP reader
+# all work on it unchanged.
+
+from __future__ import with_statement
+import httplib, os, re, threading, urlparse
+
+from biblio.util.lru import LRUCache
+
+__all__ = [ 'ByteSource', 'FileByteSource', 'HTTPByteSource', 'CachedByteSource',
+            'ByteSourceFile', 'open_byte_source', 'BYTE_SOURCE_BLOCK_SIZE', ]
+
+##############################################################################
+
+class ByteSourceException (IOError):
+    pass
+
+BYTE_SOURCE_BLOCK_SIZE  = 16 * 1024
+BYTE_SOURCE_CACHE_SIZE  = 64            # blocks
+HTTP_TIMEOUT            = 30
+
+CONTENT_RANGE_PATTERN = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)')
+
+##############################################################################
+
+class ByteSource (object):
+    """
+    Random access to the bytes of one book. Subclasses implement read_at()
+    and size(); read_at() returns fewer bytes than asked only at the end of
+    the source.
+    """
+
+    name = ''
+
+    def read_at (self, offset, length):
+        raise NotImplementedError
+
+    def size (self):
+        raise NotImplementedError
+
+    def close (self):
+        pass
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        self.close()
+
+##############################################################################
+
+class FileByteSource (ByteSource):
+
+    def __init__ (self, filename):
+        self.name = filename
+        self.stream = open(filename, 'rb')
+        self.lock = threading.Lock()
+
+    def read_at (self, offset, length):
+        with self.lock:
+            self.stream.seek(offset)
+            return self.stream.read(length)
+
+    def size (self):
+        return os.fstat(self.stream.fileno()).st_size
+
+    def close (self):
+        self.stream.close()
+
+##############################################################################
+
+class HTTPByteSource (ByteSource):
+    """
+    A remote book read with HTTP Range requests. requests and bytes_read
+    count what has been fetched so far.
+    """
+
+    def __init__ (self, url, timeout=HTTP_TIMEOUT, headers=None):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme == 'http':
+            self.connection_class = httplib.HTTPConnection
+        elif parts.scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            raise ByteSourceException('not an http or https URL: %s' % url)
+
+        self.name = url
+        self.netloc = parts.netloc
+        self.path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        self.timeout = timeout
+        self.headers = dict(headers or {})
+        self.connection = None
+        self.length = None
+        self.requests = 0
+        self.bytes_read = 0
+        self.lock = threading.Lock()
+
+    def _request (self, method, headers, expect):
+        """
+        Sends a request and returns the response and its body. The body is
+        only read if the status is the expected one: anything else (a whole
+        book answered with 200, say) is dropped along with the connection.
+        """
+        for attempt in (1, 2):
+            if self.connection is None:
+                self.connection = self.connection_class(self.netloc, timeout=self.timeout)
+            try:
+                self.connection.request(method, self.path, headers=headers)
+                response = self.connection.getresponse()
+                body = response.read() if response.status == expect else None
+                break
+            except (httplib.HTTPException, IOError), e:
+                # A kept-alive connection may have been closed by the
+                # server since the last request: retry once on a new one
+                self._disconnect()
+                if attempt == 2:
+                    raise ByteSourceException('%s: %s' % (self.name, e))
+        self.requests += 1
+        if body is None or response.getheader('connection', '').lower() == 'close':
+            self._disconnect()
+        if body is not None:
+            self.bytes_read += len(body)
+        return response, body
+
+    def _disconnect (self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def read_at (self, offset, length):
+        if length <= 0 or (self.length is not None and offset >= self.length):
+            return ''
+        headers = dict(self.headers)
+        headers['Range'] = 'bytes=%d-%d' % (offset, offset + length - 1)
+        with self.lock:
+            response, body = self._request('GET', headers, 206)
+
+        if response.status == 416:                      # past the end
+            return ''
+        if body is None:
+            raise ByteSourceException('%s: range request failed: %d %s' %
+                                      (self.name, response.status, response.reason))
+        m = CONTENT_RANGE_PATTERN.match(response.getheader('content-range', ''))
+        if m is None or int(m.group(1)) != offset:
+            raise ByteSourceException('%s: bad Content-Range in response' % self.name)
+        if m.group(3) != '*':
+            self.length = int(m.group(3))
+        return body[:length]
+
+    def size (self):
+        if self.length is None:
+            with self.lock:
+                response, body = self._request('HEAD', dict(self.headers), 200)
+            if body is None or response.getheader('content-length') is None:
+                raise ByteSourceException('%s: cannot find the size: %d %s' %
+                                          (self.name, response.status, response.reason))
+            self.length = int(response.getheader('content-length'))
+        return self.length
+
+    def close (self):
+        self._disconnect()
+
+##############################################################################
+
+class CachedByteSource (ByteSource):
+    """
+    Reads source in whole blocks of block_size bytes, and keeps the last
+    cache_size blocks read.
+    """
+
+    def __init__ (self, source, block_size=BYTE_SOURCE_BLOCK_SIZE, cache_size=BYTE_SOURCE_CACHE_SIZE):
+        self.source = source
+        self.name = source.name
+        self.block_size = block_size
+        self.blocks = LRUCache(cache_size)
+
+    def _fetch (self, first, last):
+        """
+        Reads blocks first to last (inclusive) with a single backend read.
+        Returns them, short (or missing) at the end of the source.
+        """
+        bs = self.block_size
+        data = self.source.read_at(first * bs, (last - first + 1) * bs)
+        blocks = []
+        for n in xrange(first, last + 1):
+            block = data[(n - first) * bs:(n - first + 1) * bs]
+            self.blocks.put(n, block)
+            blocks.append(block)
+        return blocks
+
+    def read_at (self, offset, length):
+        if length <= 0:
+            return ''
+        bs = self.block_size
+        first, last = offset // bs, (offset + length - 1) // bs
+
+        blocks = []
+        missing = None
+        for n in xrange(first, last + 1):
+            block = self.blocks.get(n)
+            if block is None:
+                if missing is None:
+                    missing = n
+                continue
+            if missing is not None:
+                blocks.extend(self._fetch(missing, n - 1))
+                missing = None
+            blocks.append(block)
+        if missing is not None:
+            blocks.extend(self._fetch(missing, last))
+
+        start = offset - first * bs
+        return ''.join(blocks)[start:start + length]
+
+    def size (self):
+        return self.source.size()
+
+    def close (self):
+        self.blocks.clear()
+        self.source.close()
+
+##############################################################################
+
+class ByteSourceFile (object):
+    """
+    A read-only, seekable file object over a byte source. Closing it leaves
+    the source open.
+    """
+
+    def __init__ (self, source):
+        self.source = source
+        self.name = source.name
+        self.pos = 0
+        self.closed = False
+
+    def read (self, size=-1):
+        if size is None or size < 0:
+            size = self.source.size() - self.pos
+        if size <= 0:
+            return ''
+        data = self.source.read_at(self.pos, size)
+        self.pos += len(data)
+        return data
+
+    def seek (self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.pos
+        elif whence == os.SEEK_END:
+            pos += self.source.size()
+        if pos < 0:
+            raise IOError('negative seek position %d' % pos)
+        self.pos = pos
+
+    def tell (self):
+        return self.pos
+
+    def close (self):
+        self.closed = True
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        self.close()
+
+##############################################################################
+
+def open_byte_source (location, block_size=BYTE_SOURCE_BLOCK_SIZE, cache_size=BYTE_SOURCE_CACHE_SIZE):
+    """
+    Opens a byte source for location: an http:// or https:// URL, or a
+    local file name. URLs are read through a block cache.
+    """
+    if re.match(r'https?://', location, re.I):
+        return CachedByteSource(HTTPByteSource(location), block_size, cache_size)
+    return FileByteSource(location)
+
+##############################################################################
+## THE END
@@ -0,0 +1,224 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# I/O POLICY
+#
+# biblio only ever reads the headers of the files it looks at: the first few
+# KB for identification, the PDB record table and record 0, the ZIP central
+# directory and a couple of members. The kernel does not know this, and its
+# default readahead pulls in far more of each file than is ever used. On a
+# large scan this evicts everything else from the page cache.
+#
+# All header reads go through open_header(), which applies the active
+# IOPolicy to the file descriptor:
+#
+#   random_access     POSIX_FADV_RANDOM before reading, disabling readahead
+#   header_readahead  POSIX_FADV_WILLNEED over the first N bytes, so the
+#                     header is fetched in a single request
+#   drop_cache        POSIX_FADV_DONTNEED over the whole file once it has
+#                     been completely processed
+#
+# A file is "completely processed" at the end of the outermost io_session()
+# for it. The parser entry points open a session around all of their reads,
+# so a file that is opened several times (identification, PDB header,
+# record 0) is only dropped from the cache once, at the very end.
+#
+# The default policy gives no advice at all. Use set_io_policy(HEADER_ONLY)
+# (or an IOPolicy of your own) for large scans.
+#
+# open_header() also accepts an open, seekable file object instead of a
+# file name (the member views of biblio.archive, for instance). It is
+# rewound and handed over as it is: no advice is given, and it is left
+# open for its owner to close. A ByteSource (see biblio.util.bytesource)
+# is read through a new ByteSourceFile each time.
+#
+# Writers make their changes durable with sync_file(). Inside a
+# deferred_sync() block (which is per thread) sync_file() only flushes, and
+# the caller takes over the fsync: bulk writers use this to sync many files
+# and their directories in one pass (see biblio.parsers.write_metadata_batch).
+
+from __future__ import with_statement
+from contextlib import contextmanager
+import os, threading
+
+from biblio.util.bytesource import ByteSource, ByteSourceFile
+
+__all__ = [ 'IOPolicy', 'HEADER_ONLY', 'get_io_policy', 'set_io_policy',
+            'open_header', 'io_session', 'sync_file', 'sync_path', 'deferred_sync', ]
+
+##############################################################################
+
+POSIX_FADV_NORMAL     = 0
+POSIX_FADV_RANDOM     = 1
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED   = 3
+POSIX_FADV_DONTNEED   = 4
+POSIX_FADV_NOREUSE    = 5
+
+def _load_fadvise ():
+    fadvise = getattr(os, 'posix_fadvise', None)
+    if fadvise is not None:
+        return fadvise
+
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        try:
+            cfunc = libc.posix_fadvise64
+        except AttributeError:
+            cfunc = libc.posix_fadvise
+    except (ImportError, OSError, AttributeError):
+        return None
+
+    cfunc.argtypes = (ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int)
+    cfunc.restype = ctypes.c_int
+
+    def fadvise (fd, offset, length, advice):
+        cfunc(fd, offset, length, advice)
+    return fadvise
+
+_fadvise = _load_fadvise()
+
+def fadvise (fd, offset, length, advice):
+    if _fadvise is None:
+        return
+    try:
+        _fadvise(fd, offset, length, advice)
+    except (IOError, OSError):
+        pass
+
+##############################################################################
+
+class IOPolicy (object):
+
+    def __init__ (self, random_access=False, drop_cache=False, header_readahead=0,
+                        identify_size=8192):
+        self.random_access = random_access
+        self.drop_cache = drop_cache
+        self.header_readahead = header_readahead
+        self.identify_size = identify_size
+
+    def before_read (self, fd):
+        if self.random_access:
+            fadvise(fd, 0, 0, POSIX_FADV_RANDOM)
+        if self.header_readahead > 0:
+            fadvise(fd, 0, self.header_readahead, POSIX_FADV_WILLNEED)
+
+    def release (self, fd):
+        if self.drop_cache:
+            fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+
+    def __repr__ (self):
+        return '<IOPolicy random_access=%r drop_cache=%r header_readahead=%d identify_size=%d>' % \
+               (self.random_access, self.drop_cache, self.header_readahead, self.identify_size)
+
+HEADER_ONLY = IOPolicy(random_access=True, drop_cache=True, header_readahead=16384)
+
+_io_policy = IOPolicy()
+
+def get_io_policy ():
+    return _io_policy
+
+def set_io_policy (policy):
+    global _io_policy
+    previous, _io_policy = _io_policy, policy
+    return previous
+
+##############################################################################
+
+_sessions = threading.local()
+
+def _active_sessions ():
+    try:
+        return _sessions.active
+    except AttributeError:
+        _sessions.active = {}
+        return _sessions.active
+
+@contextmanager
+def io_session (filename):
+    active = _active_sessions()
+    active[filename] = active.get(filename, 0) + 1
+    try:
+        yield
+    finally:
+        active[filename] -= 1
+        if active[filename] == 0:
+            del active[filename]
+            _release_file(filename)
+
+def _release_file (filename):
+    policy = _io_policy
+    if not policy.drop_cache or not isinstance(filename, basestring):
+        return
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        policy.release(fd)
+    finally:
+        os.close(fd)
+
+@contextmanager
+def open_header (filename, mode='rb'):
+    if isinstance(filename, ByteSource):
+        yield ByteSourceFile(filename)
+        return
+    if not isinstance(filename, basestring):
+        filename.seek(0)
+        yield filename
+        return
+
+    policy = _io_policy
+    stream = open(filename, mode)
+    try:
+        policy.before_read(stream.fileno())
+        yield stream
+    finally:
+        if filename not in _active_sessions():
+            policy.release(stream.fileno())
+        stream.close()
+
+##############################################################################
+
+_deferred = threading.local()
+
+def sync_file (stream):
+    stream.flush()
+    if getattr(_deferred, 'depth', 0) == 0:
+        os.fsync(stream.fileno())
+
+def sync_path (path):
+    """
+    fsync a file or a directory by name.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+@contextmanager
+def deferred_sync ():
+    _deferred.depth = getattr(_deferred, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _deferred.depth -= 1
+
+##############################################################################
+## THE END
@@ -0,0 +1,89 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import with_statement
+from collections import namedtuple, OrderedDict
+import threading
+
+__all__ = [ 'LRUCache', 'cache_stats', ]
+
+##############################################################################
+
+cache_stats = namedtuple('cache_stats', 'hits misses size maxsize')
+
+_missing = object()
+
+class LRUCache (object):
+    """
+    A bounded, thread-safe mapping that discards the least recently used
+    entry once it holds more than maxsize entries. A maxsize of 0 disables
+    the cache entirely.
+    """
+
+    def __init__ (self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get (self, key, default=None):
+        with self._lock:
+            value = self._data.pop(key, _missing)
+            if value is _missing:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def put (self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard (self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def resize (self, maxsize):
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._data) > max(maxsize, 0):
+                self._data.popitem(last=False)
+
+    def clear (self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats (self):
+        return cache_stats(hits=self.hits, misses=self.misses,
+                           size=len(self._data), maxsize=self.maxsize)
+
+    def __contains__ (self, key):
+        return key in self._data
+
+    def __len__ (self):
+        return len(self._data)
+
+##############################################################################
+## THE END
@@ -0,0 +1,75 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+__all__ = [ 'RangeFile', ]
+
+##############################################################################
+
+class RangeFile (object):
+    """
+    A read-only, seekable view of length bytes of a stream starting at
+    offset. Reads are passed straight through to the underlying stream, so
+    nothing outside the range is ever read. The underlying stream is only
+    closed with the view when owned is set.
+    """
+
+    def __init__ (self, stream, offset, length, owned=False):
+        self.stream = stream
+        self.offset = offset
+        self.length = length
+        self.owned = owned
+        self.pos = 0
+        self.closed = False
+
+    def read (self, size=-1):
+        remaining = self.length - self.pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return ''
+        self.stream.seek(self.offset + self.pos)
+        data = self.stream.read(size)
+        self.pos += len(data)
+        return data
+
+    def seek (self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.pos
+        elif whence == os.SEEK_END:
+            pos += self.length
+        if pos < 0:
+            raise IOError('negative seek position %d' % pos)
+        self.pos = pos
+
+    def tell (self):
+        return self.pos
+
+    def close (self):
+        if not self.closed:
+            self.closed = True
+            if self.owned:
+                self.stream.close()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc_info):
+        self.close()
+
+##############################################################################
+## THE END
@@ -0,0 +1,347 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# RAW ZIP EDITING
+#
+# Replacing one member of a ZIP archive with zipfile means reading and
+# recompressing every other member. Here the archive is handled at the
+# level of its records instead: every other member's local header, data
+# and data descriptor are copied as raw bytes, and only the central
+# directory, which holds the member offsets, is regenerated.
+#
+# Two ways of replacing a member are offered:
+#
+#   replace_member()  writes a new archive to a temporary file: the other
+#                     members are copied verbatim in their original order,
+#                     with the replaced member in its old place, and the
+#                     temporary file is renamed over the original. Given an
+#                     output path, it writes the new archive there instead
+#                     and leaves the original alone.
+#
+#   append_member()   leaves the existing archive untouched and appends the
+#                     new member, a new central directory pointing to it
+#                     and a new end of central directory record. The old
+#                     member and central directory stay in the file as dead
+#                     bytes. This writes a few KB whatever the size of the
+#                     archive.
+#
+# The first member can be forced to be a stored "mimetype" member, as the
+# EPUB OCF container requires. ZIP64 archives are not supported.
+
+from __future__ import with_statement
+from collections import namedtuple
+import os, shutil, struct, tempfile, time, zlib
+
+from biblio.util.iopolicy import sync_file
+
+__all__ = [ 'ZipEditException', 'read_central_directory', 'read_member',
+            'replace_member', 'append_member', ]
+
+##############################################################################
+
+class ZipEditException (Exception):
+    pass
+
+LOCAL_HEADER       = struct.Struct('<4s5H3L2H')
+CENTRAL_HEADER     = struct.Struct('<4s4B4HL2L5H2L')
+END_OF_DIRECTORY   = struct.Struct('<4s4H2LH')
+
+LOCAL_SIGNATURE      = 'PK\x03\x04'
+CENTRAL_SIGNATURE    = 'PK\x01\x02'
+END_SIGNATURE        = 'PK\x05\x06'
+ZIP64_SIGNATURE      = 'PK\x06\x07'
+DESCRIPTOR_SIGNATURE = 'PK\x07\x08'
+
+ZIP_STORED   = 0
+ZIP_DEFLATED = 8
+
+FLAG_DATA_DESCRIPTOR = 0x08
+
+MAX_COMMENT = 65535
+
+READ_CHUNK_SIZE = 16 * 1024
+
+# One central directory record. fields are the unpacked CENTRAL_HEADER
+# values; offset is the offset of the member's local header.
+zip_entry = namedtuple('zip_entry', 'name fields extra comment')
+
+CD_FLAGS, CD_COMPRESS, CD_CRC, CD_COMPRESSED_SIZE, CD_SIZE, CD_OFFSET = 5, 6, 9, 10, 11, 18
+
+# The end of central directory record, and where it was found
+end_record = namedtuple('end_record', 'offset count directory_size directory_offset comment')
+
+##############################################################################
+
+def _find_end_record (stream):
+    stream.seek(0, 2)
+    size = stream.tell()
+    tail_size = min(size, END_OF_DIRECTORY.size + MAX_COMMENT)
+    stream.seek(size - tail_size)
+    tail = stream.read(tail_size)
+
+    pos = tail.rfind(END_SIGNATURE)
+    while pos >= 0:
+        if pos + END_OF_DIRECTORY.size <= len(tail):
+            fields = END_OF_DIRECTORY.unpack_from(tail, pos)
+            comment = tail[pos + END_OF_DIRECTORY.size:pos + END_OF_DIRECTORY.size + fields[7]]
+            if len(comment) == fields[7]:
+                if pos >= 20 and tail[pos-20:pos-16] == ZIP64_SIGNATURE:
+                    raise ZipEditException('ZIP64 archives are not supported')
+                if fields[4] == 0xffff or fields[5] == 0xffffffff or fields[6] == 0xffffffff:
+                    raise ZipEditException('ZIP64 archives are not supported')
+                return end_record(size - tail_size + pos, fields[4], fields[5], fields[6], comment)
+        pos = tail.rfind(END_SIGNATURE, 0, pos)
+    raise ZipEditException('not a ZIP archive: no end of central directory record')
+
+def read_central_directory (stream):
+    end = _find_end_record(stream)
+    stream.seek(end.directory_offset)
+    directory = stream.read(end.directory_size)
+    if len(directory) != end.directory_size:
+        raise ZipEditException('truncated central directory')
+
+    entries = []
+    pos = 0
+    for n in xrange(end.count):
+        if directory[pos:pos+4] != CENTRAL_SIGNATURE:
+            raise ZipEditException('bad central directory record %d' % n)
+        fields = CENTRAL_HEADER.unpack_from(directory, pos)
+        pos += CENTRAL_HEADER.size
+        name_length, extra_length, comment_length = fields[12:15]
+        name = directory[pos:pos + name_length]
+        pos += name_length
+        extra = directory[pos:pos + extra_length]
+        pos += extra_length
+        comment = directory[pos:pos + comment_length]
+        pos += comment_length
+        entries.append(zip_entry(name, fields, extra, comment))
+    return entries, end
+
+def _local_record_size (stream, entry):
+    """
+    The size of a member's local header, data and data descriptor.
+    """
+    offset = entry.fields[CD_OFFSET]
+    stream.seek(offset)
+    header = stream.read(LOCAL_HEADER.size)
+    if len(header) != LOCAL_HEADER.size or header[:4] != LOCAL_SIGNATURE:
+        raise ZipEditException('bad local header for %s' % entry.name)
+    fields = LOCAL_HEADER.unpack(header)
+    size = LOCAL_HEADER.size + fields[9] + fields[10] + entry.fields[CD_COMPRESSED_SIZE]
+    if entry.fields[CD_FLAGS] & FLAG_DATA_DESCRIPTOR:
+        stream.seek(offset + size)
+        size += 16 if stream.read(4) == DESCRIPTOR_SIGNATURE else 12
+    return size
+
+def read_member (stream, entry, limit=None):
+    """
+    The contents of one member (at most limit bytes of it), read through
+    its local header without touching any other member.
+    """
+    offset = entry.fields[CD_OFFSET]
+    stream.seek(offset)
+    header = stream.read(LOCAL_HEADER.size)
+    if len(header) != LOCAL_HEADER.size or header[:4] != LOCAL_SIGNATURE:
+        raise ZipEditException('bad local header for %s' % entry.name)
+    fields = LOCAL_HEADER.unpack(header)
+    size = entry.fields[CD_COMPRESSED_SIZE]
+    stream.seek(offset + LOCAL_HEADER.size + fields[9] + fields[10])
+
+    if entry.fields[CD_COMPRESS] == ZIP_STORED:
+        return stream.read(size if limit is None else min(size, limit))
+    if entry.fields[CD_COMPRESS] != ZIP_DEFLATED:
+        raise ZipEditException('unsupported compression for %s' % entry.name)
+
+    # With a limit, only as much compressed data is read as it takes to
+    # inflate that many bytes
+    inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+    pieces = []
+    produced = 0
+    try:
+        while size > 0 and (limit is None or produced < limit):
+            chunk = stream.read(min(size, READ_CHUNK_SIZE) if limit is not None else size)
+            if not chunk:
+                break
+            size -= len(chunk)
+            data = inflater.decompress(chunk, 0 if limit is None else limit - produced)
+            pieces.append(data)
+            produced += len(data)
+    except zlib.error, e:
+        raise ZipEditException('bad compressed data for %s: %s' % (entry.name, e))
+    return ''.join(pieces)
+
+def _copy_range (stream, out, offset, size):
+    stream.seek(offset)
+    while size > 0:
+        data = stream.read(min(size, 1024 * 1024))
+        if not data:
+            raise ZipEditException('unexpected end of archive')
+        out.write(data)
+        size -= len(data)
+
+##############################################################################
+
+def _dos_time (timestamp=None):
+    t = time.localtime(timestamp)
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+           ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+def _new_member (name, data, compress, template=None):
+    """
+    Returns the local record of a new member and a function giving its
+    central directory record for a given local header offset.
+    """
+    if compress:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        payload = compressor.compress(data) + compressor.flush()
+        method = ZIP_DEFLATED
+    else:
+        payload = data
+        method = ZIP_STORED
+    crc = zlib.crc32(data) & 0xffffffff
+    mtime, mdate = _dos_time()
+    flags = (template.fields[CD_FLAGS] & 0x800) if template else 0      # keep the UTF-8 name flag
+
+    local = LOCAL_HEADER.pack(LOCAL_SIGNATURE, 20, flags, method, mtime, mdate,
+                              crc, len(payload), len(data), len(name), 0) + name + payload
+
+    if template is not None:
+        create_version, create_system = template.fields[1:3]
+        internal, external = template.fields[16:18]
+        comment = template.comment
+    else:
+        create_version, create_system, internal, external, comment = 20, 0, 0, 0, ''
+
+    def central (offset):
+        return CENTRAL_HEADER.pack(CENTRAL_SIGNATURE, create_version, create_system, 20, 0,
+                                   flags, method, mtime, mdate, crc, len(payload), len(data),
+                                   len(name), 0, len(comment), 0, internal, external,
+                                   offset) + name + comment
+    return local, central
+
+def _central_record (entry, offset):
+    fields = list(entry.fields)
+    fields[CD_OFFSET] = offset
+    return CENTRAL_HEADER.pack(*fields) + entry.name + entry.extra + entry.comment
+
+def _end_record (count, directory_size, directory_offset, comment):
+    if count > 0xffff or directory_offset > 0xffffffff:
+        raise ZipEditException('archive would need ZIP64')
+    return END_OF_DIRECTORY.pack(END_SIGNATURE, 0, 0, count, count,
+                                 directory_size, directory_offset, len(comment)) + comment
+
+##############################################################################
+
+def replace_member (filename, name, data, compress=True, mimetype_first=False, read_member=None,
+                    output=None):
+    """
+    Rewrites the archive with the member name replaced by data (or added,
+    if it is not there). With mimetype_first the archive will start with
+    a stored "mimetype" member; read_member(name) must then return the
+    contents of a member that has to be recompressed for that. With output,
+    the new archive is written to that path and filename is not replaced.
+    """
+    with open(filename, 'rb') as stream:
+        entries, end = read_central_directory(stream)
+        by_offset = sorted(entries, key=lambda e: e.fields[CD_OFFSET])
+
+        target = None
+        for entry in entries:
+            if entry.name == name:
+                target = entry
+        local, central = _new_member(name, data, compress, target)
+
+        mimetype = None
+        if mimetype_first:
+            for entry in entries:
+                if entry.name == 'mimetype':
+                    mimetype = entry
+            if mimetype is not None and (mimetype.fields[CD_COMPRESS] != ZIP_STORED or
+                                         by_offset[0] is not mimetype or mimetype.extra):
+                mime_local, mime_central = _new_member('mimetype', read_member('mimetype'), False, mimetype)
+            else:
+                mimetype = None
+
+        if output is None:
+            directory, temp = os.path.split(os.path.abspath(filename))
+            fd, temp = tempfile.mkstemp(prefix='.%s.' % temp, suffix='.tmp', dir=directory)
+        else:
+            temp = output
+            fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                records = {}
+                if mimetype is not None:
+                    records[mimetype.name] = mime_central(out.tell())
+                    out.write(mime_local)
+                for entry in by_offset:
+                    if entry is mimetype:
+                        continue
+                    if entry is target:
+                        records[entry.name] = central(out.tell())
+                        out.write(local)
+                        continue
+                    records[entry.name] = _central_record(entry, out.tell())
+                    _copy_range(stream, out, entry.fields[CD_OFFSET], _local_record_size(stream, entry))
+                if target is None:
+                    records[name] = central(out.tell())
+                    out.write(local)
+
+                names = [ e.name for e in entries ] + ([ name ] if target is None else [])
+                directory_offset = out.tell()
+                cd = ''.join(records[n] for n in names)
+                out.write(cd)
+                out.write(_end_record(len(names), len(cd), directory_offset, end.comment))
+                sync_file(out)
+            shutil.copymode(filename, temp)
+            if output is None:
+                os.rename(temp, filename)
+        except:
+            if os.path.exists(temp):
+                os.unlink(temp)
+            raise
+
+def append_member (filename, name, data, compress=True):
+    """
+    Appends a new version of the member name to the end of the archive,
+    followed by a central directory that points to it instead of the old
+    one.
+    """
+    with open(filename, 'r+b') as stream:
+        entries, end = read_central_directory(stream)
+
+        target = None
+        for entry in entries:
+            if entry.name == name:
+                target = entry
+        local, central = _new_member(name, data, compress, target)
+
+        stream.seek(0, 2)
+        offset = stream.tell()
+        records = [ central(offset) if entry is target else
+                    _central_record(entry, entry.fields[CD_OFFSET])
+                    for entry in entries ]
+        if target is None:
+            records.append(central(offset))
+        cd = ''.join(records)
+
+        stream.write(local)
+        stream.write(cd)
+        stream.write(_end_record(len(records), len(cd), offset + len(local), end.comment))
+        sync_file(stream)
+
+##############################################################################
+## THE END
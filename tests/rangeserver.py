@@ -0,0 +1,112 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A LOCAL STAND-IN FOR A BLOB STORE
+#
+# RangeServer serves the files of one directory over HTTP/1.1 on a local
+# port, answering "Range: bytes=a-b" requests with 206 Partial Content and
+# keeping connections alive. Every request is recorded in requests, as
+# (method, file name, range header), so tests can count what a reader
+# asked for. With ignore_range set it behaves like a server that does not
+# support ranges, and answers every GET with the whole file.
+
+import BaseHTTPServer, os, re, SocketServer, threading
+
+__all__ = [ 'RangeServer', ]
+
+##############################################################################
+
+RANGE_PATTERN = re.compile(r'bytes=(\d+)-(\d+)$')
+
+class _RangeRequestHandler (BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message (self, *args):
+        pass
+
+    def _load (self):
+        path = os.path.join(self.server.root, os.path.basename(self.path))
+        try:
+            with open(path, 'rb') as stream:
+                return stream.read()
+        except IOError:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+
+    def do_HEAD (self):
+        self.server.requests.append(('HEAD', os.path.basename(self.path), None))
+        data = self._load()
+        if data is not None:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+
+    def do_GET (self):
+        header = self.headers.get('Range')
+        self.server.requests.append(('GET', os.path.basename(self.path), header))
+        data = self._load()
+        if data is None:
+            return
+
+        m = RANGE_PATTERN.match(header or '')
+        if m is None or self.server.ignore_range:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        first, last = int(m.group(1)), min(int(m.group(2)), len(data) - 1)
+        if first >= len(data):
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % len(data))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(206)
+        self.send_header('Content-Range', 'bytes %d-%d/%d' % (first, last, len(data)))
+        self.send_header('Content-Length', str(last - first + 1))
+        self.end_headers()
+        self.wfile.write(data[first:last + 1])
+
+class RangeServer (SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__ (self, root, ignore_range=False):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _RangeRequestHandler)
+        self.root = root
+        self.ignore_range = ignore_range
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={ 'poll_interval': 0.05 })
+        self.thread.daemon = True
+        self.thread.start()
+
+    def handle_error (self, request, client_address):
+        pass                    # clients that hang up on a body they did not want
+
+    def url (self, name):
+        return 'http://127.0.0.1:%d/%s' % (self.server_address[1], name)
+
+    def stop (self):
+        self.shutdown()
+        self.server_close()
+
+##############################################################################
+## THE END
@@ -0,0 +1,161 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run from the top of the tree with: python -m unittest discover -s tests
+
+from __future__ import with_statement
+import os, unittest
+
+from biblio.ebook           import ebook_metadata
+from biblio.util.bytesource import ByteSourceException, CachedByteSource, FileByteSource, \
+                                   HTTPByteSource, open_byte_source
+from rangeserver            import RangeServer
+
+SAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'samples')
+
+##############################################################################
+
+class HTTPByteSourceTest (unittest.TestCase):
+
+    def setUp (self):
+        self.server = RangeServer(SAMPLES)
+
+    def tearDown (self):
+        self.server.stop()
+
+    def read_remote (self, name):
+        with open_byte_source(self.server.url(name)) as source:
+            ebook = ebook_metadata(source, hint=True)
+            return ebook, source.source
+
+    def assertSameMetadata (self, name, ebook):
+        local = ebook_metadata(os.path.join(SAMPLES, name))
+        self.assertEqual(dict(ebook), dict(local))
+
+    def test_mobi_metadata_in_two_requests (self):
+        ebook, source = self.read_remote('alice.mobi')
+        self.assertSameMetadata('alice.mobi', ebook)
+        self.assertTrue(source.requests <= 2, source.requests)
+        self.assertTrue(source.bytes_read < os.path.getsize(os.path.join(SAMPLES, 'alice.mobi')))
+
+    def test_epub_metadata_without_download (self):
+        ebook, source = self.read_remote('alice.epub')
+        self.assertSameMetadata('alice.epub', ebook)
+        self.assertTrue(source.requests <= 4, source.requests)
+        self.assertEqual(source.requests, len(self.server.requests))
+
+    def test_only_range_requests (self):
+        self.read_remote('alice.mobi')
+        for method, name, header in self.server.requests:
+            self.assertEqual(method, 'GET')
+            self.assertTrue(header.startswith('bytes='), header)
+
+    def test_size_from_content_range (self):
+        source = HTTPByteSource(self.server.url('alice.mobi'))
+        source.read_at(0, 10)
+        self.assertEqual(source.size(), os.path.getsize(os.path.join(SAMPLES, 'alice.mobi')))
+        self.assertEqual(source.requests, 1)
+        source.close()
+
+    def test_size_from_head (self):
+        source = HTTPByteSource(self.server.url('alice.mobi'))
+        self.assertEqual(source.size(), os.path.getsize(os.path.join(SAMPLES, 'alice.mobi')))
+        self.assertEqual(self.server.requests[0][0], 'HEAD')
+        source.close()
+
+    def test_read_past_end (self):
+        source = HTTPByteSource(self.server.url('alice.mobi'))
+        size = os.path.getsize(os.path.join(SAMPLES, 'alice.mobi'))
+        self.assertEqual(len(source.read_at(size - 10, 100)), 10)
+        self.assertEqual(source.read_at(size + 10, 100), '')
+        source.close()
+
+    def test_missing_file (self):
+        source = HTTPByteSource(self.server.url('missing.mobi'))
+        self.assertRaises(ByteSourceException, source.read_at, 0, 100)
+        source.close()
+
+class NoRangeServerTest (unittest.TestCase):
+
+    def setUp (self):
+        self.server = RangeServer(SAMPLES, ignore_range=True)
+
+    def tearDown (self):
+        self.server.stop()
+
+    def test_whole_file_answer_is_not_read (self):
+        source = HTTPByteSource(self.server.url('alice.mobi'))
+        self.assertRaises(ByteSourceException, source.read_at, 0, 100)
+        self.assertEqual(source.bytes_read, 0)
+        source.close()
+
+##############################################################################
+
+class CountingSource (FileByteSource):
+
+    def __init__ (self, filename):
+        FileByteSource.__init__(self, filename)
+        self.reads = []
+
+    def read_at (self, offset, length):
+        self.reads.append((offset, length))
+        return FileByteSource.read_at(self, offset, length)
+
+class CachedByteSourceTest (unittest.TestCase):
+
+    def setUp (self):
+        self.path = os.path.join(SAMPLES, 'alice.mobi')
+        with open(self.path, 'rb') as stream:
+            self.data = stream.read()
+        self.backend = CountingSource(self.path)
+        self.source = CachedByteSource(self.backend, block_size=1024, cache_size=8)
+
+    def tearDown (self):
+        self.source.close()
+
+    def test_reads_match_file (self):
+        for offset, length in ((0, 10), (1000, 100), (1020, 10), (5000, 3000), (len(self.data) - 5, 50)):
+            self.assertEqual(self.source.read_at(offset, length), self.data[offset:offset + length])
+
+    def test_adjacent_blocks_coalesced (self):
+        self.source.read_at(100, 3000)
+        self.assertEqual(self.backend.reads, [ (0, 4096), ])
+
+    def test_only_missing_blocks_fetched (self):
+        self.source.read_at(1024, 1024)
+        del self.backend.reads[:]
+        self.assertEqual(self.source.read_at(0, 4096), self.data[:4096])
+        self.assertEqual(self.backend.reads, [ (0, 1024), (2048, 2048), ])
+
+    def test_cached_blocks_not_fetched_again (self):
+        self.source.read_at(0, 2048)
+        self.source.read_at(512, 1024)
+        self.assertEqual(len(self.backend.reads), 1)
+
+    def test_lru_eviction (self):
+        for n in xrange(10):
+            self.source.read_at(n * 1024, 1)
+        del self.backend.reads[:]
+        self.source.read_at(0, 1)
+        self.assertEqual(self.backend.reads, [ (0, 1024), ])
+
+##############################################################################
+
+if __name__ == '__main__':
+    unittest.main()
+
+##############################################################################
+## THE END
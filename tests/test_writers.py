@@ -0,0 +1,309 @@
+# vim:set ts=4 sw=4 sts=4 et nowrap syntax=python ff=unix:
+#
+# Copyright 2011 Mark Crewson <mark@crewson.net>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Run from the top of the tree with: python -m unittest discover -s tests
+
+from __future__ import with_statement
+import os, shutil, stat, sys, tempfile, unittest, zipfile
+
+from biblio.ebook                 import ebook_metadata
+from biblio.identifiers.filetypes import OPF2
+from biblio.metadata              import EbookMetadata
+from biblio.parsers               import ParserException, WRITE_IN_PLACE, WRITE_REWRITE, WRITE_APPEND, \
+                                         find_parser, read_metadata, recover_batch, write_metadata, \
+                                         write_metadata_batch
+from biblio.parsers.epub          import write_epub_metadata
+from biblio.parsers.mobi          import read_mobi_metadata
+from biblio.parsers.opf           import process_opf_metadata
+from biblio.util.rawzip           import replace_member
+
+SAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'samples')
+
+# Not a default umask would produce, so a writer that loses it shows
+BOOK_MODE = 0640
+
+##############################################################################
+
+class WriterTestCase (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown (self):
+        shutil.rmtree(self.directory)
+
+    def sample (self, name, copy=None):
+        path = os.path.join(self.directory, copy or name)
+        shutil.copyfile(os.path.join(SAMPLES, name), path)
+        os.chmod(path, BOOK_MODE)
+        return path
+
+    def read (self, path):
+        with open(path, 'rb') as stream:
+            return stream.read()
+
+    def assertMode (self, path):
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), BOOK_MODE)
+
+    def assertNoLeftovers (self, *expected):
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted(expected))
+
+##############################################################################
+
+def _members (path):
+    with zipfile.ZipFile(path) as archive:
+        return [ (info.filename, info.compress_type) for info in archive.infolist() ]
+
+def _layout (path):
+    # The members in the order they are stored, rather than listed
+    with zipfile.ZipFile(path) as archive:
+        infos = sorted(archive.infolist(), key=lambda info: info.header_offset)
+        return [ (info.filename, info.compress_type) for info in infos ]
+
+def _member_data (path):
+    with zipfile.ZipFile(path) as archive:
+        return dict((name, archive.read(name)) for name in archive.namelist())
+
+class EPubWriterTest (WriterTestCase):
+
+    def update (self, path, mode=None, target=None):
+        ebook = ebook_metadata(path)
+        ebook.title = u'Alice\u2019s Adventures in Wonderland'
+        ebook.authors = [ u'Lewis Carroll', u'John Tenniel', ]
+        return write_epub_metadata(path, ebook, mode=mode, target=target)
+
+    def assertUpdated (self, path, original):
+        ebook = ebook_metadata(path)
+        self.assertEqual(ebook.title, u'Alice\u2019s Adventures in Wonderland')
+        self.assertEqual(ebook.authors, [ u'Lewis Carroll', u'John Tenniel', ])
+
+        with zipfile.ZipFile(path) as archive:
+            self.assertEqual(archive.testzip(), None)
+        self.assertEqual(_members(path), _members(original))
+        self.assertEqual(_layout(path)[0], ('mimetype', zipfile.ZIP_STORED))
+        before, after = _member_data(original), _member_data(path)
+        for name in before:
+            if name != 'content.opf':
+                self.assertEqual(after[name], before[name], name)
+        self.assertMode(path)
+
+    def test_rewrite (self):
+        path = self.sample('alice.epub')
+        self.assertEqual(self.update(path, mode=WRITE_REWRITE), WRITE_REWRITE)
+        self.assertUpdated(path, os.path.join(SAMPLES, 'alice.epub'))
+        self.assertNoLeftovers('alice.epub')
+
+    def test_append (self):
+        path = self.sample('alice.epub')
+        self.assertEqual(self.update(path, mode=WRITE_APPEND), WRITE_APPEND)
+        self.assertUpdated(path, os.path.join(SAMPLES, 'alice.epub'))
+        self.assertTrue(os.path.getsize(path) > os.path.getsize(os.path.join(SAMPLES, 'alice.epub')))
+
+    def test_target_leaves_original (self):
+        path = self.sample('alice.epub')
+        target = os.path.join(self.directory, 'updated.epub')
+        self.assertEqual(self.update(path, mode=WRITE_APPEND, target=target), WRITE_REWRITE)
+        self.assertEqual(self.read(path), self.read(os.path.join(SAMPLES, 'alice.epub')))
+        self.assertUpdated(target, path)
+
+    def test_misordered_mimetype_moved_first (self):
+        path = os.path.join(self.directory, 'misordered.epub')
+        members = _member_data(os.path.join(SAMPLES, 'alice.epub'))
+        names = [ name for name, compress in _members(os.path.join(SAMPLES, 'alice.epub')) ]
+        names.remove('mimetype')
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name in names[:3] + [ 'mimetype', ] + names[3:]:
+                archive.writestr(name, members[name])
+        os.chmod(path, BOOK_MODE)
+
+        self.update(path, mode=WRITE_REWRITE)
+        self.assertEqual(_layout(path)[0], ('mimetype', zipfile.ZIP_STORED))
+        self.assertEqual([ name for name, compress in _layout(path)[1:] ], names)
+        self.assertEqual(_member_data(path)['mimetype'], 'application/epub+zip')
+        self.assertMode(path)
+
+    def test_replace_member_adds_at_end (self):
+        path = self.sample('alice.epub')
+        replace_member(path, 'extra.txt', 'hello')
+        self.assertEqual(_members(path)[:-1], _members(os.path.join(SAMPLES, 'alice.epub')))
+        self.assertEqual(_members(path)[-1][0], 'extra.txt')
+        self.assertEqual(_member_data(path)['extra.txt'], 'hello')
+        self.assertMode(path)
+
+##############################################################################
+
+def _opf_ebook (path):
+    return process_opf_metadata(read_metadata(path).opf, EbookMetadata(OPF2))
+
+class OPFWriterTest (WriterTestCase):
+
+    def test_round_trip (self):
+        path = self.sample('alice.opf')
+        ebook = _opf_ebook(path)
+        ebook.title = u'Through the Looking-Glass'
+        self.assertEqual(find_parser(OPF2).writer(path, ebook), WRITE_REWRITE)
+
+        updated = _opf_ebook(path)
+        self.assertEqual(updated.title, u'Through the Looking-Glass')
+        self.assertEqual(updated.authors, ebook.authors)
+        original = read_metadata(os.path.join(SAMPLES, 'alice.opf')).opf
+        self.assertEqual(read_metadata(path).opf.manifest, original.manifest)
+        self.assertEqual(read_metadata(path).opf.spine, original.spine)
+        self.assertMode(path)
+        self.assertNoLeftovers('alice.opf')
+
+    def test_target (self):
+        path = self.sample('alice.opf')
+        target = os.path.join(self.directory, 'updated.opf')
+        ebook = _opf_ebook(path)
+        ebook.title = u'Through the Looking-Glass'
+        find_parser(OPF2).writer(path, ebook, target=target)
+        self.assertEqual(self.read(path), self.read(os.path.join(SAMPLES, 'alice.opf')))
+        self.assertEqual(_opf_ebook(target).title, u'Through the Looking-Glass')
+        self.assertMode(target)
+
+##############################################################################
+
+def _records (path):
+    data = open(path, 'rb').read()
+    return [ data[offset:offset + length] for offset, length in read_mobi_metadata(path).pdb.records ]
+
+class MobiWriterTest (WriterTestCase):
+
+    def test_in_place (self):
+        path = self.sample('alice.mobi')
+        ebook = ebook_metadata(path)
+        ebook.title = u'Alice'
+        ebook.authors = [ u'Carroll, Lewis', ]
+        self.assertEqual(write_metadata(path, ebook), WRITE_IN_PLACE)
+
+        updated = ebook_metadata(path)
+        self.assertEqual(updated.title, u'Alice')
+        self.assertEqual(updated.authors, [ u'Carroll, Lewis', ])
+        self.assertEqual(os.path.getsize(path), os.path.getsize(os.path.join(SAMPLES, 'alice.mobi')))
+        self.assertEqual(_records(path)[1:], _records(os.path.join(SAMPLES, 'alice.mobi'))[1:])
+        self.assertMode(path)
+
+    def test_rewrite_when_record0_grows (self):
+        path = self.sample('alice.mobi')
+        ebook = ebook_metadata(path)
+        ebook.description = u'A girl falls down a rabbit hole. ' * 500
+        self.assertEqual(write_metadata(path, ebook), WRITE_REWRITE)
+
+        self.assertEqual(ebook_metadata(path).description, ebook.description)
+        self.assertEqual(_records(path)[1:], _records(os.path.join(SAMPLES, 'alice.mobi'))[1:])
+        self.assertMode(path)
+        self.assertNoLeftovers('alice.mobi')
+
+    def test_target_leaves_original (self):
+        path = self.sample('alice.mobi')
+        target = os.path.join(self.directory, 'updated.mobi')
+        ebook = ebook_metadata(path)
+        ebook.title = u'Alice'
+        self.assertEqual(find_parser(ebook.filetype).writer(path, ebook, target=target), WRITE_REWRITE)
+        self.assertEqual(self.read(path), self.read(os.path.join(SAMPLES, 'alice.mobi')))
+        self.assertEqual(ebook_metadata(target).title, u'Alice')
+        self.assertMode(target)
+
+##############################################################################
+
+class _Crash (Exception):
+    pass
+
+class BatchWriterTest (WriterTestCase):
+
+    def setUp (self):
+        WriterTestCase.setUp(self)
+        self.books = [ self.sample('alice.epub'), self.sample('alice.mobi'), ]
+        self.journal = os.path.join(self.directory, 'batch.journal')
+        self.originals = [ self.read(path) for path in self.books ]
+        # The plugin loader re-imports the parsers package, so patch it
+        # where the batch writer looks its helpers up
+        self.parsers = sys.modules['biblio.parsers']
+        self.commit_one = self.parsers._commit_one
+
+    def tearDown (self):
+        self.parsers._commit_one = self.commit_one
+        WriterTestCase.tearDown(self)
+
+    def items (self):
+        items = []
+        for path in self.books:
+            ebook = ebook_metadata(path)
+            ebook.title = u'Alice'
+            items.append((path, ebook))
+        return items
+
+    def crash_after_first_commit (self):
+        calls = []
+        def commit_one (*args):
+            if calls:
+                raise _Crash()
+            calls.append(args)
+            self.commit_one(*args)
+        self.parsers._commit_one = commit_one
+        self.assertRaises(_Crash, write_metadata_batch, self.items(), journal=self.journal)
+        self.parsers._commit_one = self.commit_one
+
+    def test_batch (self):
+        results = write_metadata_batch(self.items(), jobs=2, journal=self.journal)
+        self.assertEqual([ r.error for r in results ], [ None, None, ])
+        self.assertEqual([ r.result for r in results ], [ WRITE_REWRITE, WRITE_REWRITE, ])
+        for path in self.books:
+            self.assertEqual(ebook_metadata(path).title, u'Alice')
+            self.assertMode(path)
+        self.assertEqual(_members(self.books[0]), _members(os.path.join(SAMPLES, 'alice.epub')))
+        self.assertNoLeftovers('alice.epub', 'alice.mobi')
+
+    def test_failure_is_isolated (self):
+        items = self.items()
+        broken = os.path.join(self.directory, 'broken.epub')
+        with open(broken, 'wb') as stream:
+            stream.write('PK\x03\x04 not really a zip')
+        results = write_metadata_batch(items + [ (broken, items[0][1]), ])
+        self.assertEqual(results[0].error, None)
+        self.assertNotEqual(results[2].error, None)
+        self.assertEqual(ebook_metadata(self.books[0]).title, u'Alice')
+        self.assertNoLeftovers('alice.epub', 'alice.mobi', 'broken.epub')
+
+    def test_existing_journal_refused (self):
+        open(self.journal, 'wb').close()
+        self.assertRaises(ParserException, write_metadata_batch, self.items(), journal=self.journal)
+        self.assertEqual([ self.read(path) for path in self.books ], self.originals)
+
+    def test_recover_finishes_batch (self):
+        self.crash_after_first_commit()
+        self.assertEqual(recover_batch(self.journal), self.books)
+        for path in self.books:
+            self.assertEqual(ebook_metadata(path).title, u'Alice')
+            self.assertMode(path)
+        self.assertNoLeftovers('alice.epub', 'alice.mobi')
+
+    def test_recover_rolls_back (self):
+        self.crash_after_first_commit()
+        self.assertEqual(recover_batch(self.journal, rollback=True), [])
+        self.assertEqual([ self.read(path) for path in self.books ], self.originals)
+        for path in self.books:
+            self.assertMode(path)
+        self.assertNoLeftovers('alice.epub', 'alice.mobi')
+
+##############################################################################
+
+if __name__ == '__main__':
+    unittest.main()
+
+##############################################################################
+## THE END